@@ -0,0 +1,478 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark for the lore bot.
+
+Builds a synthetic guild (RP channels with realistic time gaps, [INFO] posts,
+ignored channels), then drives the real /setup and /lore handlers from main.py
+against stub Discord objects and a local fake OpenAI server with configurable
+latency. Reports messages/sec, embeddings/sec, peak RSS and p50/p95/p99 query
+latency, and optionally compares them to a previous run.
+
+Usage:
+    python bench_bot.py
+    BENCH_CHANNELS=20 BENCH_QUERIES=500 python bench_bot.py
+    BENCH_BASELINE=previous_bench.txt python bench_bot.py   # exit code 1 on regression
+"""
+
+import os
+import sys
+import json
+import time
+import base64
+import random
+import shutil
+import asyncio
+import logging
+import resource
+import tempfile
+import threading
+import functools
+import hashlib
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import numpy as np
+
+# Benchmark settings
+BENCH_CHANNELS = int(os.getenv('BENCH_CHANNELS', '6'))  # [RP] channels in the synthetic guild
+BENCH_SCENES_PER_CHANNEL = int(os.getenv('BENCH_SCENES_PER_CHANNEL', '20'))  # Scenes per [RP] channel
+BENCH_MESSAGES_PER_SCENE = int(os.getenv('BENCH_MESSAGES_PER_SCENE', '40'))  # Average messages per scene (actual count varies by +/-50%)
+BENCH_INFO_POSTS = int(os.getenv('BENCH_INFO_POSTS', '50'))  # Posts in the [INFO] channel
+BENCH_QUERIES = int(os.getenv('BENCH_QUERIES', '200'))  # /lore questions asked after /setup
+BENCH_QUERY_CONCURRENCY = int(os.getenv('BENCH_QUERY_CONCURRENCY', '8'))  # /lore questions in flight at once
+BENCH_CHAT_LATENCY_MS = float(os.getenv('BENCH_CHAT_LATENCY_MS', '300'))  # Fake OpenAI: delay before a chat completion (or its first streamed chunk)
+BENCH_STREAM_CHUNK_MS = float(os.getenv('BENCH_STREAM_CHUNK_MS', '20'))  # Fake OpenAI: delay between streamed chunks
+BENCH_EMBED_LATENCY_MS = float(os.getenv('BENCH_EMBED_LATENCY_MS', '50'))  # Fake OpenAI: delay per embeddings request
+BENCH_HISTORY_LATENCY_MS = float(os.getenv('BENCH_HISTORY_LATENCY_MS', '0'))  # Stub Discord: delay per 100-message history page
+BENCH_EMBED_DIM = int(os.getenv('BENCH_EMBED_DIM', '256'))  # Dimension of the fake embeddings
+BENCH_SEED = int(os.getenv('BENCH_SEED', '42'))  # Seed of the synthetic guild and questions
+BENCH_OUTPUT = os.path.abspath(os.getenv('BENCH_OUTPUT', 'bench_output.txt'))  # Report file (the last line is the JSON summary)
+BENCH_BASELINE = os.getenv('BENCH_BASELINE')  # Previous report to compare against
+BENCH_TOLERANCE = float(os.getenv('BENCH_TOLERANCE', '0.2'))  # Relative regression allowed before exiting with code 1
+BENCH_KEEP_WORKDIR = os.getenv('BENCH_KEEP_WORKDIR', '0') == '1'  # Keep the temporary index directory for inspection
+BENCH_LOG_LEVEL = os.getenv('BENCH_LOG_LEVEL', 'WARNING')  # Log level of main.py during the run
+BENCH_GUILD_ID = 424242
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='[%(asctime)s] [%(levelname)s] %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S',
+    force=True
+)
+logger = logging.getLogger("bench")
+
+# Fake OpenAI server -----------------------------------------------------------
+
+fake_openai_stats = {"embed_requests": 0, "embed_inputs": 0, "chat_requests": 0, "chat_streams": 0}
+fake_openai_lock = threading.Lock()
+
+def count_request(**counts):
+    with fake_openai_lock:
+        for key, value in counts.items():
+            fake_openai_stats[key] += value
+
+@functools.lru_cache(maxsize=100000)
+def word_vector(word):
+    seed = int.from_bytes(hashlib.md5(word.encode("utf-8")).digest()[:8], "little")
+    return np.random.default_rng(seed).standard_normal(BENCH_EMBED_DIM).astype('float32')
+
+def fake_embedding(text):
+    """Deterministic embedding: sum of per-word random directions, so texts sharing words are close."""
+    vector = np.zeros(BENCH_EMBED_DIM, dtype='float32')
+    for word in text.lower().split()[:512]:
+        vector += word_vector(word)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else word_vector("<empty>")
+
+def fake_completion(messages):
+    """Short deterministic answer built from the last prompt (summaries, titles and /lore answers alike)."""
+    words = messages[-1]["content"].split() if messages else []
+    return "Résumé : " + " ".join(words[:60])
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        request = json.loads(self.rfile.read(length) or b"{}")
+        path = self.path.split("?")[0].rstrip("/")
+        if path.endswith("/embeddings"):
+            self.embeddings(request)
+        elif path.endswith("/chat/completions"):
+            self.chat_completions(request)
+        else:
+            self.send_json(404, {"error": {"message": f"unknown path {self.path}", "type": "invalid_request_error"}})
+
+    def embeddings(self, request):
+        inputs = request.get("input") or []
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        count_request(embed_requests=1, embed_inputs=len(inputs))
+        time.sleep(BENCH_EMBED_LATENCY_MS / 1000)
+        data = []
+        for position, text in enumerate(inputs):
+            vector = fake_embedding(str(text))
+            # The openai client asks for base64 by default
+            if request.get("encoding_format") == "base64":
+                embedding = base64.b64encode(vector.astype('<f4').tobytes()).decode("ascii")
+            else:
+                embedding = vector.tolist()
+            data.append({"object": "embedding", "index": position, "embedding": embedding})
+        tokens = sum(len(str(text)) // 4 for text in inputs)
+        self.send_json(200, {"object": "list", "data": data, "model": request.get("model"),
+                             "usage": {"prompt_tokens": tokens, "total_tokens": tokens}})
+
+    def chat_completions(self, request):
+        count_request(chat_requests=1, chat_streams=1 if request.get("stream") else 0)
+        answer = fake_completion(request.get("messages") or [])
+        base = {"id": "chatcmpl-bench", "created": int(time.time()), "model": request.get("model")}
+        time.sleep(BENCH_CHAT_LATENCY_MS / 1000)
+        if not request.get("stream"):
+            self.send_json(200, dict(base, object="chat.completion", choices=[
+                {"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+                usage={"prompt_tokens": 0, "completion_tokens": len(answer) // 4, "total_tokens": len(answer) // 4}))
+            return
+        # Server-sent events, a few words per chunk; the connection is closed after [DONE]
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        words = answer.split(" ")
+        for start in range(0, len(words), 4):
+            delta = " ".join(words[start:start + 4]) + (" " if start + 4 < len(words) else "")
+            chunk = dict(base, object="chat.completion.chunk", choices=[{"index": 0, "delta": {"content": delta}, "finish_reason": None}])
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+            time.sleep(BENCH_STREAM_CHUNK_MS / 1000)
+        chunk = dict(base, object="chat.completion.chunk", choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}])
+        self.wfile.write(f"data: {json.dumps(chunk)}\n\ndata: [DONE]\n\n".encode("utf-8"))
+        self.wfile.flush()
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def start_fake_openai():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeOpenAIHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# Stub Discord objects ---------------------------------------------------------
+
+class StubMessage:
+    def __init__(self, message_id, content, created_at, author):
+        self.id = message_id
+        self.content = content
+        self.clean_content = content
+        self.created_at = created_at
+        self.author = author
+        self.attachments = []
+
+class StubChannel:
+    def __init__(self, channel_id, name, category, messages):
+        self.id = channel_id
+        self.name = name
+        self.category = SimpleNamespace(name=category) if category else None
+        self.messages = messages
+
+    def history(self, limit=None, oldest_first=True, after=None):
+        async def iterate():
+            for position, message in enumerate(self.messages):
+                # Discord returns history in pages of 100 messages
+                if position % 100 == 0:
+                    await asyncio.sleep(BENCH_HISTORY_LATENCY_MS / 1000)
+                if after is not None and message.created_at <= after:
+                    continue
+                yield message
+        return iterate()
+
+class StubSentMessage:
+    async def edit(self, content=None, **kwargs):
+        pass
+
+class StubInteraction:
+    def __init__(self, guild):
+        self.guild = guild
+        self.guild_id = guild.id
+        self.user = SimpleNamespace(id=1, guild_permissions=SimpleNamespace(administrator=True))
+        self.sent = []
+        self.first_response_at = None
+        interaction = self
+
+        class Response:
+            async def defer(self, **kwargs):
+                pass
+
+            async def send_message(self, content=None, **kwargs):
+                interaction.record(content)
+
+        class Followup:
+            async def send(self, content=None, **kwargs):
+                interaction.record(content)
+                return StubSentMessage()
+
+        self.response = Response()
+        self.followup = Followup()
+
+    def record(self, content):
+        if self.first_response_at is None:
+            self.first_response_at = time.perf_counter()
+        self.sent.append(content)
+
+    async def edit_original_response(self, content=None, **kwargs):
+        pass
+
+# Synthetic guild --------------------------------------------------------------
+
+CHARACTERS = ["Alaric", "Brune", "Cassien", "Dame Orla", "Edwin", "Fenra", "Garrick", "Hesper", "Isolde", "Jorund",
+              "Kael", "Liora", "Maelis", "Nerys", "Osric", "Perrine"]
+PLACES = ["la taverne du Sanglier", "le port de Valmer", "la citadelle du nord", "la forêt d'Ombreval", "les mines de Karst",
+          "le temple d'Aube", "la bibliothèque royale", "le marché aux épices", "les marais de Brume", "la tour de l'Archimage"]
+OBJECTS = ["une épée runique", "une carte ancienne", "un grimoire scellé", "une bourse d'or", "un médaillon terni",
+           "une lettre cachetée", "une fiole de poison", "un cristal de lune", "une couronne brisée", "un arc elfique"]
+ACTIONS = ["observe", "interroge", "suit discrètement", "menace", "négocie avec", "soigne", "défie", "trahit", "protège", "rejoint"]
+MOODS = ["avec méfiance", "en silence", "d'un ton grave", "en riant", "sous la pluie", "à la lueur des torches",
+         "malgré la fatigue", "sans hésiter", "avec colère", "en murmurant"]
+FACTIONS = ["la Guilde des Ombres", "l'Ordre de l'Aube", "le Conseil de Valmer", "les Clans du Nord", "la Compagnie Marchande"]
+
+def rp_sentence(rng):
+    return (f"{rng.choice(CHARACTERS)} {rng.choice(ACTIONS)} {rng.choice(CHARACTERS)} {rng.choice(MOODS)} "
+            f"près de {rng.choice(PLACES)} et parle de {rng.choice(OBJECTS)}.")
+
+def info_paragraph(rng):
+    sentences = [f"{rng.choice(FACTIONS)} contrôle {rng.choice(PLACES)} depuis la guerre de l'an {rng.randint(200, 900)}."]
+    for _ in range(rng.randint(3, 8)):
+        sentences.append(f"{rng.choice(CHARACTERS)} y garde {rng.choice(OBJECTS)} pour le compte de {rng.choice(FACTIONS)}.")
+    return " ".join(sentences)
+
+def build_guild(rng, scene_break_hours):
+    """Synthetic guild: [RP] channels split into scenes by long pauses, one [INFO] channel and ignored channels."""
+    authors = [SimpleNamespace(display_name=name, id=1000 + i, bot=False) for i, name in enumerate(CHARACTERS)]
+    game_master = SimpleNamespace(display_name="MJ", id=999, bot=False)
+    start = datetime(2023, 1, 1, tzinfo=timezone.utc)
+    next_id = iter(range(10 ** 15, 10 ** 16))
+    channels = []
+    for chan_no in range(BENCH_CHANNELS):
+        messages = []
+        when = start + timedelta(hours=rng.uniform(0, 48))
+        for _ in range(BENCH_SCENES_PER_CHANNEL):
+            # A new scene starts after a pause longer than the scene break threshold
+            when += timedelta(hours=scene_break_hours + rng.uniform(1, 72))
+            cast = rng.sample(authors, rng.randint(2, 4))
+            count = max(1, rng.randint(BENCH_MESSAGES_PER_SCENE // 2, BENCH_MESSAGES_PER_SCENE * 3 // 2))
+            for _ in range(count):
+                # Replies a few minutes apart, sometimes much later in the same scene
+                when += timedelta(seconds=min(rng.expovariate(1 / 240), scene_break_hours * 3600 * 0.5))
+                content = " ".join(rp_sentence(rng) for _ in range(rng.randint(1, 4)))
+                messages.append(StubMessage(next(next_id), content, when, rng.choice(cast)))
+        category = f"[RP] Région {chan_no % 3 + 1}"
+        channels.append(StubChannel(100 + chan_no, f"scene-{chan_no}", category, messages))
+    info_messages = [StubMessage(next(next_id), info_paragraph(rng), start + timedelta(days=day), game_master)
+                     for day in range(BENCH_INFO_POSTS)]
+    channels.append(StubChannel(90, "[INFO] encyclopedie", None, info_messages))
+    # Channels that /setup must skip
+    channels.append(StubChannel(91, "[HRP] discussions", "[RP] Région 1", [StubMessage(next(next_id), "hors sujet", start, game_master)]))
+    channels.append(StubChannel(92, "general", None, [StubMessage(next(next_id), "bonjour", start, game_master)]))
+    return SimpleNamespace(id=BENCH_GUILD_ID, name="Bench", text_channels=channels)
+
+def build_questions(rng, count):
+    templates = ["Que sait-on de {c} et de {o} ?", "Où se trouve {o} selon {c} ?", "Qui contrôle {p} ?",
+                 "Que s'est-il passé entre {c} et {c2} à {p} ?", "Pourquoi {c} cherche-t-il {o} ?"]
+    return [rng.choice(templates).format(c=rng.choice(CHARACTERS), c2=rng.choice(CHARACTERS), o=rng.choice(OBJECTS), p=rng.choice(PLACES))
+            for _ in range(count)]
+
+# Measurements -----------------------------------------------------------------
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def percentiles_ms(samples):
+    if not samples:
+        return {"p50": None, "p95": None, "p99": None}
+    values = np.percentile(np.asarray(samples) * 1000, [50, 95, 99])
+    return {"p50": round(float(values[0]), 1), "p95": round(float(values[1]), 1), "p99": round(float(values[2]), 1)}
+
+async def run_setup(main, guild):
+    interaction = StubInteraction(guild)
+    messages = sum(len(channel.messages) for channel in guild.text_channels if main.channel_kind(channel))
+    before = dict(fake_openai_stats)
+    started = time.perf_counter()
+    await main.setup_command.callback(interaction)
+    seconds = time.perf_counter() - started
+    reply = interaction.sent[-1] if interaction.sent else ""
+    if not reply.startswith("Index du lore mis à jour"):
+        raise RuntimeError(f"/setup failed: {reply}")
+    shard = main.get_shard(guild.id)
+    embedded = fake_openai_stats["embed_inputs"] - before["embed_inputs"]
+    return {
+        "seconds": round(seconds, 3),
+        "messages": messages,
+        "messages_per_sec": round(messages / seconds, 1),
+        "scenes": len(shard.scenes_data),
+        "vectors": shard.faiss_index.ntotal if shard.faiss_index is not None else 0,
+        "embeddings": embedded,
+        "embeddings_per_sec": round(embedded / seconds, 1),
+        "embed_requests": fake_openai_stats["embed_requests"] - before["embed_requests"],
+        "chat_requests": fake_openai_stats["chat_requests"] - before["chat_requests"],
+        "peak_rss_mb": peak_rss_mb()
+    }
+
+async def run_queries(main, guild, questions):
+    latencies, first_responses, failures = [], [], []
+    semaphore = asyncio.Semaphore(BENCH_QUERY_CONCURRENCY)
+
+    async def ask(question):
+        async with semaphore:
+            interaction = StubInteraction(guild)
+            started = time.perf_counter()
+            await main.lore_command.callback(interaction, question)
+            latencies.append(time.perf_counter() - started)
+            if interaction.first_response_at is not None:
+                first_responses.append(interaction.first_response_at - started)
+            if not interaction.sent or any(str(text).startswith(("Désolé", "Le lore")) for text in interaction.sent):
+                failures.append((question, interaction.sent))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(ask(question) for question in questions))
+    seconds = time.perf_counter() - started
+    cache = main.get_shard(guild.id).answer_cache
+    for question, sent in failures[:5]:
+        logger.warning(f"Query failed: {question!r} -> {sent}")
+    return {
+        "queries": len(questions),
+        "failures": len(failures),
+        "seconds": round(seconds, 3),
+        "queries_per_sec": round(len(questions) / seconds, 2) if seconds > 0 else None,
+        "latency_ms": percentiles_ms(latencies),
+        "first_response_ms": percentiles_ms(first_responses),
+        "answer_cache_hits": cache.hits + cache.semantic_hits,
+        "peak_rss_mb": peak_rss_mb()
+    }
+
+# Metrics compared to the baseline: (path in the report, True if higher is better)
+BASELINE_METRICS = [
+    (("setup", "messages_per_sec"), True),
+    (("setup", "embeddings_per_sec"), True),
+    (("lore", "latency_ms", "p50"), False),
+    (("lore", "latency_ms", "p95"), False),
+    (("lore", "latency_ms", "p99"), False),
+    (("peak_rss_mb",), False),
+]
+
+def load_baseline(path):
+    # A report file ends with its JSON summary; a plain JSON file works too
+    with open(path, "r", encoding="utf-8") as f:
+        lines = [line for line in f.read().splitlines() if line.strip()]
+    return json.loads(lines[-1])
+
+def compare_to_baseline(report, baseline):
+    regressions, lines = [], []
+    for path, higher_is_better in BASELINE_METRICS:
+        current, previous = report, baseline
+        for key in path:
+            current = current.get(key) if isinstance(current, dict) else None
+            previous = previous.get(key) if isinstance(previous, dict) else None
+        if not current or not previous:
+            continue
+        change = (current - previous) / previous
+        worse = -change if higher_is_better else change
+        name = ".".join(path)
+        lines.append(f"  {name}: {previous} -> {current} ({change:+.1%})")
+        if worse > BENCH_TOLERANCE:
+            regressions.append(name)
+    return regressions, lines
+
+def format_report(report):
+    setup, lore = report["setup"], report["lore"]
+    return "\n".join([
+        f"Synthetic guild: {report['config']['channels']} RP channels x {report['config']['scenes_per_channel']} scenes, "
+        f"{report['config']['info_posts']} info posts, embeddings dim {report['config']['embed_dim']}",
+        f"/setup: {setup['messages']} messages in {setup['seconds']}s -> {setup['messages_per_sec']} messages/s",
+        f"        {setup['embeddings']} embeddings ({setup['embed_requests']} requests) -> {setup['embeddings_per_sec']} embeddings/s, "
+        f"{setup['chat_requests']} chat requests, {setup['scenes']} scenes, {setup['vectors']} vectors",
+        f"/lore:  {lore['queries']} queries ({lore['failures']} failed, {lore['answer_cache_hits']} cache hits), "
+        f"concurrency {report['config']['query_concurrency']}, {lore['queries_per_sec']} queries/s",
+        f"        latency p50 {lore['latency_ms']['p50']} ms, p95 {lore['latency_ms']['p95']} ms, p99 {lore['latency_ms']['p99']} ms",
+        f"        first response p50 {lore['first_response_ms']['p50']} ms, p95 {lore['first_response_ms']['p95']} ms, "
+        f"p99 {lore['first_response_ms']['p99']} ms",
+        f"Peak RSS: {report['peak_rss_mb']} MB (after /setup: {setup['peak_rss_mb']} MB)",
+    ])
+
+async def run_benchmark(main):
+    rng = random.Random(BENCH_SEED)
+    guild = build_guild(rng, main.SCENE_BREAK_HOURS)
+    questions = build_questions(rng, BENCH_QUERIES)
+    logger.info("Running /setup on the synthetic guild...")
+    setup = await run_setup(main, guild)
+    logger.info(f"/lore: {len(questions)} questions, concurrency {BENCH_QUERY_CONCURRENCY}...")
+    lore = await run_queries(main, guild, questions)
+    return {
+        "config": {"channels": BENCH_CHANNELS, "scenes_per_channel": BENCH_SCENES_PER_CHANNEL,
+                   "messages_per_scene": BENCH_MESSAGES_PER_SCENE, "info_posts": BENCH_INFO_POSTS,
+                   "queries": BENCH_QUERIES, "query_concurrency": BENCH_QUERY_CONCURRENCY,
+                   "chat_latency_ms": BENCH_CHAT_LATENCY_MS, "embed_latency_ms": BENCH_EMBED_LATENCY_MS,
+                   "embed_dim": BENCH_EMBED_DIM, "seed": BENCH_SEED},
+        "setup": setup,
+        "lore": lore,
+        "peak_rss_mb": peak_rss_mb()
+    }
+
+def main():
+    server = start_fake_openai()
+    workdir = tempfile.mkdtemp(prefix="lore-bench-")
+    # main.py reads its configuration at import time: point it at the fake server and the temporary directory
+    os.environ.update({
+        "OPENAI_API_KEY": "bench",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{server.server_address[1]}/v1",
+        "LORE_LEGACY_GUILD_ID": str(BENCH_GUILD_ID),
+        "LIVE_INDEXING": "0",
+    })
+    # Rate limits are not what is measured here (override them to benchmark throttling)
+    for name in ("OPENAI_RPM", "OPENAI_TPM", "OPENAI_EMBED_RPM", "OPENAI_EMBED_TPM"):
+        os.environ.setdefault(name, str(10 ** 9))
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(workdir)
+    exit_code = 0
+    try:
+        import main as bot_main
+        logging.getLogger(bot_main.__name__).setLevel(BENCH_LOG_LEVEL)
+        logging.getLogger("httpx").setLevel(logging.WARNING)
+        # Never touch the real Google Drive from a benchmark
+        bot_main._drive_init_attempted = True
+        bot_main.drive_service = None
+        report = asyncio.run(run_benchmark(bot_main))
+        text = format_report(report)
+        if BENCH_BASELINE:
+            regressions, lines = compare_to_baseline(report, load_baseline(BENCH_BASELINE))
+            text += f"\nCompared to {BENCH_BASELINE} (tolerance {BENCH_TOLERANCE:.0%}):\n" + "\n".join(lines)
+            if regressions:
+                text += f"\nREGRESSION: {', '.join(regressions)}"
+                exit_code = 1
+        if report["lore"]["failures"]:
+            exit_code = 1
+        print(text, flush=True)
+        with open(BENCH_OUTPUT, "w", encoding="utf-8") as f:
+            f.write(text + "\n" + json.dumps(report) + "\n")
+        logger.info(f"Report written to {BENCH_OUTPUT}")
+    finally:
+        server.shutdown()
+        if BENCH_KEEP_WORKDIR:
+            logger.info(f"Index files kept in {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return exit_code
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,8 @@
+import os
+
+# test_bot.py is a manual connection check against Discord, not a unit test module
+collect_ignore = ["test_bot.py"]
+
+# main.py builds its OpenAI client at import time: placeholder credentials are enough for offline tests
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("DISCORD_TOKEN", "test")
@@ -4,14 +4,24 @@ import os
 import io
 import json
 import asyncio
+import contextlib
 import functools
+import hashlib
 import logging
-from datetime import datetime, timedelta
+import random
+import re
+import sqlite3
+import time
+import unicodedata
+import uuid
+from array import array
+from collections import Counter, OrderedDict, deque
+from datetime import datetime
 
 import discord
 from discord import app_commands
 
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI, RateLimitError, BadRequestError
 import numpy as np
 import threading  # mini serveur HTTP pour Render Web
 import base64  # pour décoder des credentials en base64 si fournis
@@ -44,6 +54,13 @@ try:
     import nacl
 except ImportError:
     logger.warning("PyNaCl is not installed, voice will NOT be supported")
+
+# Tokenizer OpenAI (optionnel) pour mesurer le contexte envoyé à GPT ; à défaut, estimation ~4 caractères/token
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+    logger.warning("tiktoken n'est pas installé : le nombre de tokens du contexte /lore sera estimé")
 DISCORD_TOKEN = os.getenv('DISCORD_TOKEN')
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 OPENAI_MODEL = os.getenv('OPENAI_MODEL', 'gpt-4')
@@ -56,9 +73,64 @@ DISCORD_GUILD_ID = os.getenv('DISCORD_GUILD_ID')
 # Configurations diverses
 SCENE_BREAK_HOURS = 6  # Seuil de séparation des scènes en heures (changement temporel notable)
 MAX_CHUNK_CHARS = 4000  # Taille approx. des segments de texte pour l'indexation (en caractères)
+EMBED_BATCH_SIZE = min(int(os.getenv('EMBED_BATCH_SIZE', '256')), 2048)  # Nombre max de textes par appel embeddings.create (limite API: 2048)
+EMBED_BATCH_MAX_TOKENS = int(os.getenv('EMBED_BATCH_MAX_TOKENS', '250000'))  # Budget de tokens (estimé) par appel embeddings.create (limite API: 300k)
+OPENAI_MAX_CONCURRENCY = int(os.getenv('OPENAI_MAX_CONCURRENCY', '8'))  # Nombre max de requêtes GPT simultanées pendant /setup
+OPENAI_RPM = int(os.getenv('OPENAI_RPM', '500'))  # Limite de requêtes/minute du modèle de chat
+OPENAI_TPM = int(os.getenv('OPENAI_TPM', '30000'))  # Limite de tokens/minute du modèle de chat
+OPENAI_EMBED_RPM = int(os.getenv('OPENAI_EMBED_RPM', '3000'))  # Limite de requêtes/minute du modèle d'embedding
+OPENAI_EMBED_TPM = int(os.getenv('OPENAI_EMBED_TPM', '1000000'))  # Limite de tokens/minute du modèle d'embedding
+OPENAI_MAX_RETRIES = int(os.getenv('OPENAI_MAX_RETRIES', '6'))  # Nombre de nouvelles tentatives après une erreur 429
+OPENAI_INTERACTIVE_RESERVE = float(os.getenv('OPENAI_INTERACTIVE_RESERVE', '0.1'))  # Part des limites RPM/TPM que les appels de fond (/setup...) laissent libre pour /lore
+OPENAI_INTERACTIVE_WORKERS = int(os.getenv('OPENAI_INTERACTIVE_WORKERS', '4'))  # Threads réservés aux appels OpenAI bloquants de /lore
+OPENAI_BATCH_WORKERS = int(os.getenv('OPENAI_BATCH_WORKERS', '4'))  # Threads des appels OpenAI bloquants de /setup, de l'indexation en continu et des réindexations
+GPT_COMPLETION_TOKENS_ESTIMATE = 500  # Tokens de réponse comptés d'avance dans le budget TPM
+SETUP_CHANNEL_CONCURRENCY = int(os.getenv('SETUP_CHANNEL_CONCURRENCY', '4'))  # Nombre de salons lus en parallèle pendant /setup
+SETUP_CHECKPOINT_SECONDS = int(os.getenv('SETUP_CHECKPOINT_SECONDS', '600'))  # Intervalle des points de reprise de /setup (scènes terminées sauvegardées en segment, 0 = seulement à la fin)
+LIVE_INDEXING = os.getenv('LIVE_INDEXING', '1') == '1'  # Indexer en continu les nouveaux messages RP/INFO (sans attendre /setup)
+LIVE_INDEX_INTERVAL_SECONDS = int(os.getenv('LIVE_INDEX_INTERVAL_SECONDS', '120'))  # Intervalle entre deux lots d'indexation en continu
+LIVE_INDEX_BATCH_SCENES = int(os.getenv('LIVE_INDEX_BATCH_SCENES', '16'))  # Nombre max de scènes/entrées résumées et vectorisées par lot
+LIVE_INDEX_SAVE_SECONDS = int(os.getenv('LIVE_INDEX_SAVE_SECONDS', '900'))  # Délai min entre deux sauvegardes (segments) dues à l'indexation en continu
+LORE_CACHE_DIR = os.getenv('LORE_CACHE_DIR', 'lore_cache')  # Dossier où l'archive de base du serveur LORE_LEGACY_GUILD_ID est extraite (seulement si elle a changé)
+LORE_DB_NAME = 'lore_store.db'  # Base SQLite des scènes, messages et chunks (contenue dans lore_index.zip)
+LORE_SHARDS_DIR = os.getenv('LORE_SHARDS_DIR', 'lore_guilds')  # Dossier des index des autres serveurs (un sous-dossier par serveur)
+LORE_LEGACY_GUILD_ID = os.getenv('LORE_LEGACY_GUILD_ID', DISCORD_GUILD_ID)  # Serveur dont l'index utilise les fichiers d'avant le multi-serveur (lore_index.zip, lore_cache...), chargé au démarrage
+LORE_SHARDS_MAX_MB = int(os.getenv('LORE_SHARDS_MAX_MB', '1024'))  # Mémoire max des index chargés : les moins récemment utilisés sont déchargés au-delà
+LORE_SHARD_LOAD_WAIT_SECONDS = float(os.getenv('LORE_SHARD_LOAD_WAIT_SECONDS', '20'))  # Attente max du chargement d'un index par /lore et /setup avant de demander de réessayer
+LORE_EDIT_DEBOUNCE_SECONDS = int(os.getenv('LORE_EDIT_DEBOUNCE_SECONDS', '60'))  # Attente après la dernière modification d'une scène avant sa réindexation
+LORE_INDEX_TYPE = os.getenv('LORE_INDEX_TYPE', 'auto').lower()  # Type d'index de base : auto, flat, hnsw ou ivf (appliqué à la compaction)
+LORE_ANN_MIN_VECTORS = int(os.getenv('LORE_ANN_MIN_VECTORS', '20000'))  # En mode auto : index exact (flat) en dessous de ce nombre de vecteurs
+LORE_IVF_MIN_VECTORS = int(os.getenv('LORE_IVF_MIN_VECTORS', '1000000'))  # En mode auto : HNSW en dessous, IVF au-delà
+LORE_HNSW_M = int(os.getenv('LORE_HNSW_M', '32'))  # HNSW : nombre de voisins par nœud du graphe
+LORE_HNSW_EF_CONSTRUCTION = int(os.getenv('LORE_HNSW_EF_CONSTRUCTION', '80'))  # HNSW : largeur de recherche à la construction
+LORE_HNSW_EF_SEARCH = int(os.getenv('LORE_HNSW_EF_SEARCH', '64'))  # HNSW : largeur de recherche par requête (rappel vs latence)
+LORE_IVF_NLIST = int(os.getenv('LORE_IVF_NLIST', '0'))  # IVF : nombre de listes (0 = 4 x racine du nombre de vecteurs)
+LORE_IVF_NPROBE = int(os.getenv('LORE_IVF_NPROBE', '16'))  # IVF : nombre de listes visitées par requête (rappel vs latence)
+LORE_MANIFEST_PATH = 'lore_manifest.json'  # Manifeste du serveur LORE_LEGACY_GUILD_ID : archive de base + segments ajoutés depuis (aussi sur Drive)
+LORE_SEGMENTS_DIR = 'lore_segments'  # Dossier local des segments du serveur LORE_LEGACY_GUILD_ID (un par sauvegarde de /setup)
+LORE_COMPACTION_SEGMENTS = int(os.getenv('LORE_COMPACTION_SEGMENTS', '8'))  # Nombre de segments déclenchant la compaction
+EMBED_CACHE_PATH = os.getenv('EMBED_CACHE_PATH', 'embedding_cache.npz')  # Cache disque des embeddings (à côté de lore_index.zip)
+EMBED_CACHE_MAX_MB = int(os.getenv('EMBED_CACHE_MAX_MB', '256'))  # Taille max du cache d'embeddings (éviction LRU au-delà)
+SUMMARY_CACHE_PATH = os.getenv('SUMMARY_CACHE_PATH', 'summary_cache.json')  # Cache disque des résumés de scènes et des résumés partiels des longues scènes
+SUMMARY_CACHE_MAX_ENTRIES = int(os.getenv('SUMMARY_CACHE_MAX_ENTRIES', '20000'))  # Nombre max de résumés en cache (éviction LRU au-delà)
+SUMMARY_DIRECT_MAX_TOKENS = int(os.getenv('SUMMARY_DIRECT_MAX_TOKENS', '6000'))  # Au-delà (estimation), une scène est résumée par parties puis les résumés partiels sont fusionnés
+SUMMARY_PART_CONCURRENCY = int(os.getenv('SUMMARY_PART_CONCURRENCY', '3'))  # Nombre max de parties (ou de fusions) d'une même longue scène résumées simultanément
+ANSWER_CACHE_TTL_SECONDS = int(os.getenv('ANSWER_CACHE_TTL_SECONDS', '86400'))  # Durée de vie d'une réponse /lore en cache
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv('ANSWER_CACHE_MAX_ENTRIES', '500'))  # Nombre max de réponses /lore en cache
+LORE_EMBED_TIMEOUT_SECONDS = float(os.getenv('LORE_EMBED_TIMEOUT_SECONDS', '4'))  # Délai max de l'embedding de la question avant repli lexical
+LORE_HYBRID_CANDIDATES = int(os.getenv('LORE_HYBRID_CANDIDATES', '40'))  # Candidats lexicaux et vectoriels fusionnés par /lore
+LORE_SUMMARY_SCENES = int(os.getenv('LORE_SUMMARY_SCENES', '8'))  # Scènes présélectionnées par /lore d'après leur résumé avant la recherche de chunks (0 = tous les chunks)
+LORE_CONTEXT_TOKENS = int(os.getenv('LORE_CONTEXT_TOKENS', '3000'))  # Budget de tokens des extraits du prompt /lore (modèles sans budget dédié)
+LORE_CONTEXT_TOKENS_BY_MODEL = os.getenv('LORE_CONTEXT_TOKENS_BY_MODEL', 'gpt-4=3000,gpt-4-turbo=8000,gpt-4o=8000,gpt-4o-mini=8000,gpt-3.5-turbo=2500')  # Budget par modèle (modèle=tokens, séparés par des virgules)
+LORE_STREAM_ANSWERS = os.getenv('LORE_STREAM_ANSWERS', '1') == '1'  # Afficher la réponse /lore au fil de sa génération
+LORE_STREAM_EDIT_SECONDS = float(os.getenv('LORE_STREAM_EDIT_SECONDS', '1.2'))  # Délai min entre deux éditions du message pendant la génération (limites Discord)
+LORE_MMR_LAMBDA = float(os.getenv('LORE_MMR_LAMBDA', '0.7'))  # Sélection des extraits : 1 = pertinence seule, plus bas = plus de diversité
+ANSWER_CACHE_SIMILARITY = float(os.getenv('ANSWER_CACHE_SIMILARITY', '0.95'))  # Similarité cosinus min. pour réutiliser une réponse
 
 # Initialiser le client OpenAI
 openai_client = OpenAI(api_key=OPENAI_API_KEY)
+# Client asynchrone (les 429 sont gérés par call_openai_with_backoff, pas par le client)
+openai_async_client = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0)
 
 # Variables pour Google Drive (initialisation lazy)
 drive_service = None
@@ -146,7 +218,171 @@ def get_drive_service():
         logger.error(f"Impossible d'initialiser le service Google Drive - {e}")
 
     return drive_service
-# Petit serveur HTTP de healthcheck pour Render Web (port $PORT)
+
+# Bornes (secondes) des histogrammes de durée des étapes : de l'appel de cache au /setup de plusieurs heures
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 1800.0, 7200.0)
+
+# Métriques du bot au format texte Prometheus (servies sur /metrics) : compteurs et histogrammes mis à jour
+# par les commandes, jauges calculées à la lecture par des fonctions de collecte
+class MetricsRegistry:
+    def __init__(self, buckets=METRICS_LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()  # lu par le thread du serveur HTTP
+        self._meta = {}  # nom -> (type, description)
+        self._counters = {}  # (nom, labels) -> valeur
+        self._histograms = {}  # (nom, labels) -> [compte cumulé par borne..., somme, nombre]
+        self._collectors = []
+
+    def describe(self, name, kind, description):
+        self._meta[name] = (kind, description)
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * len(self.buckets) + [0.0, 0]
+            for position, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[position] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def add_collector(self, collector):
+        # collector() renvoie des (nom, labels, valeur) lus au moment du rendu (jauges, compteurs tenus ailleurs)
+        self._collectors.append(collector)
+
+    @staticmethod
+    def _sample(name, labels, value):
+        if not labels:
+            return f"{name} {value}"
+        text = ",".join('{}="{}"'.format(key, str(label).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                        for key, label in labels)
+        return f"{name}{{{text}}} {value}"
+
+    def render(self):
+        samples = {}
+        with self._lock:
+            for (name, labels), value in self._counters.items():
+                samples.setdefault(name, []).append(self._sample(name, labels, value))
+            for (name, labels), histogram in self._histograms.items():
+                lines = samples.setdefault(name, [])
+                for bound, count in zip(self.buckets, histogram):
+                    lines.append(self._sample(name + "_bucket", labels + (("le", bound),), count))
+                lines.append(self._sample(name + "_bucket", labels + (("le", "+Inf"),), histogram[-1]))
+                lines.append(self._sample(name + "_sum", labels, round(histogram[-2], 6)))
+                lines.append(self._sample(name + "_count", labels, histogram[-1]))
+        for collector in self._collectors:
+            try:
+                for name, labels, value in collector():
+                    samples.setdefault(name, []).append(self._sample(name, tuple(sorted(labels.items())), value))
+            except Exception as e:
+                logger.error(f"Échec de la collecte des métriques: {e}")
+        output = []
+        for name in sorted(samples):
+            kind, description = self._meta.get(name, ("untyped", ""))
+            output.append(f"# HELP {name} {description}")
+            output.append(f"# TYPE {name} {kind}")
+            output.extend(samples[name])
+        return "\n".join(output) + "\n"
+
+metrics = MetricsRegistry()
+metrics.describe("lore_stage_seconds", "histogram", "Durée des étapes des commandes et tâches de fond, en secondes")
+metrics.describe("lore_coalesced_requests_total", "counter", "Requêtes /lore rattachées à une requête identique (exact) ou équivalente (similar) en cours")
+metrics.describe("lore_errors_total", "counter", "Erreurs par commande et par étape")
+metrics.describe("lore_openai_requests_total", "counter", "Appels à l'API OpenAI par type et résultat")
+metrics.describe("lore_openai_tokens_total", "counter", "Tokens consommés auprès d'OpenAI (usage renvoyé par l'API, sinon estimation)")
+metrics.describe("lore_cache_requests_total", "counter", "Consultations des caches de réponses, d'embeddings et de résumés")
+metrics.describe("lore_index_loaded", "gauge", "Index du serveur chargé en mémoire (1) ou non (0)")
+metrics.describe("lore_index_vectors", "gauge", "Vecteurs dans l'index FAISS du serveur")
+metrics.describe("lore_index_scenes", "gauge", "Scènes et entrées INFO indexées pour le serveur")
+metrics.describe("lore_index_memory_bytes", "gauge", "Mémoire estimée de l'index du serveur")
+metrics.describe("lore_live_pending_scenes", "gauge", "Scènes en attente d'indexation en continu")
+metrics.describe("lore_embedding_cache_entries", "gauge", "Embeddings dans le cache disque")
+metrics.describe("lore_process_resident_memory_bytes", "gauge", "Mémoire résidente du processus")
+metrics.describe("lore_scheduler_queue_depth", "gauge", "Appels OpenAI bloquants en attente d'un thread, par groupe")
+metrics.describe("lore_scheduler_running", "gauge", "Appels OpenAI bloquants en cours, par groupe")
+metrics.describe("lore_scheduler_wait_seconds", "histogram", "Attente d'un thread avant un appel OpenAI bloquant, par groupe")
+metrics.describe("lore_ratelimit_waiting", "gauge", "Appels en attente du limiteur de débit OpenAI, par priorité")
+metrics.describe("lore_ratelimit_wait_seconds", "histogram", "Attente du limiteur de débit OpenAI, par priorité")
+
+# Chronométrer une étape d'une commande ; une exception qui la traverse est comptée comme erreur de l'étape
+@contextlib.contextmanager
+def stage_timer(command, stage):
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        metrics.inc("lore_errors_total", command=command, stage=stage)
+        raise
+    finally:
+        metrics.observe("lore_stage_seconds", time.perf_counter() - started, command=command, stage=stage)
+
+# Comptabiliser les tokens d'un appel OpenAI : usage renvoyé par l'API si présent, sinon les estimations fournies
+def count_openai_tokens(kind, usage, prompt_estimate, completion_estimate=0):
+    prompt_tokens = getattr(usage, "prompt_tokens", None)
+    completion_tokens = getattr(usage, "completion_tokens", None)
+    metrics.inc("lore_openai_tokens_total", prompt_tokens if prompt_tokens is not None else prompt_estimate, kind=kind, type="prompt")
+    if kind == "chat":
+        metrics.inc("lore_openai_tokens_total", completion_tokens if completion_tokens is not None else completion_estimate, kind=kind, type="completion")
+
+# Mémoire résidente actuelle du processus (Linux), à défaut le pic mesuré par getrusage
+def process_resident_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+# Jauges et compteurs de cache lus à chaque rendu de /metrics : index de chaque serveur, caches, mémoire du processus
+def collect_state_metrics():
+    samples = []
+    for shard in list(lore_shards.values()):
+        guild = str(shard.guild_id)
+        samples.append(("lore_index_loaded", {"guild": guild}, int(shard.loaded)))
+        samples.append(("lore_index_memory_bytes", {"guild": guild}, shard.memory_bytes()))
+        if shard.loaded:
+            samples.append(("lore_index_vectors", {"guild": guild}, shard.faiss_index.ntotal if shard.faiss_index is not None else 0))
+            samples.append(("lore_index_scenes", {"guild": guild}, len(shard.scenes_data)))
+        samples.append(("lore_live_pending_scenes", {"guild": guild}, len(shard.live_pending)))
+        cache = shard.answer_cache
+        samples.append(("lore_cache_requests_total", {"guild": guild, "cache": "answer", "result": "hit"}, cache.hits))
+        samples.append(("lore_cache_requests_total", {"guild": guild, "cache": "answer", "result": "similar_hit"}, cache.semantic_hits))
+        samples.append(("lore_cache_requests_total", {"guild": guild, "cache": "answer", "result": "miss"}, cache.misses))
+    samples.append(("lore_cache_requests_total", {"cache": "embedding", "result": "hit"}, embedding_cache.hits))
+    samples.append(("lore_cache_requests_total", {"cache": "embedding", "result": "miss"}, embedding_cache.misses))
+    samples.append(("lore_cache_requests_total", {"cache": "summary", "result": "hit"}, summary_cache.hits))
+    samples.append(("lore_cache_requests_total", {"cache": "summary", "result": "miss"}, summary_cache.misses))
+    samples.append(("lore_embedding_cache_entries", {}, len(embedding_cache)))
+    samples.append(("lore_process_resident_memory_bytes", {}, process_resident_bytes()))
+    for pool in work_scheduler.pools:
+        samples.append(("lore_scheduler_queue_depth", {"pool": pool}, work_scheduler.queued[pool]))
+        samples.append(("lore_scheduler_running", {"pool": pool}, work_scheduler.running[pool]))
+    for limiter in (chat_limiter, embed_limiter):
+        for interactive, priority in ((True, "interactive"), (False, "batch")):
+            samples.append(("lore_ratelimit_waiting", {"limiter": limiter.name, "priority": priority}, limiter.waiting[interactive]))
+    return samples
+
+metrics.add_collector(collect_state_metrics)
+
+# Contenu de /readyz : prêt seulement quand l'index chargé au démarrage l'est et le bot connecté,
+# avec l'état de l'index de chaque serveur
+def readiness_status():
+    startup_shard = lore_shards.get(int(LORE_LEGACY_GUILD_ID)) if LORE_LEGACY_GUILD_ID else None
+    shards = {str(shard.guild_id): dict(shard.load_status.as_dict(), memory_mb=round(shard.memory_bytes() / (1024 * 1024), 1))
+              for shard in list(lore_shards.values())}
+    status = {"index": startup_shard.load_status.as_dict() if startup_shard else None, "shards": shards, "discord": bot.is_ready()}
+    status["ready"] = (startup_shard is None or startup_shard.load_status.ready) and status["discord"]
+    return status
+
+# Petit serveur HTTP de healthcheck pour Render Web (port $PORT) : liveness sur / et /livez, readiness sur /readyz,
+# métriques Prometheus sur /metrics
 def start_healthcheck_server():
     try:
         port_str = os.getenv("PORT")
@@ -156,6 +392,24 @@ def start_healthcheck_server():
         from http.server import BaseHTTPRequestHandler, HTTPServer
         class H(BaseHTTPRequestHandler):
             def do_GET(self):
+                # /readyz : état de chargement des index (503 tant que le bot n'est pas prêt)
+                if self.path.split("?")[0] == "/readyz":
+                    status = readiness_status()
+                    body = json.dumps(status).encode("utf-8")
+                    self.send_response(200 if status["ready"] else 503)
+                    self.send_header("Content-Type", "application/json")
+                    self.end_headers()
+                    self.wfile.write(body)
+                    return
+                # /metrics : durées par étape, appels et tokens OpenAI, caches, erreurs, taille des index et mémoire
+                if self.path.split("?")[0] == "/metrics":
+                    body = metrics.render().encode("utf-8")
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                    self.end_headers()
+                    self.wfile.write(body)
+                    return
+                # / , /livez et autres chemins : le processus est vivant
                 self.send_response(200)
                 self.end_headers()
                 self.wfile.write(b"OK")
@@ -168,10 +422,1017 @@ def start_healthcheck_server():
     except Exception as e:
         logger.error(f"Impossible de démarrer le healthcheck HTTP: {e}")
 
-# Structures de données globales
-scenes_data = []        # Liste des scènes (RP) et entrées de lore info
-faiss_index = None      # Index vectoriel FAISS
-index_id_to_scene = []  # Mapping des indices de vecteur vers (scene_id, chunk_text)
+# Stockage SQLite du lore : seules les métadonnées des scènes restent en mémoire,
+# le texte des messages et des chunks est lu à la demande
+class LoreStore:
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS scenes (
+                id INTEGER PRIMARY KEY,
+                channel_id TEXT,
+                type TEXT,
+                title TEXT,
+                location TEXT,
+                date TEXT,
+                participants TEXT,
+                summary TEXT,
+                last_time TEXT,
+                message_count INTEGER,
+                source TEXT
+            );
+            CREATE TABLE IF NOT EXISTS messages (
+                scene_id INTEGER,
+                seq INTEGER,
+                id TEXT,
+                author_name TEXT,
+                author_id TEXT,
+                time TEXT,
+                content TEXT,
+                PRIMARY KEY (scene_id, seq)
+            );
+            CREATE TABLE IF NOT EXISTS chunks (
+                vector_id INTEGER PRIMARY KEY,
+                scene_id INTEGER,
+                chunk_no INTEGER,
+                text TEXT
+            );
+            CREATE TABLE IF NOT EXISTS scene_vectors (
+                scene_id INTEGER PRIMARY KEY,
+                vector BLOB
+            );
+            CREATE INDEX IF NOT EXISTS chunks_scene ON chunks (scene_id);
+            CREATE INDEX IF NOT EXISTS messages_id ON messages (id);
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+        """)
+        # Bases créées avant la colonne source : les scènes existantes sont considérées comme lues par /setup
+        if "source" not in {row[1] for row in self.conn.execute("PRAGMA table_info(scenes)")}:
+            self.conn.execute("ALTER TABLE scenes ADD COLUMN source TEXT")
+            self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def commit(self):
+        self.conn.commit()
+
+    # Vider la base (reconstruction complète de l'index)
+    def reset(self):
+        self.conn.executescript("DELETE FROM scenes; DELETE FROM messages; DELETE FROM chunks; DELETE FROM scene_vectors; DELETE FROM meta;")
+        self.conn.commit()
+
+    def get_meta(self, key, default=None):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        self.conn.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, str(value)))
+
+    # Copie cohérente de la base dans un autre fichier (API de sauvegarde SQLite)
+    def snapshot(self, path):
+        self.conn.commit()
+        dest = sqlite3.connect(path)
+        try:
+            self.conn.backup(dest)
+        finally:
+            dest.close()
+
+    # Enregistrer une scène complète (métadonnées + messages)
+    def add_scene(self, scene):
+        meta = scene_metadata(scene)
+        self.conn.execute(
+            "INSERT OR REPLACE INTO scenes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (meta["id"], meta["channel_id"], meta["type"], meta["title"], meta["location"], meta["date"],
+             json.dumps(meta["participants"], ensure_ascii=False), meta["summary"], meta["last_time"], meta["message_count"], meta["source"])
+        )
+        self.conn.execute("DELETE FROM messages WHERE scene_id = ?", (meta["id"],))
+        self.conn.executemany(
+            "INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(meta["id"], seq, m["id"], m["author"]["name"], m["author"]["id"], m["time"], m["content"])
+             for seq, m in enumerate(scene["messages"])]
+        )
+
+    # Enregistrer les chunks indexés : lignes (vector_id, scene_id, chunk_no, texte)
+    def add_chunks(self, rows):
+        self.conn.executemany("INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?)", rows)
+
+    # Métadonnées de toutes les scènes (sans les messages), par ordre d'ID
+    def load_scene_metadata(self):
+        rows = self.conn.execute(f"SELECT {self.SCENE_COLUMNS} FROM scenes ORDER BY id")
+        return [self._scene_from_row(row) for row in rows]
+
+    # Scène complète (métadonnées + messages), ou None si elle n'existe pas
+    def get_scene(self, scene_id):
+        row = self.conn.execute(f"SELECT {self.SCENE_COLUMNS} FROM scenes WHERE id = ?", (scene_id,)).fetchone()
+        if row is None:
+            return None
+        return dict(self._scene_from_row(row), messages=self.get_messages(scene_id))
+
+    SCENE_COLUMNS = "id, channel_id, type, title, location, date, participants, summary, last_time, message_count, source"
+
+    @staticmethod
+    def _scene_from_row(row):
+        return {
+            "id": row[0], "channel_id": row[1], "type": row[2], "title": row[3], "location": row[4], "date": row[5],
+            "participants": json.loads(row[6]) if row[6] else [], "summary": row[7], "last_time": row[8], "message_count": row[9],
+            "source": row[10] or "setup"
+        }
+
+    # ID des messages d'un salon déjà indexés par l'indexation en continu (ignorés par /setup)
+    def live_message_ids(self, channel_id):
+        return {row[0] for row in self.conn.execute(
+            "SELECT m.id FROM messages m JOIN scenes s ON s.id = m.scene_id WHERE s.channel_id = ? AND s.source = 'live'", (str(channel_id),))}
+
+    # Table ID de vecteur -> (scene_id, n° de chunk)
+    def load_vector_map(self):
+        return {row[0]: (row[1], row[2]) for row in self.conn.execute("SELECT vector_id, scene_id, chunk_no FROM chunks")}
+
+    # Chunks indexés d'une scène : (vector_id, n° de chunk, texte)
+    def get_scene_chunks(self, scene_id):
+        return self.conn.execute("SELECT vector_id, chunk_no, text FROM chunks WHERE scene_id = ? ORDER BY chunk_no", (scene_id,)).fetchall()
+
+    # ID de vecteur des chunks d'un ensemble de scènes
+    def get_chunk_ids(self, scene_ids):
+        scene_ids = [int(i) for i in scene_ids]
+        if not scene_ids:
+            return []
+        placeholders = ",".join("?" * len(scene_ids))
+        return [row[0] for row in self.conn.execute(f"SELECT vector_id FROM chunks WHERE scene_id IN ({placeholders})", scene_ids)]
+
+    # Enregistrer les vecteurs de résumé des scènes : lignes (scene_id, vecteur)
+    def set_scene_vectors(self, rows):
+        self.conn.executemany("INSERT OR REPLACE INTO scene_vectors VALUES (?, ?)",
+                              [(int(scene_id), np.asarray(vector, dtype='float32').tobytes()) for scene_id, vector in rows])
+
+    # Vecteurs de résumé de toutes les scènes : (scene_id, vecteur)
+    def load_scene_vectors(self):
+        return [(row[0], np.frombuffer(row[1], dtype='float32')) for row in self.conn.execute("SELECT scene_id, vector FROM scene_vectors ORDER BY scene_id")]
+
+    def delete_chunks(self, vector_ids):
+        self.conn.executemany("DELETE FROM chunks WHERE vector_id = ?", [(int(i),) for i in vector_ids])
+
+    def delete_scene(self, scene_id):
+        for table, column in (("scenes", "id"), ("messages", "scene_id"), ("chunks", "scene_id"), ("scene_vectors", "scene_id")):
+            self.conn.execute(f"DELETE FROM {table} WHERE {column} = ?", (scene_id,))
+
+    # Scène contenant un message Discord (index message -> scène), ou None
+    def find_message_scene(self, message_id):
+        row = self.conn.execute("SELECT scene_id, content FROM messages WHERE id = ?", (str(message_id),)).fetchone()
+        return (row[0], row[1]) if row else None
+
+    def update_message(self, message_id, content):
+        self.conn.execute("UPDATE messages SET content = ? WHERE id = ?", (content, str(message_id)))
+
+    def delete_message(self, message_id):
+        self.conn.execute("DELETE FROM messages WHERE id = ?", (str(message_id),))
+
+    def iter_chunk_texts(self):
+        return self.conn.execute("SELECT vector_id, text FROM chunks ORDER BY vector_id")
+
+    def get_chunk_text(self, vector_id):
+        row = self.conn.execute("SELECT text FROM chunks WHERE vector_id = ?", (vector_id,)).fetchone()
+        return row[0] if row else None
+
+    def get_messages(self, scene_id):
+        rows = self.conn.execute(
+            "SELECT id, author_name, author_id, time, content FROM messages WHERE scene_id = ? ORDER BY seq", (scene_id,)
+        )
+        return [{"id": row[0], "author": {"name": row[1], "id": row[2]}, "time": row[3], "content": row[4]} for row in rows]
+
+# Métadonnées d'une scène conservées en mémoire (sans le texte des messages ni des chunks)
+def scene_metadata(scene):
+    messages = scene.get("messages") or []
+    return {
+        "id": scene["id"],
+        "channel_id": scene.get("channel_id"),
+        "type": scene["type"],
+        "title": scene.get("title"),
+        "location": scene.get("location"),
+        "date": scene.get("date"),
+        "participants": scene.get("participants") or [],
+        "summary": scene.get("summary"),
+        "last_time": messages[-1]["time"] if messages else scene.get("last_time"),
+        "message_count": len(messages) if messages else scene.get("message_count", 0),
+        "source": scene.get("source") or "setup"  # "setup" (historique lu par /setup) ou "live" (indexation en continu)
+    }
+
+# Index vectoriel du lore : index FAISS de base ouvert en mémoire mappée (lecture seule, vecteurs chargés
+# à la demande ; graphe HNSW en mémoire) + index delta en mémoire (IndexIDMap2) pour les vecteurs ajoutés depuis la dernière compaction.
+# Les ID de vecteur sont stables : un chunk modifié reçoit un nouvel ID et l'ancien est retiré
+# (retrait réel dans le delta ; dans la base en lecture seule, exclusion à la recherche jusqu'à la compaction)
+class LoreVectorIndex:
+    def __init__(self, dimension, base=None, base_ids=None, next_id=None):
+        faiss = __import__('faiss')
+        self.d = dimension
+        self.base = base
+        self.base_ids = base_ids  # ID de vecteur de chaque position de la base (None : position = ID)
+        self.delta = faiss.IndexIDMap2(faiss.IndexFlatIP(dimension))
+        self.base_next_id = next_id if next_id is not None else self.base_size
+        self.next_id = self.base_next_id  # prochain ID de vecteur attribué
+        self.removed = set()     # IDs retirés de la base, exclus des recherches
+        self.removal_log = []    # tous les IDs retirés (rejoués sur la base compactée)
+        self._search_params = None
+
+    # Nombre de vecteurs stockés dans la base (retirés compris)
+    @property
+    def base_size(self):
+        return self.base.ntotal if self.base is not None else 0
+
+    # Nombre de vecteurs actifs
+    @property
+    def ntotal(self):
+        return self.base_size - len(self.removed) + self.delta.ntotal
+
+    # L'index de base n'a plus le type adapté à la taille du corpus : à reconstruire à la prochaine sauvegarde
+    @property
+    def needs_rebuild(self):
+        current = faiss_index_type(self.base) if self.base is not None else "flat"
+        return choose_index_type(self.ntotal) != current
+
+    def add(self, vectors):
+        ids = np.arange(self.next_id, self.next_id + len(vectors), dtype='int64')
+        self.delta.add_with_ids(vectors, ids)
+        self.next_id += len(vectors)
+
+    def remove(self, vector_ids):
+        faiss = __import__('faiss')
+        vector_ids = [int(i) for i in vector_ids]
+        self.removal_log.extend(vector_ids)
+        delta_ids = np.array([i for i in vector_ids if i >= self.base_next_id], dtype='int64')
+        if len(delta_ids):
+            self.delta.remove_ids(faiss.IDSelectorBatch(delta_ids))
+        base_ids = [i for i in vector_ids if i < self.base_next_id and self._base_position(i) is not None]
+        if base_ids:
+            self.removed.update(base_ids)
+            self._search_params = None
+
+    # Position d'un ID dans la base (None s'il n'y figure pas)
+    def _base_position(self, vector_id):
+        if self.base_ids is None:
+            return vector_id if 0 <= vector_id < self.base_size else None
+        position = int(np.searchsorted(self.base_ids, vector_id))
+        return position if position < len(self.base_ids) and self.base_ids[position] == vector_id else None
+
+    # Paramètres de recherche excluant les positions retirées de la base (IDSelector)
+    def _base_search_params(self):
+        if self._search_params is None:
+            faiss = __import__('faiss')
+            positions = np.array(sorted(self._base_position(i) for i in self.removed), dtype='int64')
+            batch = faiss.IDSelectorBatch(positions)
+            selector = faiss.IDSelectorNot(batch)
+            index_type = faiss_index_type(self.base)
+            if index_type == "hnsw":
+                params = faiss.SearchParametersHNSW(sel=selector, efSearch=self.base.hnsw.efSearch)
+            elif index_type == "ivf":
+                params = faiss.SearchParametersIVF(sel=selector, nprobe=self.base.nprobe)
+            else:
+                params = faiss.SearchParameters(sel=selector)
+            self._search_params = (params, selector, batch)  # garder les sélecteurs en vie
+        return self._search_params[0]
+
+    # Recherche dans la base et le delta, résultats (ID de vecteur) fusionnés par similarité décroissante
+    def search(self, query, k):
+        distances, indices = self.delta.search(query, k)
+        if self.base_size:
+            if self.removed:
+                base_distances, positions = self.base.search(query, k, params=self._base_search_params())
+            else:
+                base_distances, positions = self.base.search(query, k)
+            distances = np.hstack([base_distances, distances])
+            indices = np.hstack([self._base_to_ids(positions), indices])
+        return self._top_k(distances, indices, k)
+
+    # Recherche limitée à un ensemble d'ID de vecteur (chunks des scènes présélectionnées) : IDSelector sur le delta
+    # et sur une base exacte ; une base approximative (HNSW, IVF) ne visiterait qu'une partie du sous-ensemble,
+    # ses vecteurs y sont donc comparés directement (le sous-ensemble est petit)
+    def search_subset(self, query, k, vector_ids):
+        faiss = __import__('faiss')
+        vector_ids = np.unique(np.asarray(list(vector_ids), dtype='int64'))
+        parts = []
+        delta_ids = vector_ids[vector_ids >= self.base_next_id]
+        if len(delta_ids):
+            selector = faiss.IDSelectorBatch(delta_ids)
+            parts.append(self.delta.search(query, k, params=faiss.SearchParameters(sel=selector)))
+        positions = [self._base_position(int(i)) for i in vector_ids[vector_ids < self.base_next_id] if int(i) not in self.removed]
+        positions = np.array([p for p in positions if p is not None], dtype='int64')
+        if len(positions):
+            if faiss_index_type(self.base) == "flat":
+                selector = faiss.IDSelectorBatch(positions)
+                base_distances, found = self.base.search(query, k, params=faiss.SearchParameters(sel=selector))
+            else:
+                scores = query @ np.vstack([self.base.reconstruct(int(p)) for p in positions]).T
+                order = np.argsort(-scores, axis=1, kind="stable")[:, :k]
+                base_distances, found = np.take_along_axis(scores, order, axis=1), positions[order]
+                if found.shape[1] < k:  # sous-ensemble plus petit que k : compléter comme faiss (-1)
+                    pad = k - found.shape[1]
+                    base_distances = np.hstack([base_distances, np.full((len(query), pad), -np.inf, dtype='float32')])
+                    found = np.hstack([found, np.full((len(query), pad), -1, dtype='int64')])
+            parts.append((base_distances, self._base_to_ids(found)))
+        if not parts:
+            return np.full((len(query), k), -np.inf, dtype='float32'), np.full((len(query), k), -1, dtype='int64')
+        return self._top_k(np.hstack([d for d, _ in parts]), np.hstack([i for _, i in parts]), k)
+
+    # Positions de la base -> ID de vecteur (-1 conservé)
+    def _base_to_ids(self, positions):
+        if self.base_ids is None:
+            return positions
+        return np.where(positions >= 0, self.base_ids[np.maximum(positions, 0)], -1)
+
+    # Garder les k meilleurs résultats de chaque ligne (emplacements vides en dernier)
+    @staticmethod
+    def _top_k(distances, indices, k):
+        distances = np.where(indices >= 0, distances, -np.inf)
+        order = np.argsort(-distances, axis=1, kind="stable")[:, :k]
+        return np.take_along_axis(distances, order, axis=1), np.take_along_axis(indices, order, axis=1)
+
+    def reconstruct(self, vector_id):
+        if vector_id >= self.base_next_id:
+            return self.delta.reconstruct(vector_id)
+        return self.base.reconstruct(self._base_position(vector_id))
+
+    # Copie figée pour la compaction : la base (immuable) est partagée, le delta et les retraits sont copiés
+    def snapshot(self):
+        copy = LoreVectorIndex(self.d, self.base, self.base_ids, self.base_next_id)
+        for ids, vectors in self._iter_source(self.delta):
+            copy.delta.add_with_ids(vectors, ids)
+        copy.next_id = self.next_id
+        copy.removed = set(self.removed)
+        copy.removal_log = list(self.removal_log)
+        return copy
+
+    # Blocs (IDs, vecteurs) d'un index source, dans l'ordre de stockage
+    def _iter_source(self, source, block=65536):
+        faiss = __import__('faiss')
+        if source is self.delta:
+            ids = faiss.vector_to_array(source.id_map)
+            storage = source.index
+        else:
+            ids = self.base_ids if self.base_ids is not None else None
+            storage = source
+        for start in range(0, storage.ntotal, block):
+            count = min(block, storage.ntotal - start)
+            block_ids = np.asarray(ids[start:start + count]) if ids is not None else np.arange(start, start + count)
+            yield block_ids, storage.reconstruct_n(start, count)
+
+    # Parcourir tous les vecteurs actifs (base puis delta) par blocs (IDs, vecteurs), sans copier toute la base
+    def iter_blocks(self, block=65536):
+        removed = np.array(sorted(self.removed), dtype='int64')
+        for source in (self.base, self.delta):
+            if source is None:
+                continue
+            for ids, vectors in self._iter_source(source, block):
+                if len(removed):
+                    keep = ~np.isin(ids, removed)
+                    ids, vectors = ids[keep], vectors[keep]
+                yield ids, vectors
+
+    # Échantillon aléatoire d'environ `count` vecteurs (entraînement IVF, requêtes du rapport de rappel)
+    def sample(self, count, seed=0):
+        rng = np.random.default_rng(seed)
+        fraction = min(1.0, count / max(self.ntotal, 1))
+        picked = [vectors[rng.random(len(vectors)) < fraction] for _, vectors in self.iter_blocks()]
+        return np.vstack(picked) if picked else np.zeros((0, self.d), dtype='float32')
+
+    # Construire l'index de base (type choisi selon la taille du corpus, entraîné si besoin) sans les vecteurs
+    # retirés, et l'écrire avec la table position -> ID de vecteur
+    def write(self, path, ids_path, index_type=None):
+        faiss = __import__('faiss')
+        index_type = index_type or choose_index_type(self.ntotal)
+        merged = create_faiss_index(index_type, self.d, self.ntotal)
+        if not merged.is_trained:
+            merged.train(self.sample(64 * merged.nlist))
+        all_ids = []
+        for ids, vectors in self.iter_blocks():
+            merged.add(vectors)
+            all_ids.append(ids)
+        if index_type == "ivf":
+            merged.make_direct_map()  # reconstruct() reste possible (cache d'embeddings, compactions suivantes)
+        faiss.write_index(merged, path)
+        with open(ids_path, "wb") as f:
+            np.save(f, np.concatenate(all_ids).astype('int64') if all_ids else np.zeros(0, dtype='int64'))
+        configure_index_search(merged)
+        return merged
+
+# Index des résumés de scènes : un vecteur par scène (résumé GPT, ou premier chunk pour les entrées INFO),
+# beaucoup plus petit que l'index des chunks et entièrement en mémoire ; ID FAISS = ID de scène
+class SceneSummaryIndex:
+    def __init__(self, dimension):
+        faiss = __import__('faiss')
+        self.d = dimension
+        self.index = faiss.IndexIDMap2(faiss.IndexFlatIP(dimension))
+        self.scene_ids = set()
+
+    @property
+    def ntotal(self):
+        return self.index.ntotal
+
+    # Ajouter ou remplacer les vecteurs de résumé de scènes : lignes (scene_id, vecteur)
+    def set(self, rows):
+        if not rows:
+            return
+        self.remove([scene_id for scene_id, _ in rows])
+        ids = np.array([scene_id for scene_id, _ in rows], dtype='int64')
+        self.index.add_with_ids(np.vstack([vector for _, vector in rows]).astype('float32'), ids)
+        self.scene_ids.update(int(i) for i in ids)
+
+    def remove(self, scene_ids):
+        faiss = __import__('faiss')
+        present = np.array([int(i) for i in scene_ids if int(i) in self.scene_ids], dtype='int64')
+        if len(present):
+            self.index.remove_ids(faiss.IDSelectorBatch(present))
+            self.scene_ids.difference_update(int(i) for i in present)
+
+    # ID des k scènes dont le résumé est le plus proche de la question
+    def search(self, query, k):
+        _, ids = self.index.search(query, min(k, self.ntotal))
+        return [int(i) for i in ids[0] if i != -1]
+
+# Ouvrir l'index FAISS de base en mémoire mappée. IO_FLAG_MMAP_IFC mappe les vecteurs des index flat et HNSW
+# (IndexFlatCodes) et les listes inversées des IVF ; le graphe HNSW, lui, reste chargé en mémoire
+# (environ 2 x LORE_HNSW_M entiers par vecteur). IO_FLAG_MMAP seul ne mappe ni les index flat ni les HNSW.
+def open_base_index(path):
+    faiss = __import__('faiss')
+    try:
+        index = faiss.read_index(path, faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY)
+    except Exception as e:
+        # Format ne supportant pas le mmap : repli sur une lecture classique
+        logger.warning(f"Lecture en mémoire mappée impossible ({e}), chargement complet de l'index.")
+        index = faiss.read_index(path)
+    configure_index_search(index)
+    return index
+
+# Choisir le type d'index de base selon la taille du corpus (LORE_INDEX_TYPE=auto) : exact tant que le
+# corpus est petit, puis graphe HNSW, puis IVF pour les très gros corpus
+def choose_index_type(ntotal):
+    if LORE_INDEX_TYPE != "auto":
+        return LORE_INDEX_TYPE
+    if ntotal < LORE_ANN_MIN_VECTORS:
+        return "flat"
+    if ntotal < LORE_IVF_MIN_VECTORS:
+        return "hnsw"
+    return "ivf"
+
+# Nombre de listes IVF : ~4 x racine(n), avec au moins 39 vecteurs d'entraînement par liste
+def ivf_nlist(ntotal):
+    return max(1, min(LORE_IVF_NLIST or int(4 * ntotal ** 0.5), ntotal // 39))
+
+# Fabrique d'index FAISS (produit scalaire sur vecteurs normalisés = similarité cosinus)
+def create_faiss_index(index_type, dimension, ntotal):
+    faiss = __import__('faiss')
+    if index_type == "flat":
+        return faiss.IndexFlatIP(dimension)
+    if index_type == "hnsw":
+        index = faiss.index_factory(dimension, f"HNSW{LORE_HNSW_M},Flat", faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = LORE_HNSW_EF_CONSTRUCTION
+        return index
+    if index_type == "ivf":
+        return faiss.index_factory(dimension, f"IVF{ivf_nlist(ntotal)},Flat", faiss.METRIC_INNER_PRODUCT)
+    raise ValueError(f"Type d'index inconnu : {index_type}")
+
+# Type d'un index FAISS existant (flat, hnsw ou ivf)
+def faiss_index_type(index):
+    faiss = __import__('faiss')
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(index, faiss.IndexIVF):
+        return "ivf"
+    return "flat"
+
+# Appliquer les réglages de recherche (nprobe, efSearch) à un index approximatif
+def configure_index_search(index, nprobe=None, ef_search=None):
+    index_type = faiss_index_type(index)
+    if index_type == "ivf":
+        index.nprobe = min(nprobe or LORE_IVF_NPROBE, index.nlist)
+    elif index_type == "hnsw":
+        index.hnsw.efSearch = ef_search or LORE_HNSW_EF_SEARCH
+
+# Rapport rappel/latence d'un index approximatif comparé à la recherche exacte (flat) sur les mêmes vecteurs,
+# pour plusieurs valeurs du réglage de recherche (nprobe pour IVF, efSearch pour HNSW)
+def index_recall_report(index, k=10, query_count=200, block=65536, noise=0.3):
+    faiss = __import__('faiss')
+    index_type = faiss_index_type(index)
+    if index_type == "flat" or index.ntotal == 0:
+        return None
+    k = min(k, index.ntotal)
+    rng = np.random.default_rng(1)
+    query_ids = np.sort(rng.choice(index.ntotal, min(query_count, index.ntotal), replace=False))
+    # Requêtes perturbées (bruit gaussien puis renormalisation) : un vecteur indexé tel quel est toujours
+    # retrouvé en premier par l'index approché, ce qui surestimerait le rappel
+    queries = np.vstack([index.reconstruct(int(i)) for i in query_ids])
+    queries = queries + rng.normal(scale=noise / np.sqrt(queries.shape[1]), size=queries.shape).astype('float32')
+    queries /= np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+    queries = np.ascontiguousarray(queries, dtype='float32')
+    # Vérité terrain : parcours exhaustif des vecteurs par blocs
+    start_time = time.perf_counter()
+    best_d = np.full((len(queries), 0), -np.inf, dtype='float32')
+    best_i = np.zeros((len(queries), 0), dtype='int64')
+    for start in range(0, index.ntotal, block):
+        vectors = index.reconstruct_n(start, min(block, index.ntotal - start))
+        d, i = faiss.knn(queries, vectors, min(k, len(vectors)), metric=faiss.METRIC_INNER_PRODUCT)
+        best_d = np.hstack([best_d, d])
+        best_i = np.hstack([best_i, i + start])
+        order = np.argsort(-best_d, axis=1)[:, :k]
+        best_d = np.take_along_axis(best_d, order, axis=1)
+        best_i = np.take_along_axis(best_i, order, axis=1)
+    exact_ms = (time.perf_counter() - start_time) * 1000 / len(queries)
+    if index_type == "ivf":
+        knob, values, configured = "nprobe", [1, 4, 16, 64, 256], min(LORE_IVF_NPROBE, index.nlist)
+        values = [v for v in values if v <= index.nlist]
+    else:
+        knob, values, configured = "efSearch", [16, 32, 64, 128, 256], LORE_HNSW_EF_SEARCH
+    settings = []
+    for value in sorted(set(values + [configured])):
+        configure_index_search(index, **({"nprobe": value} if knob == "nprobe" else {"ef_search": value}))
+        start_time = time.perf_counter()
+        _, found = index.search(queries, k)
+        elapsed_ms = (time.perf_counter() - start_time) * 1000 / len(queries)
+        recall = np.mean([len(set(found[q]) & set(best_i[q])) / k for q in range(len(queries))])
+        settings.append({knob: value, "recall": round(float(recall), 4), "ms": round(elapsed_ms, 4)})
+    configure_index_search(index)
+    return {"type": index_type, "ntotal": int(index.ntotal), "k": k, "queries": len(queries),
+            "knob": knob, "configured": configured, "exact_ms": round(exact_ms, 4), "settings": settings}
+
+# Résumé lisible du rapport de rappel (journal, commande d'administration)
+def format_recall_report(report):
+    if not report:
+        return "Index exact (flat) : rappel 100 %."
+    lines = [f"Index {report['type']} ({report['ntotal']} vecteurs), rappel@{report['k']} sur {report['queries']} requêtes, "
+             f"recherche exacte : {report['exact_ms']:.3f} ms/requête"]
+    for setting in report["settings"]:
+        marker = " (réglage actuel)" if setting[report["knob"]] == report["configured"] else ""
+        lines.append(f"  {report['knob']}={setting[report['knob']]} : rappel {setting['recall']:.1%}, {setting['ms']:.3f} ms/requête{marker}")
+    return "\n".join(lines)
+
+# Index du lore d'un serveur Discord : stockage, fichiers (locaux et Drive) et état en mémoire propres à la guilde.
+# L'objet reste en mémoire (tampons d'indexation en continu, modifications reçues) ; l'index lui-même est chargé
+# au premier /lore ou /setup et déchargé quand les index chargés dépassent LORE_SHARDS_MAX_MB
+class LoreShard:
+    def __init__(self, guild_id):
+        self.guild_id = guild_id
+        if LORE_LEGACY_GUILD_ID and str(guild_id) == str(LORE_LEGACY_GUILD_ID):
+            # Index mono-serveur d'avant le partitionnement : mêmes fichiers qu'avant
+            self.cache_dir = LORE_CACHE_DIR
+            self.archive_path = self.archive_name = "lore_index.zip"
+            self.manifest_path = self.manifest_name = LORE_MANIFEST_PATH
+            self.segments_dir = LORE_SEGMENTS_DIR
+            self.segment_prefix = ""
+            self.drive_file_id = DRIVE_FILE_ID
+        else:
+            shard_dir = os.path.join(LORE_SHARDS_DIR, str(guild_id))
+            self.cache_dir = os.path.join(shard_dir, "cache")
+            self.archive_path = os.path.join(shard_dir, "lore_index.zip")
+            self.archive_name = f"lore_index-{guild_id}.zip"  # noms uniques dans le dossier Drive partagé
+            self.manifest_path = os.path.join(shard_dir, "lore_manifest.json")
+            self.manifest_name = f"lore_manifest-{guild_id}.json"
+            self.segments_dir = os.path.join(shard_dir, "segments")
+            self.segment_prefix = f"{guild_id}-"
+            self.drive_file_id = None
+        self.db_path = os.path.join(self.cache_dir, LORE_DB_NAME)  # Base SQLite de travail (extraite puis enrichie par /setup)
+        self.index_path = os.path.join(self.cache_dir, 'index.faiss')  # Index FAISS de base, ouvert en mémoire mappée (lecture seule)
+        self.base_info_path = os.path.join(self.cache_dir, 'base.json')  # Identité de l'archive de base actuellement extraite
+        self.lexical_path = os.path.join(self.cache_dir, 'lexical.npz')  # Index lexical BM25 de la base
+        self.base_ids_path = os.path.join(self.cache_dir, 'base_ids.npy')  # ID de vecteur de chaque position de l'index de base
+        self.load_status = IndexLoadStatus()
+        self.loader = None  # Tâche de chargement en cours
+        self.persist_lock = threading.Lock()  # Sérialise l'écriture des segments, du manifeste et la compaction
+        self.upload_lock = threading.Lock()  # Sérialise les envois vers Google Drive (faits hors de persist_lock)
+        self.indexing_lock = asyncio.Lock()  # /setup, l'indexation en continu et les réindexations ne modifient pas l'index en même temps
+        self.compaction_running = False
+        self.in_use = 0  # Commandes en cours sur l'index (il ne peut pas être déchargé)
+        self.last_used = time.monotonic()
+        self.version = 0  # Incrémenté à chaque modification de l'index (invalide le cache de réponses)
+        self.answer_cache = AnswerCache(ANSWER_CACHE_TTL_SECONDS, ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_SIMILARITY)
+        self.lore_inflight = {}  # (question normalisée, version de l'index) -> {"outcome": future (texte, éphémère), "vector": embedding}
+        # Indexation en continu : conservée quand l'index est déchargé
+        self.live_buffers = {}  # channel_id -> scène RP en cours {"category", "name", "messages", "last_time"}
+        self.live_pending = []  # scènes closes et entrées INFO en attente : (channel_id, type, catégorie, salon, messages)
+        self.live_last_save = time.monotonic()
+        self.pending_changes = {}  # message_id -> contenu modifié (None : supprimé) reçu pendant que l'index était déchargé
+        self.refresh_deadlines = {}  # scene_id -> échéance (time.monotonic) de la réindexation
+        self.lore_store = None  # Stockage SQLite des messages et chunks (LoreStore)
+        self.reset()
+
+    # Vider l'index en mémoire (la base SQLite reste ouverte)
+    def reset(self):
+        self.scenes_data = []        # Métadonnées des scènes (RP) et entrées de lore info
+        self.scenes_by_id = {}       # Index id -> scène pour des recherches en temps constant
+        self.faiss_index = None      # Index vectoriel FAISS
+        self.index_id_to_scene = {}  # Mapping des ID de vecteur vers (scene_id, n° de chunk)
+        self.lexical_index = None    # Index BM25 des chunks (LexicalIndex), mêmes ID que l'index FAISS
+        self.summary_index = None    # Index des résumés de scènes (SceneSummaryIndex), présélection de /lore
+        self.index_manifest = None   # Manifeste de persistance (archive de base + segments)
+        self.pending_delta = {"scenes": [], "chunks": [], "vectors": [], "summaries": [], "removed_vectors": [], "removed_scenes": []}  # Modifications pas encore écrites dans un segment
+
+    # Reconstruire l'index id -> scène à partir de scenes_data
+    def rebuild_scene_lookup(self):
+        self.scenes_by_id = {scene["id"]: scene for scene in self.scenes_data}
+
+    # Ajouter une scène au corpus en mémoire en gardant l'index id -> scène synchronisé
+    def register_scene(self, scene):
+        self.scenes_data.append(scene)
+        self.scenes_by_id[scene["id"]] = scene
+
+    # Retirer une scène supprimée du corpus en mémoire
+    def unregister_scene(self, scene_id):
+        scene = self.scenes_by_id.pop(scene_id, None)
+        if scene is not None:
+            self.scenes_data.remove(scene)
+        if self.summary_index is not None:
+            self.summary_index.remove([scene_id])
+
+    # Retrouver (scène, chunk texte) à partir de l'indice d'un vecteur FAISS (texte lu dans la base)
+    def lookup_vector(self, vector_id):
+        entry = self.index_id_to_scene.get(vector_id)
+        if entry is None:
+            return None, None
+        scene_id, _ = entry
+        return self.scenes_by_id.get(scene_id), self.lore_store.get_chunk_text(vector_id)
+
+    # Signaler une modification de l'index : les réponses en cache ne sont plus valides
+    def bump_version(self):
+        self.version += 1
+        self.answer_cache.clear()
+
+    # Fermer la base SQLite du lore si elle est ouverte
+    def close_store(self):
+        if self.lore_store is not None:
+            self.lore_store.close()
+            self.lore_store = None
+
+    # Ouvrir (ou rouvrir) la base SQLite du lore
+    def open_store(self):
+        self.close_store()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.lore_store = LoreStore(self.db_path)
+        return self.lore_store
+
+    # Index chargé et utilisable par /lore et /setup
+    @property
+    def loaded(self):
+        return self.load_status.done and self.lore_store is not None
+
+    # Mémoire occupée par l'index chargé (estimation : vecteurs, postings BM25, métadonnées)
+    def memory_bytes(self):
+        if not self.loaded:
+            return 0
+        total = len(self.scenes_data) * 1024 + len(self.index_id_to_scene) * 200
+        if self.faiss_index is not None:
+            total += (self.faiss_index.base_size + self.faiss_index.delta.ntotal) * self.faiss_index.d * 4
+            # Graphe HNSW de la base : non mappé, toujours en mémoire
+            if self.faiss_index.base_size and faiss_index_type(self.faiss_index.base) == "hnsw":
+                total += self.faiss_index.base_size * LORE_HNSW_M * 2 * 4
+        if self.lexical_index is not None:
+            total += len(self.lexical_index) * 4 + self.lexical_index.total_length * 8
+        if self.summary_index is not None:
+            total += self.summary_index.ntotal * (self.summary_index.d * 4 + 16)
+        return total
+
+    # L'index peut-il être déchargé ? (aucune commande, indexation, réindexation, compaction ni chargement en cours)
+    def evictable(self):
+        return (self.loaded and self.in_use == 0 and self.loader is None and not self.indexing_lock.locked()
+                and not self.compaction_running and not self.refresh_deadlines)
+
+    # Libérer l'index en mémoire (les modifications doivent avoir été sauvegardées)
+    def unload(self):
+        with self.persist_lock:
+            self.close_store()
+            self.reset()
+            self.load_status.mark_unloaded()
+        logger.info(f"Index du serveur {self.guild_id} déchargé.")
+
+lore_shards = {}  # guild_id -> LoreShard (index chargé ou non)
+
+# Index du lore d'un serveur (créé au premier accès, sans le charger)
+def get_shard(guild_id):
+    shard = lore_shards.get(guild_id)
+    if shard is None:
+        shard = lore_shards[guild_id] = LoreShard(guild_id)
+    return shard
+
+# Présélection hiérarchique : les LORE_SUMMARY_SCENES scènes dont le résumé est le plus proche de la question,
+# None si elle est désactivée ou si des scènes n'ont pas encore de vecteur de résumé (recherche sur tous les chunks)
+def shortlist_scenes(shard, query_vec):
+    summary_index = shard.summary_index
+    if LORE_SUMMARY_SCENES <= 0 or summary_index is None or len(summary_index.scene_ids) < len(shard.scenes_data):
+        return None
+    with stage_timer("lore", "scene_search"):
+        return summary_index.search(query_vec, LORE_SUMMARY_SCENES)
+
+# Fusion des classements vectoriel et lexical (Reciprocal Rank Fusion), renvoie les (ID de vecteur, score)
+# par score décroissant (query_vec None : classement lexical seul). La recherche vectorielle se limite aux chunks
+# des scènes présélectionnées ; la recherche lexicale porte toujours sur tous les chunks
+def hybrid_rank(shard, query_vec, lexical_hits, candidates, rrf_k=60):
+    scores = {}
+    if query_vec is not None and shard.faiss_index is not None:
+        scene_ids = shortlist_scenes(shard, query_vec)
+        with stage_timer("lore", "vector_search"):
+            if scene_ids:
+                _, indices = shard.faiss_index.search_subset(query_vec, candidates, shard.lore_store.get_chunk_ids(scene_ids))
+            else:
+                _, indices = shard.faiss_index.search(query_vec, candidates)
+        for rank, vector_id in enumerate(int(i) for i in indices[0] if i != -1):
+            scores[vector_id] = scores.get(vector_id, 0.0) + 1.0 / (rrf_k + rank + 1)
+    for rank, (vector_id, _) in enumerate(lexical_hits):
+        scores[vector_id] = scores.get(vector_id, 0.0) + 1.0 / (rrf_k + rank + 1)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+# Tokenizer du modèle (None si tiktoken n'est pas installé)
+@functools.lru_cache(maxsize=None)
+def model_encoding(model):
+    if tiktoken is None:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        # Le vocabulaire est téléchargé à la première utilisation : repli sur l'estimation si c'est impossible
+        logger.warning(f"Tokenizer indisponible pour {model} ({e}) : nombre de tokens estimé.")
+        return None
+
+# Nombre de tokens d'un texte pour un modèle (tokenizer réel si disponible, sinon estimation)
+def count_tokens(text, model=OPENAI_MODEL):
+    encoding = model_encoding(model)
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+# Budget de tokens des extraits de contexte /lore pour un modèle (LORE_CONTEXT_TOKENS_BY_MODEL, sinon LORE_CONTEXT_TOKENS)
+def context_token_budget(model=OPENAI_MODEL):
+    for entry in LORE_CONTEXT_TOKENS_BY_MODEL.split(","):
+        name, _, tokens = entry.partition("=")
+        if name.strip() == model and tokens.strip().isdigit():
+            return int(tokens)
+    return LORE_CONTEXT_TOKENS
+
+# Sélection gloutonne MMR (Maximal Marginal Relevance) sous budget de tokens : à chaque étape, le candidat qui
+# tient dans le budget restant et maximise lambda * pertinence - (1 - lambda) * similarité max aux extraits déjà
+# choisis ; renvoie les positions choisies dans l'ordre de sélection
+def select_mmr(relevance, vectors, token_counts, budget, mmr_lambda=LORE_MMR_LAMBDA):
+    relevance = np.asarray(relevance, dtype='float32')
+    token_counts = np.asarray(token_counts)
+    if not len(relevance):
+        return []
+    # Pertinence ramenée sur [0, 1] pour être comparable aux similarités cosinus
+    spread = relevance.max() - relevance.min()
+    relevance = (relevance - relevance.min()) / spread if spread > 0 else np.ones_like(relevance)
+    similarity = vectors @ vectors.T if vectors is not None else np.zeros((len(relevance), len(relevance)), dtype='float32')
+    max_similarity = np.zeros(len(relevance), dtype='float32')
+    available = token_counts <= budget
+    selected = []
+    while available.any():
+        scores = np.where(available, mmr_lambda * relevance - (1 - mmr_lambda) * max_similarity, -np.inf)
+        best = int(np.argmax(scores))
+        selected.append(best)
+        budget -= token_counts[best]
+        max_similarity = np.maximum(max_similarity, similarity[best])
+        available[best] = False
+        available &= token_counts <= budget
+    return selected
+
+# Construire les extraits de contexte /lore à partir des candidats classés (ID de vecteur, score) : extraits
+# pertinents et variés, dans la limite du budget de tokens du modèle
+def pack_lore_context(shard, ranked, model=OPENAI_MODEL):
+    excerpts, relevance, vector_ids = [], [], []
+    transcript_scenes = set()
+    for vector_id, score in ranked:
+        scene, chunk_text = shard.lookup_vector(vector_id)
+        if not scene:
+            continue
+        if chunk_text:
+            excerpt_text = chunk_text
+        elif scene["id"] not in transcript_scenes:
+            # Chunk introuvable : transcription complète de la scène (une seule fois par scène)
+            transcript_scenes.add(scene["id"])
+            excerpt_text = scene_transcript({"messages": shard.lore_store.get_messages(scene["id"])})
+        else:
+            continue
+        # Étiqueter l'extrait pour contexte (scène ou info)
+        label = f"Scène: {scene.get('title', '(sans titre)')}" if scene["type"] == "rp" else f"Info: {scene.get('title', '(sans titre)')}"
+        excerpts.append(f"{label}\n{excerpt_text}")
+        relevance.append(score)
+        vector_ids.append(vector_id)
+    if not excerpts:
+        return []
+    # Vecteurs des candidats pour la diversité (sans eux : sélection par pertinence seule)
+    try:
+        vectors = np.vstack([shard.faiss_index.reconstruct(vector_id) for vector_id in vector_ids]).astype('float32')
+    except Exception as e:
+        logger.warning(f"Vecteurs des extraits indisponibles ({e}) : sélection sans diversité.")
+        vectors = None
+    # Séparateur entre extraits ("\n\n") compté avec chaque extrait
+    token_counts = [count_tokens(excerpt, model) + 1 for excerpt in excerpts]
+    chosen = select_mmr(relevance, vectors, token_counts, context_token_budget(model))
+    return [excerpts[position] for position in chosen]
+
+# Migration unique de l'ancien format (scenes.json complet) vers la base SQLite
+def migrate_legacy_scenes_json(shard, path):
+    logger.info("Ancien format détecté (scenes.json) : migration vers la base SQLite...")
+    with open(path, "r", encoding="utf-8") as f:
+        legacy_scenes = json.load(f)
+    store = shard.open_store()
+    store.reset()
+    vector_id = 0
+    for scene in legacy_scenes:
+        store.add_scene(scene)
+        # Même ordre de vecteurs qu'avant : les chunks de la scène, ou la scène entière
+        texts = scene.get("chunks") or build_scene_chunks(scene)[:1]
+        store.add_chunks([(vector_id + chunk_no, scene["id"], chunk_no, text) for chunk_no, text in enumerate(texts)])
+        vector_id += len(texts)
+    store.commit()
+    logger.info(f"Migration terminée : {len(legacy_scenes)} scènes, {vector_id} chunks.")
+
+# Normaliser une question pour la clé du cache de réponses (casse, ponctuation, espaces)
+def normalize_question(question):
+    text = unicodedata.normalize("NFKC", question).casefold()
+    text = re.sub(r"[^\w\s]", " ", text)
+    return " ".join(text.split())
+
+# Cache des réponses /lore : clé = question normalisée, avec repli sur la similarité des embeddings de question
+class AnswerCache:
+    def __init__(self, ttl, max_entries, threshold):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self._entries = OrderedDict()  # question normalisée -> (vecteur, réponse, horodatage)
+        self._matrix = None            # vecteurs empilés (recalculés après ajout ou suppression)
+        self._matrix_keys = []         # question de chaque ligne de _matrix (l'ordre LRU de _entries change à chaque accès)
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+    def _expire(self):
+        now = time.monotonic()
+        expired = [k for k, (_, _, ts) in self._entries.items() if now - ts > self.ttl]
+        for key in expired:
+            del self._entries[key]
+        if expired:
+            self._matrix = None
+
+    def get(self, key):
+        self._expire()
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def get_similar(self, vector):
+        self._expire()
+        if not self._entries:
+            self.misses += 1
+            return None
+        if self._matrix is None:
+            self._matrix_keys = list(self._entries)
+            self._matrix = np.vstack([self._entries[k][0] for k in self._matrix_keys])
+        keys = self._matrix_keys
+        scores = self._matrix @ np.asarray(vector, dtype='float32')
+        best = int(np.argmax(scores))
+        if scores[best] < self.threshold:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(keys[best])
+        self.semantic_hits += 1
+        return self._entries[keys[best]][1]
+
+    def put(self, key, vector, answer):
+        self._entries[key] = (np.asarray(vector, dtype='float32'), answer, time.monotonic())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        self._matrix = None
+
+    def clear(self):
+        self._entries.clear()
+        self._matrix = None
+
+# Mots vides ignorés par l'index lexical (français et anglais)
+LEXICAL_STOPWORDS = set("""
+au aux avec ce ces dans de des du elle en et eux il ils je la le les leur lui ma mais me meme mes moi mon ne nos notre
+nous on ou par pas pour qu que qui sa se ses son sur ta te tes toi ton tu un une vos votre vous est sont etait ete
+a y c d j l m n s t qu quel quelle quels quelles quoi comment pourquoi quand ou dont cette cet sont fait faire
+the of and to in is are was were be it that this for on with as at by an or from what who where when why how
+""".split())
+
+# Découper un texte en termes pour l'index lexical : casse et accents ignorés, mots vides retirés
+def lexical_tokens(text):
+    text = unicodedata.normalize("NFKD", text.casefold())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return [token for token in re.findall(r"\w+", text) if len(token) > 1 and token not in LEXICAL_STOPWORDS]
+
+# Index inversé BM25 en mémoire sur les mêmes chunks que l'index FAISS (même ID de vecteur) :
+# retrouve les noms propres que la recherche par embeddings rate, sans appel OpenAI
+class LexicalIndex:
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings = {}             # terme -> (IDs de vecteur, fréquences du terme)
+        self.doc_lengths = array('i')  # nombre de termes par ID de vecteur (-1 : chunk retiré)
+        self.total_length = 0
+        self.doc_count = 0
+
+    def __len__(self):
+        return len(self.doc_lengths)
+
+    def add(self, vector_id, text):
+        if vector_id < len(self.doc_lengths):
+            raise ValueError(f"vecteur {vector_id} déjà présent dans l'index lexical")
+        while len(self.doc_lengths) < vector_id:
+            self.doc_lengths.append(-1)
+        tokens = lexical_tokens(text)
+        for term, tf in Counter(tokens).items():
+            ids, tfs = self.postings.setdefault(term, (array('i'), array('i')))
+            ids.append(vector_id)
+            tfs.append(tf)
+        self.doc_lengths.append(len(tokens))
+        self.total_length += len(tokens)
+        self.doc_count += 1
+
+    # Retirer un chunk : ses postings restent jusqu'à la prochaine sauvegarde mais il n'est plus jamais retourné
+    def remove(self, vector_id):
+        if vector_id >= len(self.doc_lengths) or self.doc_lengths[vector_id] < 0:
+            return
+        self.total_length -= self.doc_lengths[vector_id]
+        self.doc_count -= 1
+        self.doc_lengths[vector_id] = -1
+
+    # Meilleurs chunks pour la question : liste de (ID de vecteur, score BM25) par score décroissant
+    def search(self, query, k):
+        if not self.doc_count:
+            return []
+        lengths = np.frombuffer(self.doc_lengths, dtype=np.int32)
+        average_length = self.total_length / self.doc_count
+        scores = np.zeros(len(lengths), dtype='float32')
+        for term in set(lexical_tokens(query)):
+            posting = self.postings.get(term)
+            if posting is None:
+                continue
+            ids = np.frombuffer(posting[0], dtype=np.int32)
+            tfs = np.frombuffer(posting[1], dtype=np.int32).astype('float32')
+            idf = np.log(1 + (self.doc_count - len(ids) + 0.5) / (len(ids) + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * np.maximum(lengths[ids], 0) / average_length)
+            scores[ids] += idf * tfs * (self.k1 + 1) / (tfs + norm)
+        scores[lengths < 0] = 0
+        candidates = np.flatnonzero(scores)
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+        return [(int(i), float(scores[i])) for i in candidates]
+
+    # Sauvegarde compacte (vocabulaire + listes de postings concaténées, sans les chunks retirés)
+    def save(self, path):
+        lengths = np.frombuffer(self.doc_lengths, dtype=np.int32)
+        if (lengths < 0).any():
+            for term, (ids, tfs) in list(self.postings.items()):
+                keep = lengths[np.frombuffer(ids, dtype=np.int32)] >= 0
+                if keep.all():
+                    continue
+                if not keep.any():
+                    del self.postings[term]
+                    continue
+                self.postings[term] = (array('i', np.frombuffer(ids, dtype=np.int32)[keep].tobytes()),
+                                       array('i', np.frombuffer(tfs, dtype=np.int32)[keep].tobytes()))
+        terms = sorted(self.postings)
+        sizes = [len(self.postings[term][0]) for term in terms]
+        offsets = np.concatenate([[0], np.cumsum(sizes, dtype=np.int64)]).astype(np.int64)
+        ids = np.concatenate([np.frombuffer(self.postings[t][0], dtype=np.int32) for t in terms]) if terms else np.zeros(0, np.int32)
+        tfs = np.concatenate([np.frombuffer(self.postings[t][1], dtype=np.int32) for t in terms]) if terms else np.zeros(0, np.int32)
+        vocabulary = np.frombuffer("\n".join(terms).encode("utf-8"), dtype=np.uint8)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, vocabulary=vocabulary, offsets=offsets, ids=ids, tfs=tfs,
+                     doc_lengths=np.frombuffer(self.doc_lengths, dtype=np.int32))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        index = cls()
+        with np.load(path) as data:
+            vocabulary = data["vocabulary"].tobytes().decode("utf-8")
+            terms = vocabulary.split("\n") if vocabulary else []
+            offsets, ids, tfs = data["offsets"], data["ids"].astype(np.int32), data["tfs"].astype(np.int32)
+            for position, term in enumerate(terms):
+                start, end = offsets[position], offsets[position + 1]
+                index.postings[term] = (array('i', ids[start:end].tobytes()), array('i', tfs[start:end].tobytes()))
+            index.doc_lengths = array('i', data["doc_lengths"].astype(np.int32).tobytes())
+        index.total_length = sum(length for length in index.doc_lengths if length > 0)
+        index.doc_count = sum(1 for length in index.doc_lengths if length >= 0)
+        return index
+
+    # Copie figée pour la compaction
+    def snapshot(self):
+        copy = LexicalIndex(self.k1, self.b)
+        copy.postings = {term: (array('i', ids), array('i', tfs)) for term, (ids, tfs) in self.postings.items()}
+        copy.doc_lengths = array('i', self.doc_lengths)
+        copy.total_length = self.total_length
+        copy.doc_count = self.doc_count
+        return copy
 
 # Nettoyer les noms de salons/catégories en supprimant les balises [RP], [HRP], [INFO]
 def clean_name(name: str) -> str:
@@ -184,172 +1445,1483 @@ def clean_name(name: str) -> str:
 # Fonction utilitaire pour obtenir l'embedding d'un texte (via l'API OpenAI)
 def get_embedding(text: str):
     # Appel d'OpenAI API pour générer l'embedding d'un texte
-    result = openai_client.embeddings.create(model=OPENAI_EMBED_MODEL, input=text)
+    try:
+        result = openai_client.embeddings.create(model=OPENAI_EMBED_MODEL, input=text)
+    except Exception:
+        metrics.inc("lore_openai_requests_total", kind="embeddings", outcome="error")
+        raise
+    metrics.inc("lore_openai_requests_total", kind="embeddings", outcome="ok")
+    count_openai_tokens("embeddings", getattr(result, "usage", None), estimate_tokens(text))
     embedding = result.data[0].embedding
     return embedding
 
-# Fonction utilitaire pour poser une question à GPT (OpenAI ChatCompletion)
-def ask_gpt(messages, model=OPENAI_MODEL):
-    # Appel de l'API OpenAI ChatCompletion avec les messages fournis
-    response = openai_client.chat.completions.create(model=model, messages=messages)
+# Fonction utilitaire pour obtenir les embeddings de plusieurs textes en un seul appel API
+def get_embeddings(texts):
+    texts = list(texts)
+    try:
+        result = openai_client.embeddings.create(model=OPENAI_EMBED_MODEL, input=texts)
+    except Exception:
+        metrics.inc("lore_openai_requests_total", kind="embeddings", outcome="error")
+        raise
+    metrics.inc("lore_openai_requests_total", kind="embeddings", outcome="ok")
+    count_openai_tokens("embeddings", getattr(result, "usage", None), sum(estimate_tokens(t) for t in texts))
+    # L'API renvoie chaque embedding avec l'index du texte d'origine
+    return [d.embedding for d in sorted(result.data, key=lambda d: d.index)]
+
+# Estimation grossière du nombre de tokens d'un texte (~4 caractères par token)
+def estimate_tokens(text: str) -> int:
+    return len(text) // 4 + 1
+
+# Découper une liste de textes en lots (listes de positions) respectant les limites d'items et de tokens
+def iter_embedding_batches(texts, batch_size=EMBED_BATCH_SIZE, max_tokens=EMBED_BATCH_MAX_TOKENS):
+    batch = []
+    batch_tokens = 0
+    for pos, text in enumerate(texts):
+        tokens = estimate_tokens(text)
+        if batch and (len(batch) >= batch_size or batch_tokens + tokens > max_tokens):
+            yield batch
+            batch = []
+            batch_tokens = 0
+        batch.append(pos)
+        batch_tokens += tokens
+    if batch:
+        yield batch
+
+# Normaliser une matrice de vecteurs ligne par ligne (pour l'IP index -> cos similarity)
+def normalize_vectors(vectors):
+    matrix = np.asarray(vectors, dtype='float32')
+    if matrix.ndim == 1:
+        matrix = matrix.reshape(1, -1)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+# Cache des embeddings indexé par (modèle d'embedding, hash du texte), persisté en binaire compact (.npz)
+class EmbeddingCache:
+    def __init__(self, path, max_mb):
+        self.path = path
+        self.max_bytes = max_mb * 1024 * 1024
+        self._entries = OrderedDict()  # clé sha256 -> vecteur float32 normalisé (ordre LRU, plus ancien en premier)
+        self._dirty = False
+        self.loaded = False
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(text, model=OPENAI_EMBED_MODEL):
+        return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).digest()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, text):
+        return self.key(text) in self._entries
+
+    def get(self, text, model=OPENAI_EMBED_MODEL):
+        key = self.key(text, model)
+        vector = self._entries.get(key)
+        if vector is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return vector
+
+    def put(self, text, vector, model=OPENAI_EMBED_MODEL):
+        key = self.key(text, model)
+        self._entries[key] = np.asarray(vector, dtype='float32')
+        self._entries.move_to_end(key)
+        self._dirty = True
+        self._evict()
+
+    def _evict(self):
+        if not self._entries:
+            return
+        entry_bytes = next(iter(self._entries.values())).nbytes + 32
+        while self._entries and len(self._entries) * entry_bytes > self.max_bytes:
+            self._entries.popitem(last=False)
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return False
+        try:
+            with np.load(self.path) as data:
+                keys = data["keys"]
+                vectors = data["vectors"]
+            self._entries = OrderedDict((bytes(k), v) for k, v in zip(keys, vectors))
+            self._dirty = False
+            self.loaded = True
+            logger.info(f"Cache d'embeddings chargé: {len(self._entries)} entrées.")
+            return True
+        except Exception as e:
+            logger.error(f"Cache d'embeddings illisible, il sera reconstruit: {e}")
+            self._entries = OrderedDict()
+            return False
+
+    def save(self):
+        if not self._dirty or not self._entries:
+            return
+        # Copie prise d'un bloc : la sauvegarde tourne dans un thread pendant que la boucle d'événements lit et
+        # complète le cache (une entrée ajoutée pendant l'écriture le laisse à sauvegarder)
+        self._dirty = False
+        entries = list(self._entries.items())
+        # Un seul tableau par fichier : on ne garde que les vecteurs de la dimension la plus récente
+        dim = entries[-1][1].shape[0]
+        items = [(k, v) for k, v in entries if v.shape[0] == dim]
+        keys = np.frombuffer(b"".join(k for k, _ in items), dtype=np.uint8).reshape(-1, 32)
+        vectors = np.vstack([v for _, v in items])
+        # Écriture atomique (fichier temporaire puis remplacement)
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                np.savez(f, keys=keys, vectors=vectors)
+            os.replace(tmp_path, self.path)
+        except Exception:
+            self._dirty = True
+            raise
+        logger.info(f"Cache d'embeddings sauvegardé: {len(items)} entrées.")
+
+    def stats_line(self):
+        return f"{self.hits} hit(s) / {self.misses} miss(es), {len(self._entries)} entrées"
+
+embedding_cache = EmbeddingCache(EMBED_CACHE_PATH, EMBED_CACHE_MAX_MB)
+
+# Cache disque des résumés, indexé par le texte résumé : résumés partiels (une entrée par partie de scène, une scène
+# qui s'allonge ne fait résumer que ses nouvelles parties) et résumés de scènes entières (un /setup interrompu
+# ne repaie pas ceux des scènes qu'il n'avait pas encore intégrées)
+class SummaryCache:
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # clé sha256 (hex) -> résumé (ordre LRU, plus ancien en premier)
+        self._dirty = False
+        self.loaded = False
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(text, model=OPENAI_MODEL):
+        return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, text, model=OPENAI_MODEL):
+        key = self.key(text, model)
+        summary = self._entries.get(key)
+        if summary is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return summary
+
+    def put(self, text, summary, model=OPENAI_MODEL):
+        key = self.key(text, model)
+        self._entries[key] = summary
+        self._entries.move_to_end(key)
+        self._dirty = True
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return False
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self._entries = OrderedDict(json.load(f))
+            self._dirty = False
+            self.loaded = True
+            logger.info(f"Cache des résumés chargé: {len(self._entries)} entrées.")
+            return True
+        except Exception as e:
+            logger.error(f"Cache des résumés illisible, il sera reconstruit: {e}")
+            self._entries = OrderedDict()
+            return False
+
+    def save(self):
+        if not self._dirty:
+            return
+        # Copie prise d'un bloc (sauvegarde dans un thread, cache modifié en même temps par la boucle d'événements)
+        self._dirty = False
+        entries = list(self._entries.items())
+        # Écriture atomique (fichier temporaire puis remplacement)
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(entries, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except Exception:
+            self._dirty = True
+            raise
+        logger.info(f"Cache des résumés sauvegardé: {len(entries)} entrées.")
+
+summary_cache = SummaryCache(SUMMARY_CACHE_PATH, SUMMARY_CACHE_MAX_ENTRIES)
+
+# Obtenir l'embedding normalisé d'un texte isolé (question /lore) en passant par le cache (priorité interactive)
+async def get_cached_embedding(text):
+    vector = embedding_cache.get(text)
+    if vector is None:
+        await embed_limiter.acquire(estimate_tokens(text), interactive=True)
+        embedding = await work_scheduler.run("interactive", get_embedding, text)
+        vector = normalize_vectors(embedding)[0]
+        embedding_cache.put(text, vector)
+    return vector
+
+# Calculer les embeddings d'une liste de textes par lots, renvoie (matrice normalisée, positions réussies, stats)
+async def embed_texts(texts, batch_size=EMBED_BATCH_SIZE, progress_cb=None):
+    vectors = [None] * len(texts)
+    # Servir depuis le cache les textes déjà embeddés, et ne demander qu'une fois chaque texte manquant
+    missing = {}
+    for pos, text in enumerate(texts):
+        cached = embedding_cache.get(text)
+        if cached is not None:
+            vectors[pos] = cached
+        else:
+            missing.setdefault(text, []).append(pos)
+    missing_texts = list(missing)
+    batches = list(iter_embedding_batches(missing_texts, batch_size=batch_size))
+    stats = {"texts": len(texts), "cached": len(texts) - sum(len(p) for p in missing.values()),
+             "batches": len(batches), "failed": 0, "tokens": 0, "seconds": 0.0}
+    start = time.perf_counter()
+    for batch_no, batch in enumerate(batches, start=1):
+        batch_texts = [missing_texts[i] for i in batch]
+        await embed_limiter.acquire(sum(estimate_tokens(t) for t in batch_texts))
+        try:
+            embeddings = await work_scheduler.run("batch", get_embeddings, batch_texts)
+        except Exception as e:
+            # Un lot en échec est ignoré (ses chunks ne seront pas indexés), comme auparavant pour un chunk isolé
+            logger.error(f"Erreur lors de l'obtention des embeddings (lot {batch_no}/{len(batches)}): {e}")
+            stats["failed"] += len(batch)
+            continue
+        for text, vector in zip(batch_texts, normalize_vectors(embeddings)):
+            embedding_cache.put(text, vector)
+            for pos in missing[text]:
+                vectors[pos] = vector
+        stats["tokens"] += sum(estimate_tokens(t) for t in batch_texts)
+        if progress_cb:
+            await progress_cb(batch_no, len(batches))
+    stats["seconds"] = time.perf_counter() - start
+    ok_positions = [pos for pos, vector in enumerate(vectors) if vector is not None]
+    matrix = np.vstack([vectors[pos] for pos in ok_positions]) if ok_positions else np.zeros((0, 0), dtype='float32')
+    return matrix, ok_positions, stats
+
+# Découper un texte long en segments d'au plus MAX_CHUNK_CHARS caractères (en coupant aux sauts de ligne)
+def split_text_chunks(text, max_chars=MAX_CHUNK_CHARS):
+    chunks = []
+    current_chunk = ""
+    for line in text.splitlines():
+        if len(current_chunk) + len(line) + 1 <= max_chars:
+            current_chunk += line + "\n"
+        else:
+            if current_chunk:
+                chunks.append(current_chunk.strip())
+            current_chunk = line + "\n"
+    if current_chunk:
+        chunks.append(current_chunk.strip())
+    return chunks
+
+# Construire la transcription texte d'une scène (un message par ligne)
+def scene_transcript(scene):
+    return "\n".join(f'{m["author"]["name"]}: {m["content"]}' for m in scene["messages"])
+
+# Construire la liste des textes à indexer pour une scène/entrée
+def build_scene_chunks(scene):
+    if scene["type"] == "rp":
+        # Découper la transcription complète de la scène en morceaux de taille raisonnable
+        return split_text_chunks(scene_transcript(scene))
+    # Entrée de lore info : utiliser le contenu du message (scinder si très long)
+    info_text = scene["messages"][0]["content"]
+    if len(info_text) > MAX_CHUNK_CHARS:
+        return split_text_chunks(info_text)
+    return [info_text]
+
+# Construire le prompt de résumé narratif d'une scène RP
+def build_summary_prompt(scene, transcript_text=None):
+    if transcript_text is None:
+        transcript_text = scene_transcript(scene)
+    return [
+        {"role": "user", "content": f"Voici une scène de jeu de rôle.\n\n{transcript_text}\n\nFais un résumé narratif de cette scène en français en décrivant les événements importants et les personnages présents. Sois concis."}
+    ]
+
+# Prompt de résumé d'une partie d'une longue scène RP (sans son numéro : le résumé en cache reste valable
+# quand la scène s'allonge)
+def build_part_summary_prompt(part_text):
+    return [
+        {"role": "user", "content": f"Voici un extrait d'une longue scène de jeu de rôle.\n\n{part_text}\n\nFais un résumé narratif de cet extrait en français en décrivant les événements importants et les personnages présents. Sois concis."}
+    ]
+
+# Prompt de fusion de résumés partiels successifs en un seul résumé
+def build_merge_summary_prompt(partials):
+    parts_text = "\n\n".join(f"Partie {part_no} : {partial}" for part_no, partial in enumerate(partials, start=1))
+    return [
+        {"role": "user", "content": f"Voici les résumés successifs des parties d'une même scène de jeu de rôle, dans l'ordre chronologique.\n\n{parts_text}\n\nFais un résumé narratif de l'ensemble de la scène en français en décrivant les événements importants et les personnages présents. Sois concis."}
+    ]
+
+# Résumer une partie de scène, en passant par le cache des résumés partiels
+async def summarize_scene_part(part_text):
+    summary = summary_cache.get(part_text)
+    if summary is None:
+        summary = await ask_gpt_async(build_part_summary_prompt(part_text), OPENAI_MODEL)
+        if summary:
+            summary_cache.put(part_text, summary)
+    return summary
+
+# Fusionner un groupe de résumés partiels (un groupe d'un seul résumé est gardé tel quel)
+async def merge_summary_group(group):
+    if len(group) == 1:
+        return group[0]
+    return await ask_gpt_async(build_merge_summary_prompt(group), OPENAI_MODEL)
+
+# Fusionner des résumés partiels : par groupes tenant dans SUMMARY_DIRECT_MAX_TOKENS (au moins deux par groupe),
+# niveau après niveau jusqu'à un seul résumé (groupes d'un même niveau fusionnés en parallèle, dans la limite du
+# sémaphore de la scène)
+async def merge_summaries(partials, semaphore=None):
+    semaphore = semaphore or asyncio.Semaphore(SUMMARY_PART_CONCURRENCY)
+
+    async def merge_group(group):
+        async with semaphore:
+            return await merge_summary_group(group)
+
+    while len(partials) > 1:
+        groups = [[]]
+        group_tokens = 0
+        for partial in partials:
+            tokens = estimate_tokens(partial)
+            if len(groups[-1]) >= 2 and group_tokens + tokens > SUMMARY_DIRECT_MAX_TOKENS:
+                groups.append([])
+                group_tokens = 0
+            groups[-1].append(partial)
+            group_tokens += tokens
+        merged = await asyncio.gather(*(merge_group(group) for group in groups))
+        partials = [summary for summary in merged if summary]
+    return partials[0] if partials else None
+
+# Résumé hiérarchique d'une transcription trop longue pour un seul prompt : les parties (chunks de
+# MAX_CHUNK_CHARS) sont résumées puis leurs résumés fusionnés (une partie en échec est ignorée).
+# Au plus SUMMARY_PART_CONCURRENCY appels simultanés par scène : l'appelant n'occupe qu'une place du sémaphore du
+# pipeline (OPENAI_MAX_CONCURRENCY), une scène démesurée ne doit pas lancer une requête par partie en même temps
+async def summarize_long_transcript(transcript_text):
+    parts = split_text_chunks(transcript_text)
+    semaphore = asyncio.Semaphore(SUMMARY_PART_CONCURRENCY)
+
+    async def summarize_part(part_no, part):
+        async with semaphore:
+            try:
+                return await summarize_scene_part(part)
+            except Exception as e:
+                logger.error(f"Erreur lors du résumé de la partie {part_no}/{len(parts)} d'une scène: {e}")
+                return None
+
+    results = await asyncio.gather(*(summarize_part(part_no, part) for part_no, part in enumerate(parts, start=1)))
+    partials = [result for result in results if result]
+    logger.info(f"Scène longue résumée par parties : {len(partials)}/{len(parts)} partie(s) résumée(s).")
+    return await merge_summaries(partials, semaphore)
+
+# Générer le résumé (et le titre) d'une scène RP : en un seul prompt, ou par parties si la scène est trop longue
+async def summarize_scene(scene):
+    transcript_text = scene_transcript(scene)
+    try:
+        if estimate_tokens(transcript_text) > SUMMARY_DIRECT_MAX_TOKENS:
+            summary = await summarize_long_transcript(transcript_text)
+        else:
+            # Résumé déjà payé (scène lue par un /setup interrompu avant d'avoir été intégrée à l'index)
+            summary = summary_cache.get(transcript_text)
+            if summary is None:
+                try:
+                    summary = await ask_gpt_async(build_summary_prompt(scene, transcript_text), OPENAI_MODEL)
+                    if summary:
+                        summary_cache.put(transcript_text, summary)
+                except BadRequestError as e:
+                    # Transcription sous-estimée mais trop longue pour le modèle : résumé par parties
+                    if getattr(e, "code", None) != "context_length_exceeded":
+                        raise
+                    summary = await summarize_long_transcript(transcript_text)
+    except Exception as e:
+        summary = None
+        logger.error(f"Erreur lors de la génération du résumé: {e}")
+    scene["summary"] = summary if summary else ""
+    # Générer un titre à partir du résumé (ou à défaut, du nom du lieu)
+    scene["title"] = generate_scene_title(scene, default=clean_name(scene["location"]))
+
+# Pipeline d'ingestion de /setup : chaque scène reçue est aussitôt résumée (requêtes simultanées bornées)
+# et découpée en chunks ; les chunks, puis les résumés, sont embeddés par lots dès qu'un lot est plein.
+# Le vecteur de résumé de chaque scène est placé dans scene["summary_vector"] (premier chunk à défaut de résumé).
+# Avec on_ready, les scènes terminées lui sont remises (avec leurs chunks et vecteurs) dans l'ordre des clés d'ordre,
+# puis oubliées : seules les scènes en cours (ou en attente d'une scène précédente) restent en mémoire
+class IngestionPipeline:
+    def __init__(self, progress_cb=None, max_concurrency=OPENAI_MAX_CONCURRENCY, batch_size=EMBED_BATCH_SIZE, command="setup", on_ready=None, groups=()):
+        self.progress_cb = progress_cb
+        self.on_ready = on_ready  # on_ready(scènes, chunks indexés, vecteurs), appelé dès que des scènes sont terminées
+        self._open_groups = set(groups)  # groupes (salons) pouvant encore recevoir des scènes, fermés par close_group
+        self.command = command  # label des métriques de durée (setup, live)
+        self.batch_size = batch_size
+        self.scene_count = 0  # scènes reçues
+        self._scenes = {}  # position d'arrivée -> scène pas encore remise
+        self._order_keys = {}  # position -> clé d'ordre final de la scène (ordre d'arrivée par défaut)
+        self.summaries_total = 0
+        self.summaries_done = 0
+        self.chunks_total = 0
+        self.chunks_embedded = 0
+        self.embed_stats = {"texts": 0, "cached": 0, "batches": 0, "failed": 0, "tokens": 0, "seconds": 0.0}
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._max_pending = max_concurrency * 4
+        self._summary_tasks = set()
+        self._embed_tasks = []
+        self._pending_chunks = []  # (position, chunk texte, n° de chunk) en attente d'un lot d'embedding
+        self._pending_summaries = []  # positions des scènes résumées dont le résumé attend un lot d'embedding
+        self._summary_embed_tasks = []
+        self._chunk_results = {}  # position -> [(n° de chunk, texte, vecteur)] une fois ses chunks vectorisés
+        self._summarized = set()  # positions des scènes dont le résumé (et son vecteur) est terminé
+        self._start = time.perf_counter()
+
+    async def submit(self, scene, order_key=None):
+        pos = self.scene_count
+        self.scene_count += 1
+        self._scenes[pos] = scene
+        self._order_keys[pos] = order_key if order_key is not None else (pos,)
+        if scene["type"] == "rp":
+            self.summaries_total += 1
+            task = asyncio.create_task(self._summarize(pos))
+            self._summary_tasks.add(task)
+            task.add_done_callback(self._summary_tasks.discard)
+            # Contre-pression : ne pas lire l'historique trop loin devant les résumés
+            while len(self._summary_tasks) >= self._max_pending:
+                await asyncio.wait(set(self._summary_tasks), return_when=asyncio.FIRST_COMPLETED)
+        else:
+            self._summarized.add(pos)
+        # Créer les chunks de texte à indexer pour cette scène/entrée
+        chunks = build_scene_chunks(scene)
+        if not chunks:
+            self._chunk_results[pos] = []
+        self._pending_chunks.extend((pos, text, chunk_no) for chunk_no, text in enumerate(chunks))
+        self.chunks_total += len(chunks)
+        if len(self._pending_chunks) >= self.batch_size:
+            self._flush_chunks()
+        self._release()
+        await self._report()
+
+    def _flush_chunks(self):
+        if not self._pending_chunks:
+            return
+        batch, self._pending_chunks = self._pending_chunks, []
+        self._embed_tasks = [task for task in self._embed_tasks if not task.done() or task.cancelled() or task.exception()]
+        self._embed_tasks.append(asyncio.create_task(self._embed(batch)))
+
+    def _flush_summaries(self):
+        if not self._pending_summaries:
+            return
+        positions, self._pending_summaries = self._pending_summaries, []
+        self._summary_embed_tasks = [task for task in self._summary_embed_tasks if not task.done() or task.cancelled() or task.exception()]
+        self._summary_embed_tasks.append(asyncio.create_task(self._embed_summaries(positions)))
+
+    async def _summarize(self, pos):
+        scene = self._scenes[pos]
+        async with self._semaphore:
+            with stage_timer(self.command, "summarize"):
+                await summarize_scene(scene)
+        self.summaries_done += 1
+        if scene["summary"]:
+            self._pending_summaries.append(pos)
+            if len(self._pending_summaries) >= self.batch_size:
+                self._flush_summaries()
+        else:
+            self._summarized.add(pos)
+            self._release()
+        await self._report()
+
+    async def _embed(self, batch):
+        with stage_timer(self.command, "embed"):
+            matrix, ok_positions, stats = await embed_texts([text for _, text, _ in batch], batch_size=self.batch_size)
+        if stats["failed"]:
+            metrics.inc("lore_errors_total", stats["failed"], command=self.command, stage="embed")
+        for key in ("texts", "cached", "batches", "failed", "tokens"):
+            self.embed_stats[key] += stats[key]
+        self.chunks_embedded += len(ok_positions)
+        # Les chunks en échec sont ignorés : la scène est indexée avec les autres
+        for pos, _, _ in batch:
+            self._chunk_results.setdefault(pos, [])
+        for row, batch_pos in enumerate(ok_positions):
+            pos, text, chunk_no = batch[batch_pos]
+            self._chunk_results[pos].append((chunk_no, text, matrix[row]))
+        self._release()
+        await self._report()
+
+    async def _embed_summaries(self, positions):
+        with stage_timer(self.command, "embed_summaries"):
+            matrix, ok_positions, stats = await embed_texts([self._scenes[pos]["summary"] for pos in positions], batch_size=self.batch_size)
+        if stats["failed"]:
+            metrics.inc("lore_errors_total", stats["failed"], command=self.command, stage="embed_summaries")
+        for row, batch_pos in enumerate(ok_positions):
+            self._scenes[positions[batch_pos]]["summary_vector"] = matrix[row]
+        self._summarized.update(positions)
+        self._release()
+
+    async def _report(self):
+        if self.progress_cb:
+            await self.progress_cb(self)
+
+    # Plus aucune scène ne sera soumise pour ce groupe (salon entièrement lu)
+    def close_group(self, group):
+        self._open_groups.discard(group)
+        self._release()
+
+    # Remettre à on_ready les scènes terminées (résumé et chunks vectorisés) dans l'ordre global des clés d'ordre :
+    # seulement la suite des premières scènes non encore remises, et jamais au-delà d'un groupe (clé d'ordre sans son
+    # dernier élément, soit le salon) encore ouvert. Les IDs de scène et de vecteur restent ainsi attribués dans le
+    # même ordre quel que soit l'ordre de fin des résumés, et une reprise de /setup après la dernière scène intégrée
+    # d'un salon n'en saute aucune
+    def _release(self):
+        if self.on_ready is None:
+            return
+        positions = []
+        for pos in sorted(self._scenes, key=self._order_keys.__getitem__):
+            group = self._order_keys[pos][:-1]
+            if any(open_group < group for open_group in self._open_groups):
+                break
+            if pos not in self._chunk_results or pos not in self._summarized:
+                break
+            positions.append(pos)
+        if positions:
+            self.on_ready(*self._collect(positions))
+
+    # Envoyer les lots incomplets et attendre les embeddings en cours (point de reprise de /setup) : les scènes
+    # déjà résumées sont remises sans attendre qu'un lot se remplisse
+    async def flush(self):
+        self._flush_chunks()
+        self._flush_summaries()
+        await asyncio.gather(*self._embed_tasks, *self._summary_embed_tasks)
+
+    # Attendre la fin de tous les résumés et embeddings : renvoie les scènes pas encore remises à on_ready
+    # (toutes sans on_ready)
+    async def finish(self):
+        self._flush_chunks()
+        if self._summary_tasks:
+            await asyncio.gather(*list(self._summary_tasks))
+        self._flush_summaries()
+        await asyncio.gather(*self._summary_embed_tasks)
+        await asyncio.gather(*self._embed_tasks)
+        self.embed_stats["seconds"] = time.perf_counter() - self._start
+        return self._collect(list(self._scenes))
+
+    # (scènes, chunks indexés (scène, texte, n°), matrice des vecteurs) des positions données, triés selon les clés
+    # d'ordre quel que soit l'ordre d'arrivée des scènes ; le pipeline ne garde plus de référence à ces scènes
+    def _collect(self, positions):
+        positions = sorted(positions, key=self._order_keys.__getitem__)
+        scenes = []
+        indexed_chunks = []
+        rows = []
+        for pos in positions:
+            scene = self._scenes.pop(pos)
+            del self._order_keys[pos]
+            self._summarized.discard(pos)
+            scenes.append(scene)
+            for chunk_no, text, vector in sorted(self._chunk_results.pop(pos, []), key=lambda r: r[0]):
+                indexed_chunks.append((scene, text, chunk_no))
+                rows.append(vector)
+                # Entrées INFO et scènes sans résumé : le premier chunk représente la scène dans l'index des résumés
+                if chunk_no == 0 and scene.get("summary_vector") is None:
+                    scene["summary_vector"] = vector
+        if not indexed_chunks:
+            return scenes, [], np.zeros((0, 0), dtype='float32')
+        return scenes, indexed_chunks, np.vstack(rows)
+
+# Limiteur de débit "token bucket" (requêtes/minute + tokens/minute) partagé par tous les appels vers un modèle OpenAI.
+# Deux priorités : un appel interactif (/lore) passe toujours avant les appels de fond (/setup, indexation en continu),
+# qui laissent en outre une réserve du budget (OPENAI_INTERACTIVE_RESERVE) pour qu'une question soit servie sans attendre
+class TokenBucketLimiter:
+    def __init__(self, rpm, tpm, name, reserve=OPENAI_INTERACTIVE_RESERVE):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.name = name
+        self.reserve = reserve
+        self._requests = float(rpm)
+        self._tokens = float(tpm)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._locks = {True: asyncio.Lock(), False: asyncio.Lock()}  # ordre d'arrivée au sein de chaque priorité
+        self.waiting = {True: 0, False: 0}  # appels en attente (interactifs, de fond)
+        self.wait_times = {True: deque(maxlen=500), False: deque(maxlen=500)}  # dernières attentes (secondes)
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        self._requests = min(float(self.rpm), self._requests + elapsed * self.rpm / 60.0)
+        self._tokens = min(float(self.tpm), self._tokens + elapsed * self.tpm / 60.0)
+
+    async def acquire(self, tokens=1, interactive=False):
+        # Réserve laissée aux appels interactifs (jamais le seau entier)
+        reserve_requests = 0.0 if interactive else min(self.reserve * self.rpm, self.rpm - 1)
+        reserve_tokens = 0.0 if interactive else self.reserve * self.tpm
+        # Une requête plus grosse que le seau entier ne doit pas bloquer indéfiniment
+        tokens = min(tokens, self.tpm - reserve_tokens)
+        started = time.monotonic()
+        self.waiting[interactive] += 1
+        try:
+            # Le verrou sert les appelants de même priorité dans l'ordre d'arrivée
+            async with self._locks[interactive]:
+                while True:
+                    self._refill()
+                    now = time.monotonic()
+                    if now < self._blocked_until:
+                        await asyncio.sleep(self._blocked_until - now)
+                        continue
+                    # Priorité stricte : un appel de fond attend tant qu'un appel interactif attend
+                    if not interactive and self.waiting[True]:
+                        await asyncio.sleep(0.05)
+                        continue
+                    if self._requests >= 1 + reserve_requests and self._tokens >= tokens + reserve_tokens:
+                        self._requests -= 1
+                        self._tokens -= tokens
+                        return
+                    wait = max((1 + reserve_requests - self._requests) * 60.0 / self.rpm,
+                               (tokens + reserve_tokens - self._tokens) * 60.0 / self.tpm, 0.01)
+                    await asyncio.sleep(wait)
+        finally:
+            self.waiting[interactive] -= 1
+            waited = time.monotonic() - started
+            self.wait_times[interactive].append(waited)
+            metrics.observe("lore_ratelimit_wait_seconds", waited, limiter=self.name, priority="interactive" if interactive else "batch")
+
+    # Budget disponible (requêtes, tokens) à cet instant
+    def available(self):
+        self._refill()
+        return self._requests, self._tokens
+
+    def penalize(self, seconds):
+        # Suspendre toutes les requêtes après un 429 (le quota côté OpenAI est épuisé)
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+chat_limiter = TokenBucketLimiter(OPENAI_RPM, OPENAI_TPM, "chat")
+embed_limiter = TokenBucketLimiter(OPENAI_EMBED_RPM, OPENAI_EMBED_TPM, "embeddings")
+
+# Exécution des appels OpenAI bloquants (client synchrone) dans deux groupes de threads : interactif (/lore) et de fond
+# (/setup, indexation en continu, réindexations), pour qu'un /setup n'occupe pas les threads dont /lore a besoin
+class WorkScheduler:
+    def __init__(self, interactive_workers, batch_workers):
+        from concurrent.futures import ThreadPoolExecutor
+        self.workers = {"interactive": interactive_workers, "batch": batch_workers}
+        self.pools = {pool: ThreadPoolExecutor(max_workers=count, thread_name_prefix=f"lore-{pool}") for pool, count in self.workers.items()}
+        self._lock = threading.Lock()  # compteurs mis à jour depuis les threads
+        self.queued = {pool: 0 for pool in self.pools}
+        self.running = {pool: 0 for pool in self.pools}
+        self.completed = {pool: 0 for pool in self.pools}
+        self.wait_times = {pool: deque(maxlen=500) for pool in self.pools}  # dernières attentes en file (secondes)
+
+    # Exécuter func(*args) dans le groupe de threads "interactive" ou "batch"
+    async def run(self, pool, func, *args):
+        submitted = time.monotonic()
+        state = {"dequeued": False}
+        with self._lock:
+            self.queued[pool] += 1
+
+        def leave_queue():
+            if not state["dequeued"]:
+                state["dequeued"] = True
+                self.queued[pool] -= 1
+
+        def job():
+            waited = time.monotonic() - submitted
+            with self._lock:
+                leave_queue()
+                self.running[pool] += 1
+                self.wait_times[pool].append(waited)
+            metrics.observe("lore_scheduler_wait_seconds", waited, pool=pool)
+            try:
+                return func(*args)
+            finally:
+                with self._lock:
+                    self.running[pool] -= 1
+                    self.completed[pool] += 1
+
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.pools[pool], job)
+        except asyncio.CancelledError:
+            # Annulé avant d'avoir démarré : ne plus le compter en file
+            with self._lock:
+                leave_queue()
+            raise
+
+work_scheduler = WorkScheduler(OPENAI_INTERACTIVE_WORKERS, OPENAI_BATCH_WORKERS)
+
+# Centile d'une série de durées (0 si elle est vide)
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+# Exécuter un appel OpenAI asynchrone via le limiteur, avec backoff exponentiel sur les erreurs 429
+async def call_openai_with_backoff(limiter, tokens, request_factory, kind="chat", interactive=False):
+    for attempt in range(OPENAI_MAX_RETRIES + 1):
+        await limiter.acquire(tokens, interactive=interactive)
+        try:
+            result = await request_factory()
+            metrics.inc("lore_openai_requests_total", kind=kind, outcome="ok")
+            return result
+        except RateLimitError as e:
+            metrics.inc("lore_openai_requests_total", kind=kind, outcome="rate_limited")
+            if attempt == OPENAI_MAX_RETRIES:
+                raise
+            delay = min(60.0, 2 ** attempt) + random.uniform(0, 1)
+            try:
+                retry_after = e.response.headers.get("retry-after")
+                if retry_after:
+                    delay = max(delay, float(retry_after))
+            except Exception:
+                pass
+            logger.warning(f"Limite OpenAI atteinte (429), nouvelle tentative dans {delay:.1f}s ({attempt + 1}/{OPENAI_MAX_RETRIES})")
+            limiter.penalize(delay)
+        except Exception:
+            metrics.inc("lore_openai_requests_total", kind=kind, outcome="error")
+            raise
+
+# Poser une question à GPT (client async + limiteur partagé)
+async def ask_gpt_async(messages, model=OPENAI_MODEL, interactive=False):
+    prompt_tokens = sum(estimate_tokens(m["content"]) for m in messages)
+    response = await call_openai_with_backoff(
+        chat_limiter, prompt_tokens + GPT_COMPLETION_TOKENS_ESTIMATE,
+        lambda: openai_async_client.chat.completions.create(model=model, messages=messages),
+        interactive=interactive
+    )
     answer = response.choices[0].message.content
+    count_openai_tokens("chat", getattr(response, "usage", None), prompt_tokens, estimate_tokens(answer or ""))
     return answer
 
-# Charger l'index vectoriel et les données de scènes depuis Google Drive ou local
-def load_index_data():
-    global scenes_data, faiss_index, index_id_to_scene
-    logger.info("Début du chargement de l'index...")
+# Version en flux de ask_gpt_async : on_delta(texte partiel) est appelé à chaque fragment reçu, renvoie la réponse complète
+async def stream_gpt_async(messages, model=OPENAI_MODEL, on_delta=None, interactive=False):
+    prompt_tokens = sum(estimate_tokens(m["content"]) for m in messages)
+    stream = await call_openai_with_backoff(
+        chat_limiter, prompt_tokens + GPT_COMPLETION_TOKENS_ESTIMATE,
+        lambda: openai_async_client.chat.completions.create(model=model, messages=messages, stream=True),
+        interactive=interactive
+    )
+    parts = []
+    async for chunk in stream:
+        delta = chunk.choices[0].delta.content if chunk.choices else None
+        if not delta:
+            continue
+        parts.append(delta)
+        if on_delta:
+            await on_delta("".join(parts))
+    answer = "".join(parts)
+    # Le flux ne renvoie pas l'usage : tokens estimés
+    count_openai_tokens("chat", None, prompt_tokens, estimate_tokens(answer))
+    return answer
 
-    # Si un fichier local existe, on l'utilise en priorité
-    if os.path.exists("lore_index.zip"):
-        logger.info("Fichier lore_index.zip trouvé localement.")
-        zip_path = "lore_index.zip"
-    else:
-        logger.info("Fichier lore_index.zip non trouvé localement.")
-        zip_path = None
-        # Tenter de télécharger le fichier d'index depuis Google Drive si configuré
+# Rechercher un fichier par nom sur Google Drive (dans DRIVE_FOLDER_ID si configuré), renvoie son ID
+def find_drive_file(drive_service, name):
+    query = f"name='{name}'"
+    if DRIVE_FOLDER_ID:
+        query += f" and '{DRIVE_FOLDER_ID}' in parents"
+    results = drive_service.files().list(q=query, spaces='drive', fields="files(id, name)", pageSize=1).execute()
+    files = results.get('files', [])
+    return files[0]['id'] if files else None
+
+# Télécharger un fichier Google Drive vers un chemin local (écriture atomique)
+def download_drive_file(drive_service, file_id, path, progress_cb=None):
+    request = drive_service.files().get_media(fileId=file_id)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as fh:
+        downloader = MediaIoBaseDownload(fh, request)
+        done = False
+        while not done:
+            status, done = downloader.next_chunk()
+            if progress_cb and status:
+                progress_cb(status.progress())
+    os.replace(tmp_path, path)
+
+# Envoyer un fichier local sur Google Drive : mise à jour si le fichier existe (par ID ou par nom), sinon création
+def upload_drive_file(drive_service, path, name, file_id=None, mimetype="application/zip"):
+    if not file_id:
+        file_id = find_drive_file(drive_service, name)
+    media = MediaFileUpload(path, mimetype=mimetype, resumable=True)
+    if file_id:
+        drive_service.files().update(fileId=file_id, media_body=media).execute()
+        return file_id
+    file_metadata = {'name': name}
+    if DRIVE_FOLDER_ID:
+        file_metadata['parents'] = [DRIVE_FOLDER_ID]
+    created = drive_service.files().create(body=file_metadata, media_body=media, fields="id").execute()
+    return created.get('id')
+
+# Manifeste de l'index : archive de base (lore_index.zip) + segments ajoutés depuis la dernière compaction
+def empty_manifest():
+    return {"format": 1, "base_drive_id": None, "base_id": None, "segments": [], "next_segment": 1}
+
+# Charger le manifeste local, ou à défaut celui de Google Drive
+def load_manifest(shard):
+    if not os.path.exists(shard.manifest_path):
         drive_service = get_drive_service()
         if drive_service:
-            logger.info("Tentative de téléchargement depuis Google Drive...")
             try:
-                file_id = DRIVE_FILE_ID
-                # Si FILE_ID n'est pas fourni, chercher un fichier par nom dans le dossier
-                if not file_id:
-                    query = "name='lore_index.zip'"
-                    if DRIVE_FOLDER_ID:
-                        query += f" and '{DRIVE_FOLDER_ID}' in parents"
-                    results = drive_service.files().list(q=query, spaces='drive', fields="files(id, name)", pageSize=1).execute()
-                    files = results.get('files', [])
-                    if files:
-                        file_id = files[0]['id']
+                file_id = find_drive_file(drive_service, shard.manifest_name)
                 if file_id:
-                    try:
-                        request = drive_service.files().get_media(fileId=file_id)
-                        fh = io.BytesIO()
-                        downloader = MediaIoBaseDownload(fh, request)
-                        done = False
-                        while not done:
-                            status, done = downloader.next_chunk()
-                        fh.seek(0)
-                        with open("lore_index.zip", "wb") as f:
-                            f.write(fh.read())
-                        zip_path = "lore_index.zip"
-                        logger.info("Index téléchargé depuis Google Drive.")
-                    except Exception as e:
-                        logger.error(f"Échec du téléchargement de l'index depuis Google Drive: {e}")
-                else:
-                    logger.warning("Aucun ID de fichier trouvé pour l'index sur Google Drive")
+                    os.makedirs(os.path.dirname(shard.manifest_path) or ".", exist_ok=True)
+                    download_drive_file(drive_service, file_id, shard.manifest_path)
+                    logger.info(f"Manifeste de l'index du serveur {shard.guild_id} téléchargé depuis Google Drive.")
             except Exception as e:
-                logger.error(f"Erreur lors de l'accès à Google Drive: {e}")
-        else:
-            logger.info("Service Google Drive non configuré.")
+                logger.error(f"Échec du téléchargement du manifeste depuis Google Drive: {e}")
+    if os.path.exists(shard.manifest_path):
+        try:
+            with open(shard.manifest_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception as e:
+            logger.error(f"Manifeste de l'index illisible: {e}")
+    return empty_manifest()
+
+# Écrire le manifeste localement (atomique, sous shard.persist_lock)
+def write_manifest(shard, manifest):
+    tmp_path = shard.manifest_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(tmp_path, shard.manifest_path)
+
+# Envoyer le manifeste courant sur Google Drive, hors de shard.persist_lock (que la boucle d'événements prend aussi) :
+# copie prise sous le verrou, envois sérialisés par shard.upload_lock pour qu'un manifeste plus ancien n'écrase
+# jamais le plus récent sur Drive
+def upload_manifest(shard, drive_service):
+    with shard.upload_lock:
+        with shard.persist_lock:
+            manifest_text = json.dumps(shard.index_manifest, ensure_ascii=False)
+        upload_path = shard.manifest_path + ".upload"
+        try:
+            with open(upload_path, "w", encoding="utf-8") as f:
+                f.write(manifest_text)
+            upload_drive_file(drive_service, upload_path, shard.manifest_name, mimetype="application/json")
+        except Exception as e:
+            logger.error(f"Échec de l'envoi du manifeste sur Google Drive: {e}")
 
-    # Si on a un zip, l'extraire
-    if zip_path:
-        logger.info(f"Extraction du fichier {zip_path}...")
-        import zipfile
+# Récupérer un segment (local ou téléchargé depuis Google Drive), renvoie son chemin local ou None
+def fetch_segment(shard, segment):
+    path = os.path.join(shard.segments_dir, segment["name"])
+    if os.path.exists(path):
+        return path
+    drive_service = get_drive_service()
+    if drive_service:
         try:
-            with zipfile.ZipFile(zip_path, 'r') as zipf:
-                zipf.extractall(".")
-            logger.info("Extraction réussie.")
+            file_id = segment.get("drive_id") or find_drive_file(drive_service, segment["name"])
+            if file_id:
+                os.makedirs(shard.segments_dir, exist_ok=True)
+                download_drive_file(drive_service, file_id, path)
+                return path
+        except Exception as e:
+            logger.error(f"Échec du téléchargement du segment {segment['name']}: {e}")
+    return None
+
+# État du chargement de l'index d'un serveur (exposé par /readyz et consulté par /lore et /setup)
+class IndexLoadStatus:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reset()
+
+    # Remettre l'état à zéro (sous self._lock, sauf à la construction)
+    def _reset(self):
+        self.unloaded = False  # index déchargé après avoir été chargé (rechargé à la prochaine utilisation)
+        self.started = None
+        self.finished = None
+        self.phase = None
+        self.progress = None
+        self.timings = {}  # phase -> durée en secondes
+        self.error = None
+        self._phase_started = None
+
+    def _close_phase(self, now):
+        if self.phase is not None:
+            self.timings[self.phase] = now - self._phase_started
+
+    def start(self):
+        with self._lock:
+            self._reset()
+            self.started = time.monotonic()
+
+    def begin_phase(self, phase):
+        with self._lock:
+            now = time.monotonic()
+            self._close_phase(now)
+            self.phase = phase
+            self.progress = None
+            self._phase_started = now
+
+    # Avancement de la phase en cours (fraction entre 0 et 1)
+    def set_progress(self, fraction):
+        self.progress = fraction
+
+    def finish(self, error=None):
+        with self._lock:
+            now = time.monotonic()
+            self._close_phase(now)
+            self.phase = None
+            self.progress = None
+            self.finished = now
+            self.error = error
+
+    def mark_unloaded(self):
+        with self._lock:
+            self._reset()
+            self.unloaded = True
+
+    # Le chargement est terminé (avec ou sans erreur) : /lore et /setup peuvent utiliser l'index
+    @property
+    def done(self):
+        return self.finished is not None
+
+    # Un index déchargé reste prêt : il sera rechargé à la demande
+    @property
+    def ready(self):
+        return (self.done and self.error is None) or self.unloaded
+
+    def describe(self):
+        if self.phase is None:
+            return "démarrage"
+        if self.progress is None:
+            return self.phase
+        return f"{self.phase}, {self.progress:.0%}"
+
+    def as_dict(self):
+        with self._lock:
+            if self.started is None:
+                state = "unloaded" if self.unloaded else "pending"
+            elif self.finished is None:
+                state = "loading"
+            else:
+                state = "failed" if self.error else "ready"
+            end = self.finished if self.finished is not None else time.monotonic()
+            timings = dict(self.timings)
+            if self.phase is not None:
+                timings[self.phase] = end - self._phase_started
+            return {
+                "state": state,
+                "phase": self.phase,
+                "progress": self.progress,
+                "elapsed_seconds": round(end - self.started, 3) if self.started is not None else None,
+                "phases": {phase: round(seconds, 3) for phase, seconds in timings.items()},
+                "error": self.error
+            }
+
+# Appliquer un segment à la base et à l'index FAISS : scènes (nouvelles ou modifiées), chunks et vecteurs
+# ajoutés, puis chunks et scènes retirés (index_only : la base de travail contient déjà ce segment,
+# seul l'index est mis à jour)
+def apply_segment(shard, path, segment_no, index_only=False):
+    import zipfile
+    with zipfile.ZipFile(path, 'r') as zipf:
+        scenes = [json.loads(line) for line in zipf.read("scenes.jsonl").decode("utf-8").splitlines() if line]
+        chunk_rows = [tuple(json.loads(line)) for line in zipf.read("chunks.jsonl").decode("utf-8").splitlines() if line]
+        vectors = np.load(io.BytesIO(zipf.read("vectors.npy"))) if chunk_rows else None
+        removed = json.loads(zipf.read("removed.json")) if "removed.json" in zipf.namelist() else {"vectors": [], "scenes": []}
+        summaries = np.load(io.BytesIO(zipf.read("summaries.npz"))) if "summaries.npz" in zipf.namelist() else None
+    if chunk_rows:
+        if shard.faiss_index is None:
+            shard.faiss_index = LoreVectorIndex(vectors.shape[1])
+        if chunk_rows[0][0] != shard.faiss_index.next_id:
+            raise ValueError(f"segment {segment_no} : vecteurs attendus à partir de {shard.faiss_index.next_id}, trouvé {chunk_rows[0][0]}")
+        shard.faiss_index.add(vectors)
+    if shard.lexical_index is not None:
+        for vector_id, _, _, text in chunk_rows:
+            shard.lexical_index.add(vector_id, text)
+        for vector_id in removed["vectors"]:
+            shard.lexical_index.remove(vector_id)
+    if removed["vectors"] and shard.faiss_index is not None:
+        shard.faiss_index.remove(removed["vectors"])
+    if not index_only:
+        for scene in scenes:
+            shard.lore_store.add_scene(scene)
+        shard.lore_store.add_chunks(chunk_rows)
+        if summaries is not None:
+            shard.lore_store.set_scene_vectors(zip(summaries["ids"].tolist(), summaries["vectors"]))
+        shard.lore_store.delete_chunks(removed["vectors"])
+        for scene_id in removed["scenes"]:
+            shard.lore_store.delete_scene(scene_id)
+        shard.lore_store.set_meta("last_segment", segment_no)
+        shard.lore_store.commit()
+    return len(scenes), len(chunk_rows)
+
+# Identité de l'archive de base extraite dans le dossier de cache ({"base_id", "last_segment"}), ou None
+def read_base_info(shard):
+    try:
+        with open(shard.base_info_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_base_info(shard, info):
+    with open(shard.base_info_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(info, f)
+    os.replace(shard.base_info_path + ".tmp", shard.base_info_path)
+
+# La base de travail peut-elle être réutilisée telle quelle avec cette archive de base ?
+# (elle doit contenir la base et au plus les segments connus du manifeste)
+def working_store_matches(shard, base_info):
+    if not os.path.exists(shard.db_path):
+        return False
+    shard.open_store()
+    db_last_segment = int(shard.lore_store.get_meta("last_segment", 0))
+    known_segment = max([s["number"] for s in shard.index_manifest["segments"]] + [base_info["last_segment"]])
+    return base_info["last_segment"] <= db_last_segment <= known_segment
+
+# Trouver l'archive de base lore_index.zip (locale, sinon téléchargée depuis Google Drive), renvoie son chemin ou None
+def locate_base_archive(shard):
+    # Si un fichier local existe, on l'utilise en priorité
+    if os.path.exists(shard.archive_path):
+        logger.info(f"Fichier {shard.archive_path} trouvé localement.")
+        return shard.archive_path
+    logger.info(f"Fichier {shard.archive_path} non trouvé localement.")
+    # Tenter de télécharger le fichier d'index depuis Google Drive si configuré
+    drive_service = get_drive_service()
+    if not drive_service:
+        logger.info("Service Google Drive non configuré.")
+        return None
+    logger.info("Tentative de téléchargement depuis Google Drive...")
+    try:
+        file_id = shard.drive_file_id or shard.index_manifest.get("base_drive_id")
+        # Si FILE_ID n'est pas fourni, chercher un fichier par nom dans le dossier
+        if not file_id:
+            file_id = find_drive_file(drive_service, shard.archive_name)
+        if file_id:
+            try:
+                shard.load_status.begin_phase("téléchargement")
+                os.makedirs(os.path.dirname(shard.archive_path) or ".", exist_ok=True)
+                download_drive_file(drive_service, file_id, shard.archive_path, progress_cb=shard.load_status.set_progress)
+                logger.info("Index téléchargé depuis Google Drive.")
+                return shard.archive_path
+            except Exception as e:
+                logger.error(f"Échec du téléchargement de l'index depuis Google Drive: {e}")
+        else:
+            logger.warning("Aucun ID de fichier trouvé pour l'index sur Google Drive")
+    except Exception as e:
+        logger.error(f"Erreur lors de l'accès à Google Drive: {e}")
+    return None
+
+# Extraire l'archive de base dans le dossier de cache, sauf si cette même archive y est déjà extraite
+# Renvoie (infos de la base, migration effectuée)
+def extract_base_archive(shard, zip_path, cached_info):
+    import zipfile
+    with zipfile.ZipFile(zip_path, 'r') as zipf:
+        members = zipf.namelist()
+        if "base.json" in members:
+            base_info = json.loads(zipf.read("base.json").decode("utf-8"))
+        else:
+            # Ancienne archive sans identité : la reconnaître à sa taille et sa date
+            stat = os.stat(zip_path)
+            base_info = {"base_id": f"legacy-{stat.st_size}-{stat.st_mtime_ns}", "last_segment": None}
+        if cached_info and cached_info.get("base_id") == base_info["base_id"] and working_store_matches(shard, cached_info):
+            logger.info("Archive de base déjà extraite dans le cache, extraction ignorée.")
+            return cached_info, False
+        logger.info(f"Extraction du fichier {zip_path} dans {shard.cache_dir}...")
+        shard.load_status.begin_phase("extraction")
+        shard.close_store()  # la base va être remplacée par celle de l'archive
+        os.makedirs(shard.cache_dir, exist_ok=True)
+        if os.path.exists(shard.base_info_path):
+            os.remove(shard.base_info_path)  # une extraction interrompue ne doit pas passer pour valide
+        for stale_path in (shard.index_path, shard.base_ids_path, shard.lexical_path):
+            if os.path.exists(stale_path):
+                os.remove(stale_path)
+        zipf.extractall(shard.cache_dir)
+    logger.info("Extraction réussie.")
+
+    # Ancien format (scenes.json) : convertir une fois en base SQLite, puis réécrire l'archive
+    migrated = False
+    if LORE_DB_NAME not in members and "scenes.json" in members:
+        migrate_legacy_scenes_json(shard, os.path.join(shard.cache_dir, "scenes.json"))
+        migrated = True
+    else:
+        shard.open_store()
+    if base_info["last_segment"] is None:
+        base_info["last_segment"] = int(shard.lore_store.get_meta("last_segment", 0))
+    write_base_info(shard, base_info)
+    return base_info, migrated
 
-            # Charger les données JSON des scènes
-            logger.info("Chargement de scenes.json...")
-            with open("scenes.json", "r", encoding="utf-8") as f:
-                scenes_data = json.load(f)
-            logger.info(f"scenes.json chargé avec {len(scenes_data)} scènes.")
+# Charger l'index vectoriel et les données de scènes depuis Google Drive ou local
+def load_index_data(shard):
+    logger.info(f"Début du chargement de l'index du serveur {shard.guild_id}...")
+    shard.load_status.start()
+    # Le cache d'embeddings est indépendant de l'archive d'index (partagé par tous les serveurs, lu une seule fois)
+    shard.load_status.begin_phase("cache d'embeddings")
+    cache_loaded = embedding_cache.loaded or embedding_cache.load()
+    if not summary_cache.loaded:
+        summary_cache.load()
+    shard.load_status.begin_phase("manifeste")
+    shard.index_manifest = load_manifest(shard)
+
+    migrated = False
+    load_error = None
+    try:
+        # Archive de base déjà extraite et toujours à jour : pas besoin de l'archive elle-même
+        base_info = None
+        cached_info = read_base_info(shard)
+        if cached_info and cached_info.get("base_id") == shard.index_manifest.get("base_id") and working_store_matches(shard, cached_info):
+            logger.info("Archive de base à jour dans le cache local.")
+            base_info = cached_info
+        else:
+            zip_path = locate_base_archive(shard)
+            if zip_path:
+                base_info, migrated = extract_base_archive(shard, zip_path, cached_info)
 
-            # Charger l'index FAISS
+        if base_info is not None:
+            # Ouvrir l'index FAISS de base en mémoire mappée
             logger.info("Chargement de l'index FAISS...")
+            shard.load_status.begin_phase("index FAISS")
             try:
-                faiss = __import__('faiss')  # import dynamique pour éviter erreur si module non chargé
-                faiss_index = faiss.read_index("index.faiss")
-                if faiss_index is None:
-                    logger.warning("L'index FAISS chargé est None - fichier probablement corrompu.")
-                    faiss_index = None
-                    return
-                logger.info(f"Index FAISS chargé avec {faiss_index.ntotal} vecteurs.")
+                shard.faiss_index = None
+                if os.path.exists(shard.index_path):
+                    base_index = open_base_index(shard.index_path)
+                    # Identifiants des vecteurs de la base (absents si la base n'a jamais perdu de vecteur)
+                    base_ids = np.load(shard.base_ids_path, mmap_mode='r') if os.path.exists(shard.base_ids_path) else None
+                    shard.faiss_index = LoreVectorIndex(base_index.d, base_index, base_ids, base_info.get("next_vector_id"))
+                    logger.info(f"Index FAISS ouvert avec {shard.faiss_index.ntotal} vecteurs.")
             except ImportError as e:
                 logger.warning(f"FAISS non disponible: {e}")
-                faiss_index = None
+                shard.faiss_index = None
                 # Ne pas retourner ici, continuer sans FAISS
             except Exception as e:
                 logger.error(f"Erreur lors du chargement de l'index FAISS: {e}")
-                faiss_index = None
+                shard.faiss_index = None
                 # Ne pas retourner ici, continuer sans FAISS
+            base_last_segment = base_info["last_segment"]
+            # Index lexical de la base : reconstruit plus bas s'il manque ou ne correspond pas à l'index FAISS
+            shard.lexical_index = None
+            base_next_id = shard.faiss_index.next_id if shard.faiss_index is not None else 0
+            if os.path.exists(shard.lexical_path):
+                try:
+                    shard.lexical_index = LexicalIndex.load(shard.lexical_path)
+                    if len(shard.lexical_index) != base_next_id:
+                        logger.warning("Index lexical désynchronisé de l'index FAISS : reconstruction.")
+                        shard.lexical_index = None
+                except Exception as e:
+                    logger.error(f"Erreur lors du chargement de l'index lexical: {e}")
+                    shard.lexical_index = None
+        else:
+            logger.info("Aucune archive d'index de base disponible.")
+            shard.faiss_index = None
+            shard.lexical_index = LexicalIndex()
+            base_last_segment = 0
+            shard.open_store().reset()
+
+        # Rejouer les segments ajoutés depuis la dernière compaction : leurs vecteurs vont dans le delta,
+        # leurs scènes seulement s'ils sont plus récents que la base de travail
+        db_last_segment = int(shard.lore_store.get_meta("last_segment", 0))
+        shard.load_status.begin_phase("segments")
+        segments = [s for s in shard.index_manifest["segments"] if s["number"] > base_last_segment]
+        for position, segment in enumerate(segments):
+            shard.load_status.set_progress(position / len(segments))
+            path = fetch_segment(shard, segment)
+            if path is None:
+                logger.error(f"Segment {segment['name']} introuvable : les segments suivants sont ignorés.")
+                break
+            try:
+                added_scenes, added_chunks = apply_segment(shard, path, segment["number"], index_only=segment["number"] <= db_last_segment)
+            except Exception as e:
+                logger.error(f"Segment {segment['name']} inutilisable ({e}) : les segments suivants sont ignorés.")
+                break
+            logger.info(f"Segment {segment['name']} appliqué ({added_scenes} scènes, {added_chunks} chunks).")
+
+        # Index lexical absent de l'archive (ancien format) : le reconstruire à partir des chunks de la base
+        if shard.lexical_index is None:
+            shard.load_status.begin_phase("index lexical")
+            shard.lexical_index = LexicalIndex()
+            for vector_id, text in shard.lore_store.iter_chunk_texts():
+                shard.lexical_index.add(vector_id, text)
+            # Derniers vecteurs retirés : garder la même numérotation que l'index FAISS
+            if shard.faiss_index is not None and len(shard.lexical_index) < shard.faiss_index.next_id:
+                shard.lexical_index.doc_lengths.extend([-1] * (shard.faiss_index.next_id - len(shard.lexical_index)))
+            logger.info(f"Index lexical reconstruit avec {len(shard.lexical_index)} chunks.")
+
+        # Charger les métadonnées des scènes (les messages restent dans la base)
+        logger.info("Chargement des métadonnées des scènes...")
+        shard.load_status.begin_phase("métadonnées")
+        shard.scenes_data = shard.lore_store.load_scene_metadata()
+        shard.rebuild_scene_lookup()
+        shard.summary_index = load_summary_index(shard)
+
+        # Charger la table de correspondance index->scene/chunk
+        logger.info("Chargement de la table de correspondance...")
+        shard.index_id_to_scene = shard.lore_store.load_vector_map()
+        logger.info(f"Table de correspondance créée avec {len(shard.index_id_to_scene)} entrées.")
+        logger.info(f"{len(shard.scenes_data)} scènes/entrées lore chargées depuis l'index existant.")
+        # Réutiliser les vecteurs déjà indexés si le cache d'embeddings n'existe pas encore
+        if not cache_loaded and shard.faiss_index is not None:
+            shard.load_status.begin_phase("initialisation du cache d'embeddings")
+            seed_embedding_cache_from_index(shard)
+        if migrated and shard.faiss_index is not None:
+            shard.load_status.begin_phase("compaction")
+            compact_index_segments(shard)
 
-            # Reconstruire la table de correspondance index->scene/chunk
-            logger.info("Reconstruction de la table de correspondance...")
-            index_id_to_scene = []
-            for scene in scenes_data:
-                # Pour chaque scène, ajouter soit ses chunks, soit la scène entière
-                if scene.get("chunks"):
-                    for chunk in scene["chunks"]:
-                        index_id_to_scene.append((scene["id"], chunk))
-                else:
-                    index_id_to_scene.append((scene["id"], None))
-            logger.info(f"Table de correspondance créée avec {len(index_id_to_scene)} entrées.")
-            logger.info(f"{len(scenes_data)} scènes/entrées lore chargées depuis l'index existant.")
-
+    except Exception as e:
+        logger.error(f"Erreur lors du chargement de l'index local: {e}")
+        import traceback
+        traceback.print_exc()
+        load_error = str(e)
+        shard.scenes_data = []
+        shard.scenes_by_id = {}
+        shard.index_id_to_scene = {}
+        shard.faiss_index = None
+        shard.lexical_index = LexicalIndex()
+        shard.summary_index = None
+        shard.open_store().reset()
+    shard.bump_version()
+    shard.load_status.finish(error=load_error)
+    logger.info(f"Chargement de l'index du serveur {shard.guild_id} terminé en {shard.load_status.as_dict()['elapsed_seconds']}s.")
+
+# Construire l'index des résumés de scènes à partir des vecteurs enregistrés dans la base (None s'il n'y en a aucun)
+def load_summary_index(shard):
+    rows = shard.lore_store.load_scene_vectors()
+    if not rows:
+        return None
+    summary_index = SceneSummaryIndex(len(rows[0][1]))
+    summary_index.set(rows)
+    logger.info(f"Index des résumés chargé avec {summary_index.ntotal} scènes.")
+    return summary_index
+
+# Charger l'index d'un serveur dans un thread (le bot continue de répondre pendant ce temps)
+async def load_index_in_background(shard):
+    try:
+        with stage_timer("index", "load"):
+            await asyncio.to_thread(load_index_data, shard)
+    except Exception as e:
+        logger.error(f"Échec du chargement de l'index du serveur {shard.guild_id} en arrière-plan: {e}")
+        shard.load_status.finish(error=str(e))
+    finally:
+        shard.loader = None
+    # Modifications de messages reçues pendant que l'index n'était pas chargé
+    if shard.loaded:
+        changes, shard.pending_changes = shard.pending_changes, {}
+        for message_id, content in changes.items():
+            handle_message_change(shard, message_id, content)
+    await enforce_shard_memory_cap()
+
+# Lancer le chargement de l'index d'un serveur s'il n'est pas chargé et l'attendre au plus wait secondes,
+# renvoie True si l'index est utilisable
+async def ensure_shard_loaded(shard, wait=0):
+    shard.last_used = time.monotonic()
+    if not shard.loaded and shard.loader is None:
+        shard.loader = asyncio.create_task(load_index_in_background(shard))
+    if not shard.loaded and wait > 0:
+        try:
+            await asyncio.wait_for(asyncio.shield(shard.loader), wait)
+        except asyncio.TimeoutError:
+            pass
+    return shard.loaded
+
+# Décharger les index les moins récemment utilisés tant que les index chargés dépassent LORE_SHARDS_MAX_MB
+# (les index occupés sont ignorés ; leurs modifications sont sauvegardées avant déchargement)
+async def enforce_shard_memory_cap():
+    limit = LORE_SHARDS_MAX_MB * 1024 * 1024
+    for shard in sorted(lore_shards.values(), key=lambda shard: shard.last_used):
+        if sum(other.memory_bytes() for other in lore_shards.values()) <= limit:
+            return
+        if not shard.evictable():
+            continue
+        try:
+            await asyncio.to_thread(save_index_data, shard)
         except Exception as e:
-            logger.error(f"Erreur lors du chargement de l'index local: {e}")
-            import traceback
-            traceback.print_exc()
-            scenes_data = []
-            index_id_to_scene = []
-            faiss_index = None
-    else:
-        logger.info("Aucun fichier d'index disponible.")
-        scenes_data = []
-        index_id_to_scene = []
-        faiss_index = None
-
-# Sauvegarder l'index vectoriel et les données de scènes localement et sur Drive
-def save_index_data():
-    global scenes_data, faiss_index
-    # Sauvegarder scenes_data en JSON
-    with open("scenes.json", "w", encoding="utf-8") as f:
-        json.dump(scenes_data, f, ensure_ascii=False, indent=2)
-    # Sauvegarder l'index FAISS
-    faiss = __import__('faiss')
-    faiss.write_index(faiss_index, "index.faiss")
-    # Créer un zip de scenes.json et index.faiss
+            logger.error(f"Échec de la sauvegarde de l'index du serveur {shard.guild_id} avant déchargement: {e}")
+            continue
+        # L'index a pu être repris (commande, indexation...) pendant la sauvegarde
+        if shard.evictable() and not any(shard.pending_delta.values()):
+            shard.unload()
+
+# Alimenter le cache d'embeddings avec les vecteurs déjà présents dans l'index FAISS
+def seed_embedding_cache_from_index(shard):
+    seeded = 0
+    for vector_id, text in shard.lore_store.iter_chunk_texts():
+        if vector_id >= shard.faiss_index.next_id:
+            break
+        embedding_cache.put(text, shard.faiss_index.reconstruct(vector_id))
+        seeded += 1
+    logger.info(f"Cache d'embeddings initialisé avec {seeded} vecteurs de l'index existant.")
+
+# Mémoriser les ajouts et retraits en attente d'écriture dans le prochain segment
+def record_index_delta(shard, scenes, chunk_rows, vectors, removed_vectors=(), removed_scenes=(), summaries=()):
+    # Un ID de scène supprimée peut être réattribué : les retraits sont appliqués après les ajouts du segment
+    added_ids = {scene["id"] for scene in scenes}
+    shard.pending_delta["removed_scenes"][:] = [scene_id for scene_id in shard.pending_delta["removed_scenes"] if scene_id not in added_ids]
+    shard.pending_delta["scenes"].extend(scene["id"] for scene in scenes)
+    shard.pending_delta["chunks"].extend(chunk_rows)
+    if chunk_rows:
+        shard.pending_delta["vectors"].append(np.asarray(vectors, dtype='float32'))
+    shard.pending_delta["summaries"].extend(summaries)
+    shard.pending_delta["removed_vectors"].extend(int(i) for i in removed_vectors)
+    shard.pending_delta["removed_scenes"].extend(removed_scenes)
+
+# Scènes complètes (métadonnées + messages) ajoutées ou modifiées depuis le dernier segment, relues dans la base :
+# le delta ne garde que leurs ID (une scène supprimée depuis est ignorée, son retrait figure dans le segment)
+def pending_segment_scenes(shard):
+    for scene_id in dict.fromkeys(shard.pending_delta["scenes"]):
+        scene = shard.lore_store.get_scene(scene_id)
+        if scene is not None:
+            yield scene
+
+# Écrire le delta en attente dans un nouveau segment (scènes complètes, chunks, vecteurs, résumés, retraits), renvoie son chemin
+def write_segment(shard, segment_name):
     import zipfile
-    with zipfile.ZipFile("lore_index.zip", "w", zipfile.ZIP_DEFLATED) as zipf:
-        zipf.write("scenes.json")
-        zipf.write("index.faiss")
-    # Uploader sur Google Drive si configuré
+    os.makedirs(shard.segments_dir, exist_ok=True)
+    path = os.path.join(shard.segments_dir, segment_name)
+    vectors_buffer = io.BytesIO()
+    if shard.pending_delta["vectors"]:
+        np.save(vectors_buffer, np.vstack(shard.pending_delta["vectors"]))
+    with zipfile.ZipFile(path + ".tmp", "w", zipfile.ZIP_DEFLATED) as zipf:
+        zipf.writestr("scenes.jsonl", "".join(json.dumps(scene, ensure_ascii=False) + "\n" for scene in pending_segment_scenes(shard)))
+        zipf.writestr("chunks.jsonl", "".join(json.dumps(list(row), ensure_ascii=False) + "\n" for row in shard.pending_delta["chunks"]))
+        zipf.writestr("vectors.npy", vectors_buffer.getvalue())
+        zipf.writestr("removed.json", json.dumps({"vectors": shard.pending_delta["removed_vectors"], "scenes": shard.pending_delta["removed_scenes"]}))
+        if shard.pending_delta["summaries"]:
+            summaries_buffer = io.BytesIO()
+            np.savez(summaries_buffer, ids=np.array([scene_id for scene_id, _ in shard.pending_delta["summaries"]], dtype='int64'),
+                     vectors=np.vstack([vector for _, vector in shard.pending_delta["summaries"]]).astype('float32'))
+            zipf.writestr("summaries.npz", summaries_buffer.getvalue())
+    os.replace(path + ".tmp", path)
+    return path
+
+# Sauvegarder les ajouts depuis la dernière sauvegarde : un nouveau segment + le manifeste (localement et sur Drive)
+def save_index_data(shard):
+    with shard.persist_lock:
+        if not any(shard.pending_delta.values()):
+            return
+        segment_no = shard.index_manifest["next_segment"]
+        segment_name = f"{shard.segment_prefix}segment-{segment_no:06d}.zip"
+        path = write_segment(shard, segment_name)
+        # La base locale connaît déjà ces données : noter seulement le segment correspondant
+        shard.lore_store.set_meta("last_segment", segment_no)
+        shard.lore_store.commit()
+        segment = {"number": segment_no, "name": segment_name, "scenes": len(set(shard.pending_delta["scenes"])),
+                   "vectors": len(shard.pending_delta["chunks"]), "bytes": os.path.getsize(path), "drive_id": None}
+        for pending in shard.pending_delta.values():
+            pending.clear()
+        shard.index_manifest["segments"].append(segment)
+        shard.index_manifest["next_segment"] = segment_no + 1
+        write_manifest(shard, shard.index_manifest)
+        segment_count = len(shard.index_manifest["segments"])
+    # Uploader uniquement le nouveau segment sur Google Drive si configuré, verrou relâché : un envoi lent ne bloque
+    # pas la boucle d'événements (indexation en continu, modifications de messages)
     drive_service = get_drive_service()
     if drive_service:
         try:
-            file_id = DRIVE_FILE_ID
-            # Vérifier si le fichier existe déjà (par ID ou par nom)
-            if file_id:
-                # Mise à jour du fichier existant par ID
-                media = MediaFileUpload("lore_index.zip", mimetype="application/zip", resumable=True)
-                drive_service.files().update(fileId=file_id, media_body=media).execute()
-            else:
-                # Rechercher par nom dans le dossier (au cas où)
-                query = "name='lore_index.zip'"
-                if DRIVE_FOLDER_ID:
-                    query += f" and '{DRIVE_FOLDER_ID}' in parents"
-                results = drive_service.files().list(q=query, fields="files(id)", pageSize=1).execute()
-                files = results.get('files', [])
-                if files:
-                    file_id = files[0]['id']
-                if file_id:
-                    media = MediaFileUpload("lore_index.zip", mimetype="application/zip", resumable=True)
-                    drive_service.files().update(fileId=file_id, media_body=media).execute()
-                else:
-                    # Créer un nouveau fichier sur Drive
-                    file_metadata = {'name': 'lore_index.zip'}
-                    if DRIVE_FOLDER_ID:
-                        file_metadata['parents'] = [DRIVE_FOLDER_ID]
-                    media = MediaFileUpload("lore_index.zip", mimetype="application/zip", resumable=True)
-                    drive_service.files().create(body=file_metadata, media_body=media).execute()
-            logger.info("Index sauvegardé sur Google Drive.")
+            drive_id = upload_drive_file(drive_service, path, segment_name)
+            logger.info(f"Segment {segment_name} sauvegardé sur Google Drive ({segment['bytes']} octets).")
+            with shard.persist_lock:
+                segment["drive_id"] = drive_id
+                write_manifest(shard, shard.index_manifest)
         except Exception as e:
             logger.error(f"Échec de la sauvegarde sur Google Drive: {e}")
+        upload_manifest(shard, drive_service)
+    try:
+        embedding_cache.save()
+        summary_cache.save()
+    except Exception as e:
+        logger.error(f"Échec de la sauvegarde des caches d'embeddings et de résumés: {e}")
+    # Trop de segments, ou type d'index à changer : les fusionner dans une nouvelle archive de base en arrière-plan
+    if segment_count >= LORE_COMPACTION_SEGMENTS or (shard.faiss_index is not None and shard.faiss_index.needs_rebuild):
+        compact_index_segments(shard, background=True)
+
+# Remplacer l'index en mémoire par la nouvelle base compactée (ouverte en mémoire mappée), en reportant
+# les vecteurs ajoutés et retirés depuis l'instantané de compaction
+def adopt_compacted_base(shard, index_snapshot):
+    base = open_base_index(shard.index_path)
+    adopted = LoreVectorIndex(base.d, base, np.load(shard.base_ids_path, mmap_mode='r'), index_snapshot.next_id)
+    for ids, vectors in shard.faiss_index._iter_source(shard.faiss_index.delta):
+        keep = ids >= index_snapshot.next_id
+        if keep.any():
+            adopted.delta.add_with_ids(vectors[keep], ids[keep])
+    adopted.next_id = shard.faiss_index.next_id
+    adopted.remove(shard.faiss_index.removal_log[len(index_snapshot.removal_log):])
+    shard.faiss_index = adopted
+
+# Fusionner les segments dans une nouvelle archive de base
+# (lore_index.zip = base.json + base SQLite + index.faiss + base_ids.npy + lexical.npz)
+def compact_index_segments(shard, background=False):
+    if shard.compaction_running:
+        return
+    shard.compaction_running = True
+    # Instantané cohérent pris immédiatement ; la fusion, la compression et l'envoi peuvent se faire en arrière-plan
+    try:
+        with shard.persist_lock:
+            shard.lore_store.snapshot(shard.db_path + ".snapshot")
+            index_snapshot = shard.faiss_index.snapshot() if shard.faiss_index is not None else None
+            lexical_snapshot = shard.lexical_index.snapshot()
+            merged = list(shard.index_manifest["segments"])
+            base_info = {"base_id": uuid.uuid4().hex, "last_segment": int(shard.lore_store.get_meta("last_segment", 0)),
+                         "next_vector_id": index_snapshot.next_id if index_snapshot is not None else 0}
+    except Exception as e:
+        shard.compaction_running = False
+        logger.error(f"Échec de l'instantané pour la compaction de l'index: {e}")
+        return
+
+    def build_and_upload():
+        import zipfile
+        compaction_started = time.perf_counter()
+        try:
+            index_snapshot_path = shard.index_path + ".snapshot"
+            ids_snapshot_path = shard.base_ids_path + ".snapshot"
+            if index_snapshot is not None:
+                merged_index = index_snapshot.write(index_snapshot_path, ids_snapshot_path)
+                base_info["index_type"] = faiss_index_type(merged_index)
+                # Index approximatif : mesurer le rappel obtenu par rapport à la recherche exacte
+                base_info["recall_report"] = index_recall_report(merged_index)
+                logger.info(format_recall_report(base_info["recall_report"]))
+                del merged_index
+            lexical_snapshot.save(shard.lexical_path + ".snapshot")
+            # L'index reste non compressé dans l'archive : une fois extrait, il est ouvert en mémoire mappée
+            with zipfile.ZipFile(shard.archive_path + ".tmp", "w", zipfile.ZIP_DEFLATED) as zipf:
+                zipf.writestr("base.json", json.dumps(base_info))
+                zipf.write(shard.db_path + ".snapshot", arcname=LORE_DB_NAME)
+                if index_snapshot is not None:
+                    zipf.write(index_snapshot_path, arcname="index.faiss", compress_type=zipfile.ZIP_STORED)
+                    zipf.write(ids_snapshot_path, arcname="base_ids.npy", compress_type=zipfile.ZIP_STORED)
+                zipf.write(shard.lexical_path + ".snapshot", arcname="lexical.npz")
+            os.replace(shard.archive_path + ".tmp", shard.archive_path)
+            os.remove(shard.db_path + ".snapshot")
+            # Le cache devient la nouvelle base (la base de travail contient déjà tout ; l'ancien index reste
+            # mappé par ce processus jusqu'à ce qu'il adopte la nouvelle base)
+            if os.path.exists(shard.base_info_path):
+                os.remove(shard.base_info_path)
+            if index_snapshot is not None:
+                os.replace(index_snapshot_path, shard.index_path)
+                os.replace(ids_snapshot_path, shard.base_ids_path)
+            os.replace(shard.lexical_path + ".snapshot", shard.lexical_path)
+            write_base_info(shard, base_info)
+            if index_snapshot is not None:
+                with shard.persist_lock:
+                    adopt_compacted_base(shard, index_snapshot)
+            # Uploader la nouvelle base sur Google Drive si configuré, puis retirer les segments fusionnés
+            drive_service = get_drive_service()
+            base_drive_id = shard.index_manifest.get("base_drive_id")
+            if drive_service:
+                try:
+                    base_drive_id = upload_drive_file(drive_service, shard.archive_path, shard.archive_name, file_id=shard.drive_file_id or base_drive_id)
+                    logger.info("Index sauvegardé sur Google Drive.")
+                except Exception as e:
+                    logger.error(f"Échec de la sauvegarde sur Google Drive: {e}")
+                    return
+            merged_names = {segment["name"] for segment in merged}
+            with shard.persist_lock:
+                shard.index_manifest["base_drive_id"] = base_drive_id
+                shard.index_manifest["base_id"] = base_info["base_id"]
+                shard.index_manifest["segments"] = [s for s in shard.index_manifest["segments"] if s["name"] not in merged_names]
+                write_manifest(shard, shard.index_manifest)
+            if drive_service:
+                upload_manifest(shard, drive_service)
+            for segment in merged:
+                try:
+                    path = os.path.join(shard.segments_dir, segment["name"])
+                    if os.path.exists(path):
+                        os.remove(path)
+                    if drive_service and segment.get("drive_id"):
+                        drive_service.files().delete(fileId=segment["drive_id"]).execute()
+                except Exception as e:
+                    logger.warning(f"Impossible de supprimer le segment fusionné {segment['name']}: {e}")
+            logger.info(f"Compaction de l'index terminée ({len(merged)} segment(s) fusionné(s)).")
+        except Exception as e:
+            metrics.inc("lore_errors_total", command="index", stage="compaction")
+            logger.error(f"Échec de la compaction de l'index: {e}")
+        finally:
+            metrics.observe("lore_stage_seconds", time.perf_counter() - compaction_started, command="index", stage="compaction")
+            shard.compaction_running = False
+
+    if background:
+        threading.Thread(target=build_and_upload, daemon=True).start()
+    else:
+        build_and_upload()
 
 # L'index sera chargé au démarrage du bot dans la fonction main()
 
@@ -370,59 +2942,229 @@ bot = discord.Client(
 )
 tree = app_commands.CommandTree(bot)
 
+# Ajouter des chunks vectorisés (scene_id, n° de chunk, texte) à l'index FAISS, au BM25, à la base et à la table
+# de correspondance ; renvoie les lignes (vector_id, scene_id, chunk_no, texte). Appelé sous shard.persist_lock.
+def add_index_chunks(shard, chunks, vectors):
+    if not chunks:
+        return []
+    # Créer l'index FAISS dynamiquement si nécessaire (dimension = taille de l'embedding)
+    if shard.faiss_index is None:
+        shard.faiss_index = LoreVectorIndex(vectors.shape[1])
+    # Ajouter tous les vecteurs normalisés en une seule fois (ID attribués à la suite)
+    first_vector_id = shard.faiss_index.next_id
+    shard.faiss_index.add(vectors)
+    rows = [(first_vector_id + offset, scene_id, chunk_no, text) for offset, (scene_id, chunk_no, text) in enumerate(chunks)]
+    shard.lore_store.add_chunks(rows)
+    for vector_id, scene_id, chunk_no, text in rows:
+        shard.lexical_index.add(vector_id, text)
+        shard.index_id_to_scene[vector_id] = (scene_id, chunk_no)
+    return rows
+
+# Enregistrer des vecteurs de résumé (scene_id, vecteur) dans la base et l'index des résumés (sous shard.persist_lock)
+def add_scene_summaries(shard, rows):
+    if not rows:
+        return
+    if shard.summary_index is None:
+        shard.summary_index = SceneSummaryIndex(len(rows[0][1]))
+    shard.summary_index.set(rows)
+    shard.lore_store.set_scene_vectors(rows)
+
+# Vectoriser une fois les résumés des scènes indexées avant l'index des résumés (appelé par /setup) ;
+# entrées INFO et scènes sans résumé : vecteur de leur premier chunk, déjà dans l'index
+async def backfill_scene_summaries(shard):
+    known = shard.summary_index.scene_ids if shard.summary_index is not None else set()
+    missing = [scene for scene in shard.scenes_data if scene["id"] not in known]
+    if not missing:
+        return 0
+    summarized = [scene for scene in missing if scene["type"] == "rp" and scene.get("summary")]
+    matrix, ok_positions, _ = await embed_texts([scene["summary"] for scene in summarized])
+    rows = [(summarized[pos]["id"], matrix[row]) for row, pos in enumerate(ok_positions)]
+    summarized_ids = {scene["id"] for scene in summarized}
+    for scene in missing:
+        if scene["id"] in summarized_ids or shard.faiss_index is None:
+            continue
+        chunks = shard.lore_store.get_scene_chunks(scene["id"])
+        if chunks:
+            rows.append((scene["id"], shard.faiss_index.reconstruct(chunks[0][0])))
+    with shard.persist_lock:
+        add_scene_summaries(shard, rows)
+        record_index_delta(shard, [], [], None, summaries=rows)
+        shard.lore_store.commit()
+    logger.info(f"Index des résumés complété : {len(rows)}/{len(missing)} scène(s) vectorisée(s).")
+    return len(rows)
+
+# Retirer des chunks de l'index FAISS, du BM25, de la base et de la table de correspondance (sous shard.persist_lock)
+def remove_index_chunks(shard, vector_ids):
+    if not vector_ids:
+        return
+    if shard.faiss_index is not None:
+        shard.faiss_index.remove(vector_ids)
+    for vector_id in vector_ids:
+        shard.lexical_index.remove(vector_id)
+        shard.index_id_to_scene.pop(vector_id, None)
+    shard.lore_store.delete_chunks(vector_ids)
+
+# Intégrer des scènes résumées et vectorisées à l'index : ID, base SQLite, FAISS, BM25, delta du prochain segment
+# et corpus en mémoire (utilisé par /setup et par l'indexation en continu)
+def commit_new_scenes(shard, new_scenes, indexed_chunks, vectors):
+    # Assigner des ID uniques aux nouvelles scènes (dans l'ordre reçu)
+    next_id = max(shard.scenes_by_id, default=0) + 1
+    for scene in new_scenes:
+        scene['id'] = next_id
+        next_id += 1
+    summary_rows = [(scene['id'], scene.pop('summary_vector')) for scene in new_scenes if scene.get('summary_vector') is not None]
+
+    # Verrou : une compaction en arrière-plan peut remplacer l'index de base en même temps
+    with shard.persist_lock:
+        # Enregistrer les scènes (messages compris) dans la base
+        for scene in new_scenes:
+            shard.lore_store.add_scene(scene)
+        chunk_rows = add_index_chunks(shard, [(scene['id'], chunk_no, text) for scene, text, chunk_no in indexed_chunks], vectors)
+        add_scene_summaries(shard, summary_rows)
+        # Mémoriser le delta pour le prochain segment de sauvegarde
+        record_index_delta(shard, new_scenes, chunk_rows, vectors, summaries=summary_rows)
+    # Ajouter les nouvelles scènes/entrées au corpus en mémoire (et à l'index id -> scène)
+    for scene in new_scenes:
+        shard.register_scene(scene_metadata(scene))
+    # L'index a changé : invalider les réponses /lore en cache
+    shard.bump_version()
+
 # Commande slash /setup pour indexer le lore du serveur
 @tree.command(name="setup", description="Récupère l'historique RP et construit l'index du lore", guild=discord.Object(id=int(DISCORD_GUILD_ID)) if DISCORD_GUILD_ID else None)
 async def setup_command(interaction: discord.Interaction):
-    global scenes_data, faiss_index, index_id_to_scene
     # Restreindre l'utilisation de /setup aux administrateurs du serveur
     if not interaction.user.guild_permissions.administrator:
         await interaction.response.send_message("Désolé, vous n'avez pas la permission d'utiliser cette commande.", ephemeral=True)
         return
+    guild = interaction.guild
+    if guild is None:
+        await interaction.response.send_message("Erreur : serveur introuvable (guild est None).", ephemeral=True)
+        return
     # Accuser réception de la commande (peut prendre du temps)
     await interaction.response.defer(thinking=True, ephemeral=True)
+    # Index de ce serveur, chargé si besoin (il ne peut pas être déchargé pendant /setup)
+    shard = get_shard(guild.id)
+    shard.in_use += 1
+    if not await ensure_shard_loaded(shard, LORE_SHARD_LOAD_WAIT_SECONDS):
+        shard.in_use -= 1
+        await interaction.followup.send(f"L'index du lore est en cours de chargement ({shard.load_status.describe()}). Réessayez dans quelques instants.", ephemeral=True)
+        return
+    # Attendre la fin d'un éventuel lot d'indexation en continu (et le suspendre pendant /setup)
+    await shard.indexing_lock.acquire()
+    setup_started = time.perf_counter()
+    checkpoint_task = None
     try:
-        guild = interaction.guild
-        if guild is None:
-            await interaction.followup.send("Erreur : serveur introuvable (guild est None).", ephemeral=True)
-            return
+        # Scènes indexées avant l'index des résumés : compléter celui-ci (une seule fois)
+        with stage_timer("setup", "summary_backfill"):
+            await backfill_scene_summaries(shard)
 
-        # Dictionnaire des dernières dates traitées par channel (pour mise à jour incrémentale)
+        # Dictionnaire des dernières dates lues par /setup par channel (pour mise à jour incrémentale). Les scènes
+        # indexées en continu ne comptent pas : les messages postés pendant un arrêt du bot, ou l'historique d'un salon
+        # jamais lu par /setup, seraient sinon sautés
         last_processed = {}
-        if scenes_data:
-            for scene in scenes_data:
-                if scene["messages"]:
-                    try:
-                        last_msg_time = scene["messages"][-1]["time"]
-                    except:
-                        last_msg_time = None
-                    chan_id = scene.get("channel_id")
-                    if last_msg_time and chan_id:
-                        if chan_id not in last_processed or last_msg_time > last_processed[chan_id]:
-                            last_processed[chan_id] = last_msg_time
-
-        new_scenes = []  # liste des nouvelles scènes/entrées extraites
-        total_channels = len([c for c in guild.text_channels if ("[RP]" in c.name or (c.category and "[RP]" in c.category.name)) or ("[INFO]" in c.name or (c.category and "[INFO]" in c.category.name)) and not "[HRP]" in c.name])
+        for scene in shard.scenes_data:
+            if scene.get("source") == "live":
+                continue
+            last_msg_time = scene.get("last_time")
+            chan_id = scene.get("channel_id")
+            if last_msg_time and chan_id:
+                if chan_id not in last_processed or last_msg_time > last_processed[chan_id]:
+                    last_processed[chan_id] = last_msg_time
+
+        # Salons RP et INFO à traiter (les salons non pertinents sont ignorés)
+        channels = [(channel, channel_kind(channel)) for channel in guild.text_channels if channel_kind(channel)]
+        total_channels = len(channels)
         processed_channels = 0
 
-        # Parcourir tous les salons texte du serveur pour l'extraction
-        for channel in guild.text_channels:
+        # Mise à jour de progression (au plus toutes les 2 secondes pour ménager l'API Discord)
+        last_progress = 0.0
+
+        async def report_progress(pipeline):
+            nonlocal last_progress
+            now = time.monotonic()
+            if now - last_progress < 2:
+                return
+            last_progress = now
+            try:
+                await interaction.edit_original_response(content=(
+                    f"Indexation... salons {processed_channels}/{total_channels}, scènes {pipeline.scene_count}, "
+                    f"résumés {pipeline.summaries_done}/{pipeline.summaries_total}, "
+                    f"embeddings {pipeline.chunks_embedded}/{pipeline.chunks_total}"))
+            except:
+                pass  # Ignorer les erreurs de mise à jour
+
+        # Les scènes sont lues en flux : chacune part en résumé/embedding dès que sa fin est détectée.
+        # Plusieurs salons sont lus en parallèle ; discord.py applique les limites de débit par route
+        # (un bucket par salon) et le sémaphore borne le nombre de lectures simultanées.
+        # Chaque scène terminée est intégrée à l'index (base SQLite, FAISS, BM25) dès que les scènes qui la précèdent
+        # (salons précédents compris) le sont, puis oubliée par le pipeline : les IDs suivent l'ordre des salons. Pendant qu'un point de reprise écrit son segment (sous shard.persist_lock, dans un thread),
+        # les scènes prêtes attendent la fin de l'écriture plutôt que de bloquer la boucle d'événements.
+        committed = {"scenes": 0, "chunks": 0}
+        checkpointed = {"scenes": 0, "count": 0}
+        deferred = []  # scènes prêtes pendant l'écriture d'un point de reprise
+        saving = False
+
+        def commit_ready(ready_scenes, ready_chunks, ready_vectors):
+            if saving:
+                deferred.append((ready_scenes, ready_chunks, ready_vectors))
+                return
+            commit_new_scenes(shard, ready_scenes, ready_chunks, ready_vectors)
+            committed["scenes"] += len(ready_scenes)
+            committed["chunks"] += len(ready_chunks)
+
+        pipeline = IngestionPipeline(progress_cb=report_progress, on_ready=commit_ready,
+                                     groups=[(chan_index,) for chan_index in range(total_channels)])
+        channel_semaphore = asyncio.Semaphore(SETUP_CHANNEL_CONCURRENCY)
+
+        # Points de reprise : les scènes intégrées sont sauvegardées (segment, caches) à intervalles réguliers.
+        # Après un redémarrage, elles sont rechargées avec l'index et le /setup suivant reprend chaque salon
+        # après sa dernière scène intégrée.
+        checkpoint_stop = asyncio.Event()
+
+        async def checkpoint_loop():
+            while True:
+                try:
+                    await asyncio.wait_for(checkpoint_stop.wait(), SETUP_CHECKPOINT_SECONDS)
+                    return
+                except asyncio.TimeoutError:
+                    pass
+                nonlocal saving
+                try:
+                    with stage_timer("setup", "checkpoint"):
+                        await pipeline.flush()
+                        if committed["scenes"] == checkpointed["scenes"]:
+                            continue
+                        trim_live_buffers(shard)
+                        saved_scenes = committed["scenes"]
+                        saving = True
+                        try:
+                            await asyncio.to_thread(save_index_data, shard)
+                        finally:
+                            saving = False
+                            while deferred:
+                                commit_ready(*deferred.pop(0))
+                        checkpointed["scenes"] = saved_scenes
+                        checkpointed["count"] += 1
+                    logger.info(f"/setup du serveur {shard.guild_id} : point de reprise n°{checkpointed['count']}, "
+                                f"{checkpointed['scenes']} scène(s)/entrée(s) sauvegardée(s).")
+                except Exception as e:
+                    metrics.inc("lore_errors_total", command="setup", stage="checkpoint")
+                    logger.error(f"Échec du point de reprise de /setup du serveur {shard.guild_id}: {e}")
+
+        checkpoint_task = asyncio.create_task(checkpoint_loop()) if SETUP_CHECKPOINT_SECONDS > 0 else None
+
+        async def crawl_channel(chan_index, channel, kind):
+            nonlocal processed_channels
             chan_name = channel.name
-            cat_name = channel.category.name if channel.category else ""
-            # Identifier les salons RP et INFO à traiter
-            is_rp = "[RP]" in chan_name or (channel.category and "[RP]" in cat_name)
-            is_info = "[INFO]" in chan_name or (channel.category and "[INFO]" in cat_name)
-            is_hrp = "[HRP]" in chan_name  # salons hors-roleplay à ignorer
-            if not (is_rp or is_info) or is_hrp:
-                continue  # ignorer les salons non pertinents
-
-            # Mise à jour de progression
-            processed_channels += 1
-            if processed_channels % 5 == 0 or processed_channels == total_channels:
+
+            # Mise à jour toutes les 1000 messages pour maintenir la connexion
+            async def report_read_progress(message_count):
                 try:
-                    await interaction.edit_original_response(content=f"Traitement des salons... ({processed_channels}/{total_channels})")
+                    await interaction.edit_original_response(content=f"Lecture de #{chan_name}: {message_count} messages...")
                 except:
-                    pass  # Ignorer les erreurs de mise à jour
-            # Récupérer l'historique du salon Discord
+                    pass
+
+            # Si on a une date de dernière lecture, récupérer seulement les messages après cette date
             after_date = None
             chan_key = str(channel.id)
             if chan_key in last_processed:
@@ -430,220 +3172,48 @@ async def setup_command(interaction: discord.Interaction):
                     after_date = datetime.fromisoformat(last_processed[chan_key])
                 except:
                     after_date = None
-            messages = []
-            try:
-                message_count = 0
-                if after_date:
-                    # Si on a une date de dernière lecture, récupérer les messages après cette date
-                    async for msg in channel.history(limit=None, oldest_first=True, after=after_date):
-                        messages.append(msg)
-                        message_count += 1
-                        # Mise à jour toutes les 1000 messages pour maintenir la connexion
-                        if message_count % 1000 == 0:
-                            try:
-                                await interaction.edit_original_response(content=f"Lecture de #{chan_name}: {message_count} messages...")
-                            except:
-                                pass
-                else:
-                    # Récupérer TOUS les messages du salon pour un recensement complet
-                    async for msg in channel.history(limit=None, oldest_first=True):
-                        messages.append(msg)
-                        message_count += 1
-                        # Mise à jour toutes les 1000 messages pour maintenir la connexion
-                        if message_count % 1000 == 0:
-                            try:
-                                await interaction.edit_original_response(content=f"Lecture de #{chan_name}: {message_count} messages...")
-                            except:
-                                pass
-            except Exception as e:
-                print(f"Impossible de lire l'historique de {chan_name}: {e}")
-                continue
-            if not messages:
-                continue  # pas de nouveaux messages dans ce salon
-            if is_rp:
-                # Segmentation des messages RP en scènes
-                scene_msgs = []
-                last_msg_time = None
-                for msg in messages:
-                    # Ignorer les messages système ou du bot sans contenu pertinent
-                    if msg.author.bot and not msg.content:
-                        continue
-                    # Préparer le texte du message nettoyé
-                    content = msg.clean_content
-                    if msg.attachments:
-                        for att in msg.attachments:
-                            content += f" [Attachment: {att.url}]"
-                    # Vérifier la condition de rupture de scène (écart de temps)
-                    if scene_msgs:
-                        delta = msg.created_at - last_msg_time if last_msg_time else timedelta()
-                        if delta.total_seconds() > SCENE_BREAK_HOURS * 3600:
-                            # ** Nouvelle scène si le délai dépasse le seuil configuré **
-                            if scene_msgs:
-                                scene = create_scene_object(scene_msgs, cat_name, chan_name, channel_id=channel.id, is_info=False)
-                                new_scenes.append(scene)
-                            scene_msgs = []
-                    # Ajouter le message courant à la scène en cours
-                    if scene_msgs == []:
-                        # Marquer l'heure de début de la nouvelle scène (date du premier message)
-                        scene_start_time = msg.created_at
-                    scene_msgs.append({
-                        "id": str(msg.id),
-                        "author": {"name": msg.author.display_name, "id": str(msg.author.id)},
-                        "time": msg.created_at.isoformat(),
-                        "content": content
-                    })
-                    # Mettre à jour le dernier timestamp vu et les participants de la scène en cours
-                    last_msg_time = msg.created_at
-                # Fin de la boucle messages du salon RP - ajouter la dernière scène accumulée
-                if scene_msgs:
-                    scene = create_scene_object(scene_msgs, cat_name, chan_name, channel_id=channel.id, is_info=False)
-                    new_scenes.append(scene)
-            elif is_info:
-                # Chaque message d'un salon [INFO] est considéré comme une entrée de lore séparée
-                for msg in messages:
-                    content = msg.clean_content
-                    if msg.attachments:
-                        for att in msg.attachments:
-                            content += f" [Attachment: {att.url}]"
-                    info_entry = {
-                        "id": str(msg.id),
-                        "channel_id": str(channel.id),
-                        "title": None,
-                        "type": "info",
-                        "location": f"{clean_name(cat_name)} / {clean_name(chan_name)}" if cat_name else clean_name(chan_name),
-                        "date": msg.created_at.isoformat(),
-                        "participants": [],  # pas de participants multiples pour une info, auteur éventuel non listé
-                        "summary": None,
-                        "messages": [{
-                            "id": str(msg.id),
-                            "author": {"name": msg.author.display_name, "id": str(msg.author.id)},
-                            "time": msg.created_at.isoformat(),
-                            "content": content
-                        }]
-                    }
-                    # Générer un titre pour l'entrée d'info (ex: premières mots ou titre présent dans le contenu)
-                    info_entry["title"] = generate_info_title(content, chan_name)
-                    new_scenes.append(info_entry)
+            async with channel_semaphore:
+                try:
+                    # Messages déjà indexés en continu : ne pas les indexer une seconde fois
+                    skip_ids = shard.lore_store.live_message_ids(channel.id)
+                    # La clé (rang du salon, rang de la scène) garde l'ordre des scènes de chaque salon
+                    scene_no = 0
+                    async for scene in iter_channel_scenes(channel, kind, after_date=after_date, progress_cb=report_read_progress, skip_ids=skip_ids):
+                        await pipeline.submit(scene, order_key=(chan_index, scene_no))
+                        scene_no += 1
+                except Exception as e:
+                    metrics.inc("lore_errors_total", command="setup", stage="crawl")
+                    logger.error(f"Impossible de lire l'historique de {chan_name}: {e}")
+            processed_channels += 1
+            # Les scènes des salons suivants peuvent être intégrées une fois celles de ce salon remises
+            pipeline.close_group((chan_index,))
+
+        with stage_timer("setup", "crawl"):
+            await asyncio.gather(*(crawl_channel(chan_index, channel, kind) for chan_index, (channel, kind) in enumerate(channels)))
+
+        # Attendre la fin des résumés et des embeddings en cours (les dernières scènes sont intégrées au fil de l'eau)
+        with stage_timer("setup", "drain"):
+            await pipeline.finish()
+        # Laisser finir un point de reprise en cours (et intégrer les scènes mises de côté pendant son écriture)
+        if checkpoint_task is not None:
+            checkpoint_stop.set()
+            await checkpoint_task
         # Si aucune nouvelle scène ou entrée n'a été collectée
-        if not new_scenes:
+        if not committed["scenes"]:
+            # Sauvegarder tout de même les vecteurs de résumé complétés
+            await asyncio.to_thread(save_index_data, shard)
             await interaction.followup.send("Aucune nouvelle donnée à indexer.", ephemeral=True)
             return
 
-        # Assigner des ID uniques aux nouvelles scènes AVANT l'indexation
-        next_id = (max([s['id'] for s in scenes_data], default=0) + 1) if scenes_data else 1
-        for scene in new_scenes:
-            scene['id'] = next_id
-            next_id += 1
-        # Traiter chaque nouvelle scène/entrée
-        total_scenes = len(new_scenes)
-        processed_scenes = 0
-
-        # Mise à jour de progression
-        try:
-            await interaction.edit_original_response(content=f"Génération des résumés et indexation... (0/{total_scenes})")
-        except:
-            pass
-
-        for scene in new_scenes:
-            processed_scenes += 1
-            if scene["type"] == "rp":
-                # Générer un résumé narratif de la scène via GPT
-                transcript_text = "\n".join(f'{m["author"]["name"]}: {m["content"]}' for m in scene["messages"])
-                prompt = [
-                    {"role": "user", "content": f"Voici une scène de jeu de rôle.\n\n{transcript_text}\n\nFais un résumé narratif de cette scène en français en décrivant les événements importants et les personnages présents. Sois concis."}
-                ]
-                try:
-                    summary = await asyncio.get_running_loop().run_in_executor(None, functools.partial(ask_gpt, prompt, OPENAI_MODEL))
-                except Exception as e:
-                    summary = None
-                    print(f"Erreur lors de la génération du résumé: {e}")
-                scene["summary"] = summary if summary else ""
-                # Générer un titre à partir du résumé (ou à défaut, du nom du lieu)
-                scene["title"] = generate_scene_title(scene, default=clean_name(scene["location"]))
-            else:
-                # Type "info" (pas de résumé auto généré)
-                pass
-
-            # Créer les chunks de texte à indexer pour cette scène/entrée
-            chunks = []
-            text_to_index_list = []
-            if scene["type"] == "rp":
-                # Découper la transcription complète de la scène en morceaux de taille raisonnable
-                full_text = "\n".join(f'{m["author"]["name"]}: {m["content"]}' for m in scene["messages"])
-                current_chunk = ""
-                for line in full_text.splitlines():
-                    if len(current_chunk) + len(line) + 1 <= MAX_CHUNK_CHARS:
-                        current_chunk += line + "\n"
-                    else:
-                        if current_chunk:
-                            chunks.append(current_chunk.strip())
-                        current_chunk = line + "\n"
-                if current_chunk:
-                    chunks.append(current_chunk.strip())
-                text_to_index_list = chunks
-            else:
-                # Entrée de lore info : utiliser le contenu du message (scinder si très long)
-                info_text = scene["messages"][0]["content"]
-                if len(info_text) > MAX_CHUNK_CHARS:
-                    parts = info_text.split("\n")
-                    current_chunk = ""
-                    for part in parts:
-                        if len(current_chunk) + len(part) + 1 <= MAX_CHUNK_CHARS:
-                            current_chunk += part + "\n"
-                        else:
-                            if current_chunk:
-                                chunks.append(current_chunk.strip())
-                            current_chunk = part + "\n"
-                    if current_chunk:
-                        chunks.append(current_chunk.strip())
-                    text_to_index_list = chunks
-                else:
-                    text_to_index_list = [info_text]
-
-            # Enregistrer les chunks dans la scène (pour référence future lors du chargement)
-            if len(text_to_index_list) > 1:
-                scene["chunks"] = text_to_index_list
-            else:
-                scene["chunks"] = []
-
-            # Mise à jour de progression
-            if processed_scenes % 10 == 0 or processed_scenes == total_scenes:
-                try:
-                    await interaction.edit_original_response(content=f"Génération des résumés et indexation... ({processed_scenes}/{total_scenes})")
-                except:
-                    pass
-
-            # Calculer l'embedding de chaque chunk et l'ajouter à l'index vectoriel
-            chunk_count = 0
-            for text in text_to_index_list:
-                chunk_count += 1
-                try:
-                    emb = await asyncio.get_running_loop().run_in_executor(None, functools.partial(get_embedding, text))
-                except Exception as e:
-                    print(f"Erreur lors de l'obtention de l'embedding: {e}")
-                    continue
-                # Normaliser le vecteur d'embedding (pour l'IP index -> cos similarity)
-                norm = sum(x*x for x in emb) ** 0.5
-                vec = [x / norm for x in emb] if norm != 0 else emb
-                vec = np.array(vec, dtype='float32')
-                # Créer l'index FAISS dynamiquement si nécessaire (dimension = taille de l'embedding)
-                faiss = __import__('faiss')
-                if faiss_index is None:
-                    faiss_index = faiss.IndexFlatIP(vec.shape[0])
-                # Ajouter le vecteur normalisé à l'index FAISS
-                faiss_index.add(vec.reshape(1, -1))
-                # Enregistrer le mapping index->scene_id (+ chunk texte pour reconstruire l'extrait)
-                index_id_to_scene.append((scene['id'], text))
-
-                # Mise à jour de progression pour les embeddings (toutes les 5 embeddings)
-                if chunk_count % 5 == 0:
-                    try:
-                        await interaction.edit_original_response(content=f"Génération des embeddings... Scène {processed_scenes}/{total_scenes}, chunk {chunk_count}/{len(text_to_index_list)}")
-                    except:
-                        pass
-        # Ajouter les nouvelles scènes/entrées au corpus en mémoire
-        for scene in new_scenes:
-            scenes_data.append(scene)
+        # Les messages déjà lus par /setup ne doivent pas être réindexés par l'indexation en continu
+        trim_live_buffers(shard)
+        embed_stats = pipeline.embed_stats
+        chunk_count = committed["chunks"]
+        rate = chunk_count / embed_stats["seconds"] if embed_stats["seconds"] > 0 else 0.0
+        throughput_report = (f"{chunk_count}/{embed_stats['texts']} chunks indexés en {embed_stats['batches']} lot(s), "
+                             f"{embed_stats['seconds']:.1f}s ({rate:.1f} chunks/s, ~{embed_stats['tokens']} tokens), "
+                             f"{embed_stats['cached']} servis par le cache (cache : {embedding_cache.stats_line()})")
+        logger.info(f"Embeddings: {throughput_report}")
 
         # Mise à jour finale
         try:
@@ -652,57 +3222,172 @@ async def setup_command(interaction: discord.Interaction):
             pass
 
         # Sauvegarder l’index et les données mises à jour
-        save_index_data()
+        with stage_timer("setup", "save"):
+            await asyncio.to_thread(save_index_data, shard)
         # Répondre à l'interaction une fois terminé
-        await interaction.followup.send(f"Index du lore mis à jour avec {len(new_scenes)} nouvelle(s) scène(s)/entrée(s).", ephemeral=True)
+        checkpoint_report = f" (dont {checkpointed['scenes']} sauvegardée(s) en {checkpointed['count']} point(s) de reprise)" if checkpointed["count"] else ""
+        await interaction.followup.send(f"Index du lore mis à jour avec {committed['scenes']} nouvelle(s) scène(s)/entrée(s){checkpoint_report}.\n"
+                                        f"Embeddings : {throughput_report}", ephemeral=True)
     except Exception as e:
         # En cas d'erreur générale lors du setup
+        metrics.inc("lore_errors_total", command="setup", stage="total")
         await interaction.followup.send(f"Une erreur s'est produite pendant la construction de l'index : {e}", ephemeral=True)
+    finally:
+        # Ne pas laisser tourner les points de reprise après une erreur
+        if checkpoint_task is not None and not checkpoint_task.done():
+            checkpoint_stop.set()
+            await checkpoint_task
+        metrics.observe("lore_stage_seconds", time.perf_counter() - setup_started, command="setup", stage="total")
+        shard.indexing_lock.release()
+        shard.in_use -= 1
+    # L'index a grossi : décharger au besoin les index d'autres serveurs
+    await enforce_shard_memory_cap()
+
+# Découper un texte en messages Discord (2000 caractères max), de préférence aux sauts de ligne
+def split_discord_message(text, limit=2000):
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = limit
+        parts.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    parts.append(text)
+    return parts
+
+# Latences des réponses /lore diffusées en flux (secondes) : premier texte visible et réponse complète
+lore_answer_latency = {"first_token": deque(maxlen=500), "total": deque(maxlen=500)}
+
+# Générer la réponse /lore en flux : le message de suivi est envoyé dès le premier texte reçu puis édité au plus
+# toutes les LORE_STREAM_EDIT_SECONDS, avec une dernière édition une fois la réponse complète
+async def stream_lore_answer(interaction, prompt, model=OPENAI_MODEL):
+    start = time.perf_counter()
+    message = None
+    shown = ""
+    last_edit = 0.0
+
+    async def show(text):
+        nonlocal message, shown, last_edit
+        preview = split_discord_message(text)[0]
+        if message is None:
+            message = await interaction.followup.send(preview, wait=True)
+            lore_answer_latency["first_token"].append(time.perf_counter() - start)
+            metrics.observe("lore_stage_seconds", lore_answer_latency["first_token"][-1], command="lore", stage="first_token")
+        else:
+            await message.edit(content=preview)
+        shown = preview
+        last_edit = time.monotonic()
+
+    async def on_delta(text):
+        if message is None or time.monotonic() - last_edit >= LORE_STREAM_EDIT_SECONDS:
+            try:
+                await show(text)
+            except discord.HTTPException as e:
+                # Édition refusée (limite de débit...) : la prochaine ou la dernière édition rattrapera
+                logger.warning(f"Édition de la réponse en cours impossible: {e}")
+
+    answer = await stream_gpt_async(prompt, model, on_delta=on_delta, interactive=True)
+    parts = split_discord_message(answer or "Désolé, aucune réponse n'a pu être générée.")
+    if message is None:
+        await show(parts[0])
+    elif shown != parts[0]:
+        await message.edit(content=parts[0])
+    # Réponse plus longue qu'un message Discord : la suite dans des messages séparés
+    for part in parts[1:]:
+        await interaction.followup.send(part)
+    total = time.perf_counter() - start
+    lore_answer_latency["total"].append(total)
+    logger.info(f"Réponse /lore diffusée : premier texte après {lore_answer_latency['first_token'][-1]:.2f}s, complète après {total:.2f}s.")
+    return answer
+
+# Envoyer une réponse /lore (texte, éphémère), en plusieurs messages de 2000 caractères max si besoin
+async def send_lore_reply(interaction, reply):
+    text, ephemeral = reply
+    for part in split_discord_message(text):
+        await interaction.followup.send(part, ephemeral=ephemeral)
+
+# Requête /lore en cours sur la même version de l'index dont la question est presque identique
+# (similarité >= ANSWER_CACHE_SIMILARITY), renvoie la future de sa réponse ou None
+def find_similar_inflight(shard, vector):
+    for (_, version), entry in shard.lore_inflight.items():
+        if version == shard.version and entry["vector"] is not None and float(np.dot(entry["vector"], vector)) >= ANSWER_CACHE_SIMILARITY:
+            return entry["outcome"]
+    return None
 
 # Commande slash /lore pour poser une question sur le lore
 @tree.command(name="lore", description="Pose une question sur le lore du serveur", guild=discord.Object(id=int(DISCORD_GUILD_ID)) if DISCORD_GUILD_ID else None)
 @app_commands.describe(question="Votre question sur le lore")
 async def lore_command(interaction: discord.Interaction, question: str):
     await interaction.response.defer(thinking=True)
-    # Vérifier que l'index du lore est disponible
-    if faiss_index is None or not scenes_data:
-        await interaction.followup.send("Le lore n'est pas encore indexé. Veuillez exécuter /setup d'abord.", ephemeral=True)
+    if interaction.guild_id is None:
+        await interaction.followup.send("Cette commande s'utilise sur un serveur.", ephemeral=True)
         return
+    # Index de ce serveur (il ne peut pas être déchargé pendant la commande)
+    shard = get_shard(interaction.guild_id)
+    shard.in_use += 1
+    lore_started = time.perf_counter()
+    inflight = None  # calcul en cours de cette requête, partagé avec les requêtes identiques
+    reply = ("Désolé, aucune réponse n'a pu être générée.", True)  # (texte, éphémère) transmis aux requêtes rattachées
     try:
-        # Obtenir l'embedding de la question utilisateur
-        query_emb = await asyncio.get_running_loop().run_in_executor(None, functools.partial(get_embedding, question))
-        norm = sum(x*x for x in query_emb) ** 0.5
-        query_vec = [x / norm for x in query_emb] if norm != 0 else query_emb
-        query_vec = np.array(query_vec, dtype='float32').reshape(1, -1)
-        # Rechercher les vecteurs les plus similaires dans l'index
-        k = 3  # nombre maximum d'extraits pertinents à récupérer
-        faiss = __import__('faiss')
-        distances, indices = faiss_index.search(query_vec, k)
-        relevant_excerpts = []
-        used_scene_ids = set()
-        total_chars = 0
-        for idx in indices[0]:
-            if idx == -1:
-                continue
-            scene_id, chunk_text = index_id_to_scene[idx]
-            scene = next((s for s in scenes_data if s["id"] == scene_id), None)
-            if not scene or scene_id in used_scene_ids:
-                continue
-            used_scene_ids.add(scene_id)
-            # Préparer l'extrait de texte correspondant
-            if chunk_text:
-                excerpt_text = chunk_text
-            else:
-                excerpt_text = "\n".join(f'{m["author"]["name"]}: {m["content"]}' for m in scene["messages"])
-            # Étiqueter l'extrait pour contexte (scène ou info)
-            label = f"Scène: {scene.get('title', '(sans titre)')}" if scene["type"] == "rp" else f"Info: {scene.get('title', '(sans titre)')}"
-            excerpt = f"{label}\n{excerpt_text}"
-            relevant_excerpts.append(excerpt)
-            total_chars += len(excerpt)
-            if total_chars > 8000:
-                break  # limiter la taille totale du contexte envoyé à GPT
+        # L'index est encore en cours de chargement
+        with stage_timer("lore", "index_wait"):
+            index_ready = await ensure_shard_loaded(shard, LORE_SHARD_LOAD_WAIT_SECONDS)
+        if not index_ready:
+            await interaction.followup.send(f"Le lore est en cours de chargement ({shard.load_status.describe()}). Réessayez dans quelques instants.", ephemeral=True)
+            return
+        # Vérifier que l'index du lore est disponible
+        if shard.faiss_index is None or not shard.scenes_data:
+            await interaction.followup.send("Le lore n'est pas encore indexé. Veuillez exécuter /setup d'abord.", ephemeral=True)
+            return
+        # Réponse déjà connue pour la même question (normalisée) : aucun appel OpenAI
+        question_key = normalize_question(question)
+        cached_answer = shard.answer_cache.get(question_key)
+        if cached_answer:
+            # Une réponse diffusée peut dépasser 2000 caractères : l'envoyer en plusieurs messages
+            await send_lore_reply(interaction, (cached_answer, False))
+            return
+        # Même question déjà en cours de traitement sur le même index : attendre sa réponse plutôt que la recalculer
+        inflight_key = (question_key, shard.version)
+        pending = shard.lore_inflight.get(inflight_key)
+        if pending is not None:
+            metrics.inc("lore_coalesced_requests_total", match="exact")
+            await send_lore_reply(interaction, await asyncio.shield(pending["outcome"]))
+            return
+        inflight = shard.lore_inflight[inflight_key] = {"outcome": asyncio.get_running_loop().create_future(), "vector": None}
+        # Recherche lexicale pendant le calcul de l'embedding de la question (repli si l'appel échoue ou traîne)
+        embedding_started = time.perf_counter()
+        embedding_task = asyncio.ensure_future(get_cached_embedding(question))
+        with stage_timer("lore", "lexical_search"):
+            lexical_hits = shard.lexical_index.search(question, LORE_HYBRID_CANDIDATES)
+        try:
+            query_vec = (await asyncio.wait_for(embedding_task, LORE_EMBED_TIMEOUT_SECONDS)).reshape(1, -1)
+            metrics.observe("lore_stage_seconds", time.perf_counter() - embedding_started, command="lore", stage="embedding")
+        except Exception as e:
+            metrics.inc("lore_errors_total", command="lore", stage="embedding")
+            logger.warning(f"Embedding de la question indisponible ({e!r}) : recherche lexicale seule.")
+            query_vec = None
+        # Question formulée différemment mais équivalente : réutiliser la réponse en cache
+        if query_vec is not None:
+            cached_answer = shard.answer_cache.get_similar(query_vec[0])
+            if cached_answer:
+                reply = (cached_answer, False)
+                await send_lore_reply(interaction, reply)
+                return
+            # Question équivalente en cours de traitement : partager sa réponse
+            similar = find_similar_inflight(shard, query_vec[0])
+            inflight["vector"] = query_vec[0]
+            if similar is not None:
+                metrics.inc("lore_coalesced_requests_total", match="similar")
+                reply = await asyncio.shield(similar)
+                await send_lore_reply(interaction, reply)
+                return
+        # Classement hybride (vectoriel + BM25) des chunks pertinents, puis sélection sous budget de tokens
+        ranked = hybrid_rank(shard, query_vec, lexical_hits, LORE_HYBRID_CANDIDATES)
+        with stage_timer("lore", "context"):
+            relevant_excerpts = pack_lore_context(shard, ranked, OPENAI_MODEL)
         if not relevant_excerpts:
-            await interaction.followup.send("Aucune information du lore trouvée pour répondre à la question.", ephemeral=True)
+            reply = ("Aucune information du lore trouvée pour répondre à la question.", True)
+            await send_lore_reply(interaction, reply)
             return
         # Préparer le message de contexte pour GPT
         lore_context = "\n\n".join(relevant_excerpts)
@@ -710,23 +3395,148 @@ async def lore_command(interaction: discord.Interaction, question: str):
             {"role": "system", "content": "Tu es un assistant expert du lore de notre jeu de rôle. Réponds aux questions en utilisant uniquement les informations fournies dans le contexte. Ne fais aucune supposition en dehors du contenu donné. Si une information manque pour répondre, indique que tu ne sais pas."},
             {"role": "user", "content": f"Contexte du lore :\n{lore_context}\n\nQuestion : {question}\n\nRéponds en utilisant uniquement le contexte ci-dessus."}
         ]
-        # Obtenir la réponse de GPT
-        answer = await asyncio.get_running_loop().run_in_executor(None, functools.partial(ask_gpt, prompt, OPENAI_MODEL))
+        # Obtenir la réponse de GPT (affichée au fil de sa génération si LORE_STREAM_ANSWERS)
+        with stage_timer("lore", "generation"):
+            if LORE_STREAM_ANSWERS:
+                answer = await stream_lore_answer(interaction, prompt, OPENAI_MODEL)
+            else:
+                answer = await ask_gpt_async(prompt, OPENAI_MODEL, interactive=True)
+        reply = (answer or "Désolé, aucune réponse n'a pu être générée.", False)
+        # Les réponses obtenues sans recherche vectorielle (mode dégradé) ne sont pas mises en cache
+        if answer and query_vec is not None:
+            shard.answer_cache.put(question_key, query_vec[0], answer)
         # Envoyer la réponse dans le canal Discord
-        await interaction.followup.send(answer)
+        if not LORE_STREAM_ANSWERS:
+            await send_lore_reply(interaction, reply)
     except Exception as e:
-        await interaction.followup.send(f"Désolé, une erreur est survenue pendant la recherche de la réponse : {e}", ephemeral=True)
+        metrics.inc("lore_errors_total", command="lore", stage="total")
+        reply = (f"Désolé, une erreur est survenue pendant la recherche de la réponse : {e}", True)
+        await send_lore_reply(interaction, reply)
+    finally:
+        # Transmettre la réponse aux requêtes identiques rattachées à celle-ci
+        if inflight is not None:
+            if shard.lore_inflight.get(inflight_key) is inflight:
+                del shard.lore_inflight[inflight_key]
+            inflight["outcome"].set_result(reply)
+        metrics.observe("lore_stage_seconds", time.perf_counter() - lore_started, command="lore", stage="total")
+        shard.in_use -= 1
+
+# Commande slash /lorestats : files de travail et limites OpenAI (administrateurs)
+@tree.command(name="lorestats", description="Files d'attente et limites OpenAI du bot (administrateurs)", guild=discord.Object(id=int(DISCORD_GUILD_ID)) if DISCORD_GUILD_ID else None)
+async def lorestats_command(interaction: discord.Interaction):
+    if not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("Désolé, vous n'avez pas la permission d'utiliser cette commande.", ephemeral=True)
+        return
+    lines = ["**Threads des appels OpenAI**"]
+    for pool, label in (("interactive", "interactif (/lore)"), ("batch", "fond (/setup, indexation)")):
+        waits = list(work_scheduler.wait_times[pool])
+        lines.append(f"{label} : {work_scheduler.queued[pool]} en attente, {work_scheduler.running[pool]}/{work_scheduler.workers[pool]} en cours, "
+                     f"{work_scheduler.completed[pool]} terminés, attente p50 {percentile(waits, 0.5) * 1000:.0f} ms / p95 {percentile(waits, 0.95) * 1000:.0f} ms")
+    lines.append("**Limites de débit OpenAI**")
+    for limiter in (chat_limiter, embed_limiter):
+        requests, tokens = limiter.available()
+        queues = ", ".join(f"{label} {limiter.waiting[interactive]} en attente (p95 {percentile(list(limiter.wait_times[interactive]), 0.95):.1f}s)"
+                           for interactive, label in ((True, "interactif"), (False, "fond")))
+        lines.append(f"{limiter.name} : {queues} ; budget {requests:.0f}/{limiter.rpm} requêtes, {tokens:.0f}/{limiter.tpm} tokens")
+    first_tokens = list(lore_answer_latency["first_token"])
+    if first_tokens:
+        lines.append(f"**/lore** : premier texte p50 {percentile(first_tokens, 0.5):.2f}s / p95 {percentile(first_tokens, 0.95):.2f}s")
+    await interaction.response.send_message("\n".join(lines), ephemeral=True)
+
+# Déterminer le type d'un salon à indexer : "rp", "info" ou None (salon ignoré)
+def channel_kind(channel):
+    chan_name = channel.name
+    cat_name = channel.category.name if channel.category else ""
+    is_rp = "[RP]" in chan_name or "[RP]" in cat_name
+    is_info = "[INFO]" in chan_name or "[INFO]" in cat_name
+    is_hrp = "[HRP]" in chan_name  # salons hors-roleplay à ignorer
+    if not (is_rp or is_info) or is_hrp:
+        return None
+    return "rp" if is_rp else "info"
+
+# Convertir un message Discord en enregistrement compact (texte nettoyé + pièces jointes)
+def message_record(msg):
+    content = msg.clean_content
+    if msg.attachments:
+        for att in msg.attachments:
+            content += f" [Attachment: {att.url}]"
+    return {
+        "id": str(msg.id),
+        "author": {"name": msg.author.display_name, "id": str(msg.author.id)},
+        "time": msg.created_at.isoformat(),
+        "content": content
+    }
+
+# Lire l'historique d'un salon en flux, du plus ancien au plus récent (sans tout garder en mémoire)
+# (les messages dont l'ID est dans skip_ids sont ignorés)
+async def iter_channel_history(channel, after_date=None, progress_cb=None, skip_ids=()):
+    message_count = 0
+    async for msg in channel.history(limit=None, oldest_first=True, after=after_date):
+        message_count += 1
+        if progress_cb and message_count % 1000 == 0:
+            await progress_cb(message_count)
+        if str(msg.id) in skip_ids:
+            continue
+        yield msg
+
+# Segmenter un flux de messages RP en scènes : une scène est émise dès que la rupture suivante est vue
+async def iter_rp_scenes(messages, category_name, channel_name, channel_id=None):
+    scene_msgs = []
+    last_msg_time = None
+    async for msg in messages:
+        # Ignorer les messages système ou du bot sans contenu pertinent
+        if msg.author.bot and not msg.content:
+            continue
+        # Vérifier la condition de rupture de scène (écart de temps)
+        if scene_msgs and last_msg_time:
+            delta = msg.created_at - last_msg_time
+            if delta.total_seconds() > SCENE_BREAK_HOURS * 3600:
+                # ** Nouvelle scène si le délai dépasse le seuil configuré **
+                yield create_scene_object(scene_msgs, category_name, channel_name, channel_id=channel_id, is_info=False)
+                scene_msgs = []
+        # Ajouter le message courant à la scène en cours
+        scene_msgs.append(message_record(msg))
+        last_msg_time = msg.created_at
+    # Fin du flux - émettre la dernière scène accumulée
+    if scene_msgs:
+        yield create_scene_object(scene_msgs, category_name, channel_name, channel_id=channel_id, is_info=False)
+
+# Flux des scènes (salon RP) ou entrées de lore (salon INFO) d'un salon
+async def iter_channel_scenes(channel, kind, after_date=None, progress_cb=None, skip_ids=()):
+    cat_name = channel.category.name if channel.category else ""
+    messages = iter_channel_history(channel, after_date=after_date, progress_cb=progress_cb, skip_ids=skip_ids)
+    if kind == "rp":
+        async for scene in iter_rp_scenes(messages, cat_name, channel.name, channel_id=channel.id):
+            yield scene
+    else:
+        # Chaque message d'un salon [INFO] est considéré comme une entrée de lore séparée
+        async for msg in messages:
+            yield create_info_entry(msg, cat_name, channel.name, channel_id=channel.id)
+
+# Fonction utilitaire pour créer une entrée de lore info à partir d'un message d'un salon [INFO]
+def create_info_entry(msg, category_name, channel_name, channel_id=None):
+    return info_entry_from_record(message_record(msg), category_name, channel_name, channel_id=channel_id)
+
+# Créer une entrée de lore info à partir d'un message déjà converti (voir message_record)
+def info_entry_from_record(record, category_name, channel_name, channel_id=None):
+    info_entry = {
+        "id": record["id"],
+        "channel_id": str(channel_id) if channel_id else None,
+        "title": None,
+        "type": "info",
+        "location": f"{clean_name(category_name)} / {clean_name(channel_name)}" if category_name else clean_name(channel_name),
+        "date": record["time"],
+        "participants": [],  # pas de participants multiples pour une info, auteur éventuel non listé
+        "summary": None,
+        "messages": [record]
+    }
+    # Générer un titre pour l'entrée d'info (ex: premières mots ou titre présent dans le contenu)
+    info_entry["title"] = generate_info_title(record["content"], channel_name)
+    return info_entry
 
 # Fonction utilitaire pour créer un objet de scène RP à partir d'une liste de messages
 def create_scene_object(messages, category_name, channel_name, channel_id=None, is_info=False):
-    # Construire la liste des participants (auteurs uniques)
-    participants = []
-    seen_ids = set()
-    for m in messages:
-        uid = m["author"]["id"]
-        if uid not in seen_ids:
-            seen_ids.add(uid)
-            participants.append({"name": m["author"]["name"], "id": uid})
+    participants = scene_participants(messages)
     location = f"{clean_name(category_name)} / {clean_name(channel_name)}" if category_name else clean_name(channel_name)
     scene_obj = {
         "id": None,
@@ -741,6 +3551,17 @@ def create_scene_object(messages, category_name, channel_name, channel_id=None,
     }
     return scene_obj
 
+# Construire la liste des participants d'une scène (auteurs uniques, par ordre d'apparition)
+def scene_participants(messages):
+    participants = []
+    seen_ids = set()
+    for m in messages:
+        uid = m["author"]["id"]
+        if uid not in seen_ids:
+            seen_ids.add(uid)
+            participants.append({"name": m["author"]["name"], "id": uid})
+    return participants
+
 # Générer un titre pour une scène RP à partir de son résumé ou de son lieu par défaut
 def generate_scene_title(scene, default="Scène RP"):
     title = ""
@@ -781,6 +3602,290 @@ def generate_info_title(content, channel_name):
         title = clean_name(channel_name)
     return title
 
+# Indexation en continu : les messages des salons [RP]/[INFO] sont regroupés par salon avec la même règle de
+# rupture de scène que /setup (SCENE_BREAK_HOURS) ; les scènes closes sont résumées et vectorisées par petits lots.
+# Les tampons sont propres à chaque serveur (LoreShard) et conservés quand son index est déchargé.
+
+# Clore la scène RP en cours d'un salon et la mettre en attente d'indexation
+def close_live_scene(shard, channel_id):
+    buffer = shard.live_buffers.pop(channel_id, None)
+    if buffer and buffer["messages"]:
+        shard.live_pending.append((channel_id, "rp", buffer["category"], buffer["name"], buffer["messages"]))
+
+# Ajouter un nouveau message au tampon de son salon
+def buffer_live_message(shard, msg, kind):
+    channel = msg.channel
+    cat_name = channel.category.name if channel.category else ""
+    record = message_record(msg)
+    if kind == "info":
+        # Chaque message d'un salon [INFO] est une entrée de lore séparée
+        shard.live_pending.append((channel.id, "info", cat_name, channel.name, [record]))
+        return
+    buffer = shard.live_buffers.get(channel.id)
+    if buffer and (msg.created_at - buffer["last_time"]).total_seconds() > SCENE_BREAK_HOURS * 3600:
+        close_live_scene(shard, channel.id)
+        buffer = None
+    if buffer is None:
+        buffer = shard.live_buffers[channel.id] = {"category": cat_name, "name": channel.name, "messages": [], "last_time": None}
+    buffer["messages"].append(record)
+    buffer["last_time"] = msg.created_at
+
+# Retirer des tampons les messages déjà indexés (par /setup) : tout ce qui précède la dernière date connue du salon
+def trim_live_buffers(shard):
+    last_processed = {}
+    for scene in shard.scenes_data:
+        if scene.get("last_time") and scene.get("channel_id"):
+            last_processed[scene["channel_id"]] = max(last_processed.get(scene["channel_id"], ""), scene["last_time"])
+    for channel_id in list(shard.live_buffers):
+        watermark = last_processed.get(str(channel_id), "")
+        buffer = shard.live_buffers[channel_id]
+        buffer["messages"] = [m for m in buffer["messages"] if m["time"] > watermark]
+        if not buffer["messages"]:
+            del shard.live_buffers[channel_id]
+    kept = []
+    for channel_id, kind, cat_name, chan_name, messages in shard.live_pending:
+        watermark = last_processed.get(str(channel_id), "")
+        messages = [m for m in messages if m["time"] > watermark]
+        if messages:
+            kept.append((channel_id, kind, cat_name, chan_name, messages))
+    shard.live_pending[:] = kept
+
+# Indexer un lot de scènes closes (les scènes RP inactives depuis SCENE_BREAK_HOURS sont closes au passage)
+async def flush_live_index(shard):
+    if not shard.loaded or shard.indexing_lock.locked():
+        return
+    async with shard.indexing_lock:
+        now = discord.utils.utcnow()
+        for channel_id in [cid for cid, buffer in shard.live_buffers.items()
+                           if (now - buffer["last_time"]).total_seconds() > SCENE_BREAK_HOURS * 3600]:
+            close_live_scene(shard, channel_id)
+        if shard.live_pending:
+            batch = shard.live_pending[:LIVE_INDEX_BATCH_SCENES]
+            del shard.live_pending[:len(batch)]
+            try:
+                pipeline = IngestionPipeline(command="live")
+                for position, (channel_id, kind, cat_name, chan_name, messages) in enumerate(batch):
+                    if kind == "rp":
+                        scene = create_scene_object(messages, cat_name, chan_name, channel_id=channel_id, is_info=False)
+                    else:
+                        scene = info_entry_from_record(messages[0], cat_name, chan_name, channel_id=channel_id)
+                    scene["source"] = "live"
+                    await pipeline.submit(scene, order_key=(position,))
+                new_scenes, indexed_chunks, vectors = await pipeline.finish()
+                with stage_timer("live", "commit"):
+                    commit_new_scenes(shard, new_scenes, indexed_chunks, vectors)
+            except Exception as e:
+                metrics.inc("lore_errors_total", command="live", stage="total")
+                # Remettre le lot en tête de file pour le prochain passage
+                shard.live_pending[:0] = batch
+                logger.error(f"Échec de l'indexation en continu du serveur {shard.guild_id}: {e}")
+                return
+            logger.info(f"Indexation en continu du serveur {shard.guild_id} : {len(new_scenes)} scène(s)/entrée(s), {len(indexed_chunks)} chunks "
+                        f"({len(shard.live_pending)} en attente).")
+        await save_live_index_if_due(shard)
+
+# Sauvegarder les modifications en continu : les segments sont espacés pour ne pas déclencher trop de compactions
+# (écriture dans un thread, comme les points de reprise de /setup)
+async def save_live_index_if_due(shard):
+    if any(shard.pending_delta.values()) and time.monotonic() - shard.live_last_save >= LIVE_INDEX_SAVE_SECONDS:
+        shard.live_last_save = time.monotonic()
+        await asyncio.to_thread(save_index_data, shard)
+
+# Scènes closes en attente d'indexation (ou scènes RP inactives depuis SCENE_BREAK_HOURS) ?
+def has_closed_live_scenes(shard):
+    now = discord.utils.utcnow()
+    return bool(shard.live_pending) or any((now - buffer["last_time"]).total_seconds() > SCENE_BREAK_HOURS * 3600
+                                           for buffer in shard.live_buffers.values())
+
+# Boucle d'indexation en continu (lancée au démarrage si LIVE_INDEXING), pour chaque serveur
+async def live_indexer_loop():
+    while True:
+        await asyncio.sleep(LIVE_INDEX_INTERVAL_SECONDS)
+        for shard in list(lore_shards.values()):
+            try:
+                if shard.loaded:
+                    await flush_live_index(shard)
+                elif has_closed_live_scenes(shard):
+                    # Index déchargé : le recharger, ses scènes seront indexées au prochain passage
+                    await ensure_shard_loaded(shard)
+            except Exception as e:
+                logger.error(f"Erreur de l'indexation en continu du serveur {shard.guild_id}: {e}")
+
+@bot.event
+async def on_message(message):
+    # Seuls les nouveaux messages des salons [RP]/[INFO] du serveur indexé sont pris en compte
+    if not LIVE_INDEXING or message.guild is None or message.author == bot.user:
+        return
+    if DISCORD_GUILD_ID and message.guild.id != int(DISCORD_GUILD_ID):
+        return
+    kind = channel_kind(message.channel)
+    if kind is None or (message.author.bot and not message.content):
+        return
+    buffer_live_message(get_shard(message.guild.id), message, kind)
+
+# Modifier (content) ou supprimer (content None) un message encore dans les tampons d'indexation en continu,
+# renvoie False s'il n'y figure pas
+def update_live_message(shard, message_id, content):
+    message_id = str(message_id)
+    for messages in [buffer["messages"] for buffer in shard.live_buffers.values()] + [item[4] for item in shard.live_pending]:
+        for position, record in enumerate(messages):
+            if record["id"] == message_id:
+                if content is None:
+                    del messages[position]
+                    # Ne pas garder de scène vide en attente
+                    shard.live_pending[:] = [item for item in shard.live_pending if item[4]]
+                    for channel_id in [cid for cid, buffer in shard.live_buffers.items() if not buffer["messages"]]:
+                        del shard.live_buffers[channel_id]
+                else:
+                    record["content"] = content
+                return True
+    return False
+
+# Réindexer une scène après modification ou suppression de ses messages : seuls les chunks dont le texte a
+# changé sont revectorisés (nouvel ID de vecteur, l'ancien est retiré de l'index)
+async def refresh_scene(shard, scene_id):
+    scene = shard.scenes_by_id.get(scene_id)
+    if scene is None:
+        return
+    messages = shard.lore_store.get_messages(scene_id)
+    old_chunks = shard.lore_store.get_scene_chunks(scene_id)
+    if not messages:
+        # Plus aucun message : la scène/entrée disparaît de l'index
+        with shard.persist_lock:
+            removed_vectors = [vector_id for vector_id, _, _ in old_chunks]
+            remove_index_chunks(shard, removed_vectors)
+            shard.lore_store.delete_scene(scene_id)
+            record_index_delta(shard, [], [], None, removed_vectors=removed_vectors, removed_scenes=[scene_id])
+        shard.unregister_scene(scene_id)
+        shard.bump_version()
+        logger.info(f"Scène {scene_id} supprimée de l'index (plus aucun message).")
+        await save_live_index_if_due(shard)
+        return
+
+    updated = dict(scene, messages=messages, date=messages[0]["time"], participants=scene_participants(messages))
+    if updated["type"] == "rp":
+        await summarize_scene(updated)
+    else:
+        updated["title"] = generate_info_title(messages[0]["content"], updated.get("location") or "")
+    chunk_texts = build_scene_chunks(updated)
+    old_texts = {chunk_no: text for _, chunk_no, text in old_chunks}
+    changed = [(chunk_no, text) for chunk_no, text in enumerate(chunk_texts) if old_texts.get(chunk_no) != text]
+    removed_vectors = [vector_id for vector_id, chunk_no, text in old_chunks
+                       if chunk_no >= len(chunk_texts) or chunk_texts[chunk_no] != text]
+    vectors, ok_positions, _ = await embed_texts([text for _, text in changed])
+    if len(ok_positions) < len(changed):
+        # Ne pas laisser la scène à moitié indexée : réessayer plus tard
+        logger.error(f"Réindexation de la scène {scene_id} incomplète (embeddings en échec), nouvel essai prévu.")
+        schedule_scene_refresh(shard, scene_id)
+        return
+    # Vecteur de résumé : résumé régénéré (scène RP), sinon premier chunk s'il a changé
+    summary_rows = []
+    if updated["type"] == "rp" and updated.get("summary"):
+        summary_matrix, summary_ok, _ = await embed_texts([updated["summary"]])
+        if summary_ok:
+            summary_rows = [(scene_id, summary_matrix[0])]
+    elif changed and changed[0][0] == 0:
+        summary_rows = [(scene_id, vectors[0])]
+    with shard.persist_lock:
+        shard.lore_store.add_scene(updated)
+        remove_index_chunks(shard, removed_vectors)
+        chunk_rows = add_index_chunks(shard, [(scene_id, chunk_no, text) for chunk_no, text in changed], vectors)
+        add_scene_summaries(shard, summary_rows)
+        record_index_delta(shard, [updated], chunk_rows, vectors, removed_vectors=removed_vectors, summaries=summary_rows)
+    # Mettre à jour les métadonnées en place (partagées par scenes_data et scenes_by_id)
+    scene.update(scene_metadata(updated))
+    shard.bump_version()
+    logger.info(f"Scène {scene_id} réindexée ({len(changed)} chunk(s) revectorisé(s), {len(removed_vectors)} retiré(s)).")
+    await save_live_index_if_due(shard)
+
+# Réindexations de scènes différées : une rafale de modifications ne coûte qu'un résumé et un lot d'embeddings
+# (échéances dans LoreShard.refresh_deadlines)
+scene_refresh_tasks = set()
+
+# Programmer (ou repousser) la réindexation d'une scène à LORE_EDIT_DEBOUNCE_SECONDS après la dernière modification
+def schedule_scene_refresh(shard, scene_id):
+    already_scheduled = scene_id in shard.refresh_deadlines
+    shard.refresh_deadlines[scene_id] = time.monotonic() + LORE_EDIT_DEBOUNCE_SECONDS
+    if not already_scheduled:
+        task = asyncio.create_task(run_scene_refresh(shard, scene_id))
+        scene_refresh_tasks.add(task)
+        task.add_done_callback(scene_refresh_tasks.discard)
+
+async def run_scene_refresh(shard, scene_id):
+    while True:
+        delay = shard.refresh_deadlines[scene_id] - time.monotonic()
+        if delay <= 0:
+            break
+        await asyncio.sleep(delay)
+    async with shard.indexing_lock:
+        # Les modifications reçues pendant la réindexation en programment une nouvelle
+        del shard.refresh_deadlines[scene_id]
+        try:
+            with stage_timer("refresh", "total"):
+                await refresh_scene(shard, scene_id)
+        except Exception as e:
+            logger.error(f"Erreur lors de la réindexation de la scène {scene_id}: {e}")
+
+# L'événement brut concerne-t-il un serveur indexé ?
+def tracks_raw_event(payload):
+    if not LIVE_INDEXING or payload.guild_id is None:
+        return False
+    return not DISCORD_GUILD_ID or payload.guild_id == int(DISCORD_GUILD_ID)
+
+# Message modifié ou supprimé : tampon d'indexation en continu, sinon scène indexée (index message -> scène)
+def handle_message_change(shard, message_id, content):
+    if update_live_message(shard, message_id, content):
+        return
+    if not shard.loaded:
+        # Index pas encore ouvert, en cours de chargement ou déchargé : la modification sera appliquée à son chargement
+        shard.pending_changes[message_id] = content
+        return
+    found = shard.lore_store.find_message_scene(message_id)
+    if found is None:
+        return
+    scene_id, old_content = found
+    if content == old_content:
+        return  # aperçu de lien ajouté par Discord, texte inchangé
+    with shard.persist_lock:
+        if content is None:
+            shard.lore_store.delete_message(message_id)
+        else:
+            shard.lore_store.update_message(message_id, content)
+    schedule_scene_refresh(shard, scene_id)
+
+# Salon et nouveau texte (au format de message_record) d'un message modifié : payload.message n'existe qu'à partir
+# de discord.py 2.5, sinon le texte est lu dans les données brutes de l'événement (payload.cached_message est
+# l'ancienne version). (None, None) si la modification ne porte pas sur le texte.
+def edited_message_content(payload):
+    message = getattr(payload, "message", None)
+    if message is not None:
+        return message.channel, message_record(message)["content"]
+    if "content" not in payload.data:
+        return None, None
+    content = payload.data["content"] + "".join(f" [Attachment: {att['url']}]" for att in payload.data.get("attachments", []))
+    return bot.get_channel(payload.channel_id), content
+
+@bot.event
+async def on_raw_message_edit(payload):
+    if not tracks_raw_event(payload):
+        return
+    channel, content = edited_message_content(payload)
+    if channel is None or channel_kind(channel) is None:
+        return
+    handle_message_change(get_shard(payload.guild_id), payload.message_id, content)
+
+@bot.event
+async def on_raw_message_delete(payload):
+    if tracks_raw_event(payload):
+        handle_message_change(get_shard(payload.guild_id), payload.message_id, None)
+
+@bot.event
+async def on_raw_bulk_message_delete(payload):
+    if tracks_raw_event(payload):
+        shard = get_shard(payload.guild_id)
+        for message_id in payload.message_ids:
+            handle_message_change(shard, message_id, None)
+
 @bot.event
 async def on_ready():
     # Synchroniser les commandes slash (guilde spécifique si ID fourni, sinon global)
@@ -875,9 +3980,17 @@ async def start_bot_with_retry():
 async def main():
     """Fonction principale avec gestion des sessions et cleanup"""
     try:
-        # Charger l'index existant au démarrage si possible
-        logger.info("Chargement de l'index au démarrage...")
-        load_index_data()
+        # Charger l'index existant en arrière-plan : la connexion à Discord n'attend pas
+        # (les index des autres serveurs sont chargés à leur premier /lore ou /setup)
+        if LORE_LEGACY_GUILD_ID:
+            logger.info("Chargement de l'index au démarrage (en arrière-plan)...")
+            await ensure_shard_loaded(get_shard(int(LORE_LEGACY_GUILD_ID)))
+        # Charger le tokenizer du modèle dans un thread (vocabulaire téléchargé à la première utilisation) :
+        # le premier /lore ne le charge pas sur la boucle d'événements
+        bot.encoding_loader = asyncio.create_task(asyncio.to_thread(model_encoding, OPENAI_MODEL))
+        # Indexer en continu les nouveaux messages RP/INFO
+        # (référence gardée sur le bot : asyncio ne conserve qu'une référence faible aux tâches)
+        bot.live_indexer = asyncio.create_task(live_indexer_loop()) if LIVE_INDEXING else None
 
         # Démarrer le bot
         await start_bot_with_retry()
@@ -888,6 +4001,19 @@ async def main():
         import traceback
         traceback.print_exc()
     finally:
+        # Sauvegarder les scènes indexées en continu depuis le dernier segment
+        for shard in list(lore_shards.values()):
+            try:
+                if shard.loaded:
+                    await asyncio.to_thread(save_index_data, shard)
+            except Exception as e:
+                logger.error(f"Échec de la sauvegarde de l'index du serveur {shard.guild_id}: {e}")
+        # Conserver les embeddings calculés pour les questions /lore depuis la dernière sauvegarde
+        try:
+            embedding_cache.save()
+            summary_cache.save()
+        except Exception as e:
+            logger.error(f"Échec de la sauvegarde des caches d'embeddings et de résumés: {e}")
         logger.info("Bot arrêté.")
 
 # Démarrer le bot avec gestion d'erreurs
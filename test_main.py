@@ -0,0 +1,689 @@
+#!/usr/bin/env python3
+"""
+Offline unit tests for the lore bot helpers (no Discord or OpenAI access)
+"""
+
+import asyncio
+import json
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+import main
+
+
+@pytest.fixture
+def shard(monkeypatch, tmp_path):
+    """Empty guild index in a temporary directory, without Google Drive"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(main, "get_drive_service", lambda: None)
+    monkeypatch.setattr(main, "embedding_cache", main.EmbeddingCache(str(tmp_path / "embedding_cache.npz"), 16))
+    monkeypatch.setattr(main, "summary_cache", main.SummaryCache(str(tmp_path / "summary_cache.json"), 100))
+    guild_shard = main.LoreShard(4242)
+    main.load_index_data(guild_shard)
+    yield guild_shard
+    guild_shard.close_store()
+
+
+def info_entry(message_id, content, channel_id=900):
+    record = {"id": str(message_id), "author": {"name": "MJ", "id": "1"}, "time": f"2024-01-01T00:00:{message_id % 60:02d}+00:00", "content": content}
+    return main.info_entry_from_record(record, "", "[INFO] lore", channel_id=channel_id)
+
+
+def commit_entries(shard, entries, dim=8):
+    vectors = np.eye(dim, dtype="float32")[[len(shard.scenes_data) + n for n in range(len(entries))]]
+    main.commit_new_scenes(shard, entries, [(entry, entry["messages"][0]["content"], 0) for entry in entries], vectors)
+
+
+def test_split_discord_message_short_text_is_one_part():
+    assert main.split_discord_message("Bonjour") == ["Bonjour"]
+    assert main.split_discord_message("") == [""]
+
+
+def test_split_discord_message_cuts_on_newlines():
+    lines = [f"ligne {i} " + "x" * 90 for i in range(60)]
+    parts = main.split_discord_message("\n".join(lines))
+    assert len(parts) > 1
+    assert all(len(part) <= 2000 for part in parts)
+    # Every cut falls between two lines, and no line is lost
+    assert "\n".join(parts).split("\n") == lines
+
+
+def test_split_discord_message_hard_cut_without_newline():
+    text = "a" * 4500
+    parts = main.split_discord_message(text)
+    assert [len(part) for part in parts] == [2000, 2000, 500]
+    assert "".join(parts) == text
+
+
+def test_lexical_index_ranks_rare_names_first():
+    index = main.LexicalIndex()
+    index.add(0, "Le capitaine traverse la forêt avec ses hommes")
+    index.add(1, "Aldric le forgeron rencontre le capitaine près de la forêt")
+    index.add(2, "La forêt est calme ce soir")
+    hits = index.search("Où est Aldric ?", 10)
+    assert [vector_id for vector_id, _ in hits] == [1]
+    ids = [vector_id for vector_id, _ in index.search("capitaine forêt", 10)]
+    assert ids[:2] == [0, 1] and 2 in ids
+
+
+def test_lexical_index_removed_chunk_is_never_returned(tmp_path):
+    index = main.LexicalIndex()
+    index.add(0, "Aldric garde la porte nord")
+    index.add(1, "Aldric quitte la ville")
+    index.remove(0)
+    assert [vector_id for vector_id, _ in index.search("Aldric", 10)] == [1]
+    # Removed chunks are also dropped from the saved postings
+    path = str(tmp_path / "lexical.npz")
+    index.save(path)
+    loaded = main.LexicalIndex.load(path)
+    assert loaded.doc_count == 1
+    assert loaded.search("Aldric", 10) == index.search("Aldric", 10)
+
+
+def test_hybrid_rank_fuses_vector_and_lexical_ranks():
+    class FakeIndex:
+        def search(self, query_vec, k):
+            return None, np.array([[5, 7, 9, -1]])
+
+    shard = SimpleNamespace(faiss_index=FakeIndex(), summary_index=None)
+    ranked = main.hybrid_rank(shard, np.zeros((1, 4), dtype="float32"), [(7, 3.0), (11, 2.0)], 4, rrf_k=60)
+    # 7 is found by both searches; the others are ordered by their rank in the one search that found them
+    assert [vector_id for vector_id, _ in ranked] == [7, 5, 11, 9]
+    assert dict(ranked)[7] == pytest.approx(1 / 62 + 1 / 61)
+    # Without a query embedding, the lexical ranking is used alone
+    assert [vector_id for vector_id, _ in main.hybrid_rank(shard, None, [(7, 3.0), (11, 2.0)], 4)] == [7, 11]
+
+
+def test_select_mmr_skips_near_duplicates():
+    vectors = np.array([[1.0, 0.0], [1.0, 0.0], [0.0, 1.0]], dtype="float32")
+    # The second excerpt repeats the first one: the less relevant but different third one is chosen instead
+    assert main.select_mmr([1.0, 0.95, 0.5], vectors, [10, 10, 10], 20, mmr_lambda=0.5) == [0, 2]
+    # Without vectors the selection follows relevance only
+    assert main.select_mmr([1.0, 0.95, 0.5], None, [10, 10, 10], 20, mmr_lambda=0.5) == [0, 1]
+
+
+def test_select_mmr_respects_token_budget():
+    vectors = np.eye(4, dtype="float32")
+    chosen = main.select_mmr([4.0, 3.0, 2.0, 1.0], vectors, [60, 50, 30, 10], 100)
+    assert sum([60, 50, 30, 10][position] for position in chosen) <= 100
+    # The most relevant excerpt goes first, then smaller ones fill the remaining budget
+    assert chosen == [0, 2, 3]
+    assert main.select_mmr([1.0], vectors[:1], [500], 100) == []
+    assert main.select_mmr([], None, [], 100) == []
+
+
+def test_pack_lore_context_labels_and_packs_excerpts(monkeypatch):
+    scenes = {0: {"id": 1, "type": "rp", "title": "Le duel"}, 1: {"id": 2, "type": "info", "title": "Les guildes"}}
+    texts = {0: "Aldric affronte le capitaine.", 1: "La guilde des forgerons tient le port."}
+
+    class FakeIndex:
+        def reconstruct(self, vector_id):
+            return np.eye(2, dtype="float32")[vector_id]
+
+    shard = SimpleNamespace(faiss_index=FakeIndex(), lookup_vector=lambda vector_id: (scenes.get(vector_id), texts.get(vector_id)))
+    monkeypatch.setattr(main, "context_token_budget", lambda model=None: 1000)
+    excerpts = main.pack_lore_context(shard, [(0, 0.9), (1, 0.5), (7, 0.4)])
+    assert excerpts == ["Scène: Le duel\nAldric affronte le capitaine.", "Info: Les guildes\nLa guilde des forgerons tient le port."]
+    # A budget too small for any excerpt gives no context at all
+    monkeypatch.setattr(main, "context_token_budget", lambda model=None: 1)
+    assert main.pack_lore_context(shard, [(0, 0.9), (1, 0.5)]) == []
+
+
+def test_token_bucket_keeps_a_reserve_for_interactive_calls():
+    async def scenario():
+        limiter = main.TokenBucketLimiter(10, 10**6, "test", reserve=0.2)
+        for _ in range(8):
+            await asyncio.wait_for(limiter.acquire(), 1)
+        # Background calls leave the last 20 % of the budget to /lore
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(limiter.acquire(), 0.2)
+        await asyncio.wait_for(limiter.acquire(interactive=True), 1)
+        # A request larger than the whole bucket is capped instead of waiting forever
+        await asyncio.wait_for(main.TokenBucketLimiter(10, 100, "test", reserve=0).acquire(1000, interactive=True), 1)
+
+    asyncio.run(scenario())
+
+
+def test_token_bucket_serves_interactive_calls_first():
+    async def scenario():
+        limiter = main.TokenBucketLimiter(600, 10**6, "test", reserve=0)
+        for _ in range(600):
+            await limiter.acquire(interactive=True)
+        served = []
+
+        async def call(name, interactive):
+            await limiter.acquire(interactive=interactive)
+            served.append(name)
+
+        background = asyncio.create_task(call("batch", False))
+        await asyncio.sleep(0.01)
+        # The /lore call arrives after the background call but is served before it
+        await asyncio.wait_for(asyncio.gather(background, call("lore", True)), 2)
+        assert served == ["lore", "batch"]
+
+    asyncio.run(scenario())
+
+
+def test_find_similar_inflight_matches_same_index_version_only():
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        question = np.array([1.0, 0.0], dtype="float32")
+        pending = loop.create_future()
+        shard = SimpleNamespace(version=3, lore_inflight={
+            ("qui est aldric", 2): {"outcome": loop.create_future(), "vector": question},  # older index
+            ("ou est aldric", 3): {"outcome": loop.create_future(), "vector": None},  # embedding not computed yet
+            ("qui est donc aldric", 3): {"outcome": pending, "vector": question},
+        })
+        assert main.find_similar_inflight(shard, question) is pending
+        assert main.find_similar_inflight(shard, np.array([0.0, 1.0], dtype="float32")) is None
+        shard.version = 4
+        assert main.find_similar_inflight(shard, question) is None
+
+    asyncio.run(scenario())
+
+
+def test_ingestion_pipeline_releases_scenes_in_order_key_order(monkeypatch):
+    gates = {}
+
+    async def fake_summarize(scene):
+        await gates[scene["name"]].wait()
+        scene["summary"] = f"Résumé de {scene['name']}"
+        scene["title"] = scene["name"]
+
+    async def fake_embed(texts, batch_size=None, progress_cb=None):
+        stats = {"texts": len(texts), "cached": 0, "batches": 1, "failed": 0, "tokens": 0}
+        return np.ones((len(texts), 2), dtype="float32"), list(range(len(texts))), stats
+
+    monkeypatch.setattr(main, "summarize_scene", fake_summarize)
+    monkeypatch.setattr(main, "embed_texts", fake_embed)
+    monkeypatch.setattr(main, "build_scene_chunks", lambda scene: [f"{scene['name']} chunk"])
+
+    async def wait_summaries(pipeline, count):
+        while pipeline.summaries_done < count:
+            await asyncio.sleep(0.01)
+        await pipeline.flush()
+
+    async def scenario():
+        committed = []
+        pipeline = main.IngestionPipeline(batch_size=1, groups=[("a",), ("b",)],
+                                          on_ready=lambda scenes, chunks, vectors: committed.extend(s["name"] for s in scenes))
+        for channel, number in [("a", 0), ("a", 1), ("b", 0)]:
+            name = f"{channel}{number}"
+            gates[name] = asyncio.Event()
+            await pipeline.submit({"type": "rp", "name": name}, order_key=(channel, number))
+        gates["a1"].set()
+        gates["b0"].set()
+        await wait_summaries(pipeline, 2)
+        # a1 and b0 are finished but wait for a0, whatever the order the summaries finished in
+        assert committed == []
+        gates["a0"].set()
+        await wait_summaries(pipeline, 3)
+        # Channel a may still receive scenes: b0 waits until it is fully read
+        assert committed == ["a0", "a1"]
+        pipeline.close_group(("a",))
+        assert committed == ["a0", "a1", "b0"]
+        scenes, _, _ = await pipeline.finish()
+        assert scenes == []
+        # Released scenes are no longer held by the pipeline
+        assert not pipeline._scenes and not pipeline._chunk_results
+
+    asyncio.run(scenario())
+
+
+def test_answer_cache_similar_lookup_after_lru_reorder():
+    cache = main.AnswerCache(ttl=3600, max_entries=10, threshold=0.95)
+    aldric, ville = np.array([1.0, 0.0], dtype="float32"), np.array([0.0, 1.0], dtype="float32")
+    cache.put("aldric", aldric, "Réponse Aldric")
+    cache.put("ville", ville, "Réponse ville")
+    assert cache.get_similar(np.array([0.7071, 0.7071], dtype="float32")) is None  # builds the matrix
+    assert cache.get("aldric") == "Réponse Aldric"  # moves "aldric" after "ville"
+    assert cache.get_similar(ville) == "Réponse ville"
+    assert cache.get_similar(aldric) == "Réponse Aldric"
+
+
+def test_answer_cache_ttl_and_max_entries(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(main.time, "monotonic", lambda: now[0])
+    cache = main.AnswerCache(ttl=60, max_entries=2, threshold=0.95)
+    cache.put("a", np.array([1.0, 0.0, 0.0], dtype="float32"), "A")
+    cache.put("b", np.array([0.0, 1.0, 0.0], dtype="float32"), "B")
+    cache.get("a")
+    # The least recently used question is evicted first
+    cache.put("c", np.array([0.0, 0.0, 1.0], dtype="float32"), "C")
+    assert cache.get("b") is None and cache.get("a") == "A" and cache.get("c") == "C"
+    now[0] += 61
+    assert cache.get("a") is None
+    assert cache.get_similar(np.array([0.0, 0.0, 1.0], dtype="float32")) is None
+
+
+def test_merge_summaries_groups_partials_level_by_level(monkeypatch):
+    group_sizes = []
+
+    async def fake_ask(messages, model=None, interactive=False):
+        group_sizes.append(messages[0]["content"].count("\nPartie "))
+        return f"fusion {len(group_sizes)}"
+
+    monkeypatch.setattr(main, "ask_gpt_async", fake_ask)
+    monkeypatch.setattr(main, "estimate_tokens", lambda text: 10)
+    monkeypatch.setattr(main, "SUMMARY_DIRECT_MAX_TOKENS", 25)
+    result = asyncio.run(main.merge_summaries([f"résumé {n}" for n in range(5)]))
+    # 5 partials -> [2, 2, 1] -> [2, 1] -> [2]: a single summary is carried to the next level as is
+    assert group_sizes == [2, 2, 2, 2]
+    assert result == "fusion 4"
+    assert asyncio.run(main.merge_summaries(["seul"])) == "seul"
+    assert asyncio.run(main.merge_summaries([])) is None
+
+
+def test_summarize_long_transcript_reuses_part_summaries_of_a_grown_scene(monkeypatch, tmp_path):
+    part_prompts = []
+    running = {"now": 0, "peak": 0}
+
+    async def fake_ask(messages, model=None, interactive=False):
+        content = messages[0]["content"]
+        if "extrait" not in content:
+            return "résumé fusionné"
+        running["now"] += 1
+        running["peak"] = max(running["peak"], running["now"])
+        await asyncio.sleep(0.01)
+        running["now"] -= 1
+        part_prompts.append(content)
+        if "ligne 045 " in content:
+            raise RuntimeError("erreur du modèle")
+        return f"résumé partiel {len(part_prompts)}"
+
+    monkeypatch.setattr(main, "ask_gpt_async", fake_ask)
+    monkeypatch.setattr(main, "summary_cache", main.SummaryCache(str(tmp_path / "summaries.json"), 100))
+    lines = [f"ligne {n:03d} " + "x" * 90 for n in range(200)]
+    assert asyncio.run(main.summarize_long_transcript("\n".join(lines[:100]))) == "résumé fusionné"
+    assert len(part_prompts) == 3
+    assert 1 < running["peak"] <= main.SUMMARY_PART_CONCURRENCY
+    # The failed second part is retried, the unchanged first part comes from the cache, the grown last part is new
+    part_prompts.clear()
+    asyncio.run(main.summarize_long_transcript("\n".join(lines[:130])))
+    assert len(part_prompts) == len(main.split_text_chunks("\n".join(lines[:130]))) - 1
+    assert not any("ligne 000 " in prompt for prompt in part_prompts)
+
+
+def test_save_index_data_uploads_to_drive_outside_the_persist_lock(shard, monkeypatch):
+    uploads = []
+
+    def fake_upload(drive_service, path, name, file_id=None, mimetype="application/zip"):
+        assert not shard.persist_lock.locked()
+        with open(path, "rb") as f:
+            uploads.append((name, f.read()))
+        return f"drive-{name}"
+
+    monkeypatch.setattr(main, "get_drive_service", lambda: object())
+    monkeypatch.setattr(main, "upload_drive_file", fake_upload)
+    commit_entries(shard, [info_entry(1, "Le royaume du nord"), info_entry(2, "La guilde du port")])
+    main.save_index_data(shard)
+    segment_name, manifest_name = [name for name, _ in uploads]
+    assert manifest_name == shard.manifest_name
+    # The manifest sent to Drive already knows where the new segment is
+    assert json.loads(uploads[1][1])["segments"][-1]["drive_id"] == f"drive-{segment_name}"
+    with open(shard.manifest_path, encoding="utf-8") as f:
+        assert json.load(f)["segments"][-1]["drive_id"] == f"drive-{segment_name}"
+
+
+def test_message_changes_are_applied_when_an_unopened_index_loads(shard):
+    entries = [info_entry(1, "Le royaume du nord"), info_entry(2, "La guilde du port")]
+    commit_entries(shard, entries)
+    main.save_index_data(shard)
+    scene_ids = {entry["messages"][0]["id"]: entry["id"] for entry in entries}
+    # Same guild in a fresh process: its index was never opened
+    reopened = main.LoreShard(shard.guild_id)
+    main.handle_message_change(reopened, "1", "Le royaume du nord est tombé")
+    main.handle_message_change(reopened, "2", None)
+    assert reopened.pending_changes == {"1": "Le royaume du nord est tombé", "2": None}
+
+    async def load():
+        await main.load_index_in_background(reopened)
+        return dict(reopened.refresh_deadlines)
+
+    deadlines = asyncio.run(load())
+    try:
+        assert reopened.pending_changes == {}
+        assert reopened.lore_store.get_messages(scene_ids["1"])[0]["content"] == "Le royaume du nord est tombé"
+        assert reopened.lore_store.get_messages(scene_ids["2"]) == []
+        assert set(deadlines) == {scene_ids["1"], scene_ids["2"]}
+    finally:
+        reopened.close_store()
+
+
+def test_index_load_status_transitions():
+    status = main.IndexLoadStatus()
+    assert status.as_dict()["state"] == "pending" and not status.ready
+    status.start()
+    status.begin_phase("manifeste")
+    status.set_progress(0.5)
+    assert status.as_dict()["state"] == "loading" and status.describe() == "manifeste, 50%"
+    status.begin_phase("index FAISS")
+    status.finish()
+    payload = status.as_dict()
+    assert payload["state"] == "ready" and status.ready
+    assert set(payload["phases"]) == {"manifeste", "index FAISS"} and payload["phase"] is None
+    status.mark_unloaded()
+    # An unloaded index stays ready: it is reloaded on demand
+    assert status.as_dict() == {"state": "unloaded", "phase": None, "progress": None, "elapsed_seconds": None, "phases": {}, "error": None}
+    assert status.ready
+    status.start()
+    status.finish(error="archive illisible")
+    assert status.as_dict()["state"] == "failed" and not status.ready and status.done
+
+
+def test_readiness_status_waits_for_the_startup_index_and_discord(monkeypatch):
+    def stub_shard(guild_id):
+        return SimpleNamespace(guild_id=guild_id, load_status=main.IndexLoadStatus(), memory_bytes=lambda: 3 * 1024 * 1024)
+
+    startup, other = stub_shard(7), stub_shard(8)
+    monkeypatch.setattr(main, "lore_shards", {7: startup, 8: other})
+    monkeypatch.setattr(main, "LORE_LEGACY_GUILD_ID", "7")
+    monkeypatch.setattr(main.bot, "is_ready", lambda: True)
+    status = main.readiness_status()
+    assert not status["ready"] and status["index"]["state"] == "pending"
+    assert status["shards"]["8"] == dict(other.load_status.as_dict(), memory_mb=3.0)
+    startup.load_status.start()
+    startup.load_status.finish()
+    # Other guilds' indexes are loaded lazily and do not hold readiness back
+    assert main.readiness_status()["ready"]
+    monkeypatch.setattr(main.bot, "is_ready", lambda: False)
+    assert not main.readiness_status()["ready"]
+    json.dumps(main.readiness_status())
+
+
+def test_iter_embedding_batches_respects_size_and_token_limits(monkeypatch):
+    monkeypatch.setattr(main, "estimate_tokens", len)
+    texts = ["a" * 10, "b" * 10, "c" * 10, "d" * 10, "e" * 10]
+    assert list(main.iter_embedding_batches(texts, batch_size=2, max_tokens=1000)) == [[0, 1], [2, 3], [4]]
+    assert list(main.iter_embedding_batches(texts, batch_size=10, max_tokens=25)) == [[0, 1], [2, 3], [4]]
+    # A text larger than the token budget still goes out, alone in its batch
+    assert list(main.iter_embedding_batches(["x" * 5, "y" * 50, "z" * 5], batch_size=10, max_tokens=20)) == [[0], [1], [2]]
+    assert list(main.iter_embedding_batches([], batch_size=10, max_tokens=20)) == []
+
+
+def test_embedding_cache_lru_eviction_and_round_trip(tmp_path):
+    path = str(tmp_path / "embedding_cache.npz")
+    # 8 float32 + 32-byte key = 64 bytes per entry: room for 3 entries
+    cache = main.EmbeddingCache(path, 3 * 64 / (1024 * 1024))
+    vectors = {text: np.full(8, n, dtype="float32") for n, text in enumerate(["a", "b", "c", "d"])}
+    for text in ["a", "b", "c"]:
+        cache.put(text, vectors[text])
+    assert cache.get("a") is not None  # "b" is now the least recently used
+    cache.put("d", vectors["d"])
+    assert len(cache) == 3 and "b" not in cache
+    cache.save()
+    loaded = main.EmbeddingCache(path, 1)
+    assert loaded.load()
+    # The LRU order survives the round trip: "c" is the oldest entry
+    assert list(loaded._entries) == [main.EmbeddingCache.key(text) for text in ["c", "a", "d"]]
+    for text in ["a", "c", "d"]:
+        np.testing.assert_array_equal(loaded.get(text), vectors[text])
+    assert loaded.get("b") is None and loaded.misses == 1
+
+
+def discord_message(message_id, content, created_at, author="Aldric", bot=False):
+    return SimpleNamespace(id=message_id, content=content, clean_content=content, created_at=created_at, attachments=[],
+                           author=SimpleNamespace(display_name=author, id=abs(hash(author)) % 10000, bot=bot))
+
+
+def test_iter_rp_scenes_splits_on_long_pauses(monkeypatch):
+    monkeypatch.setattr(main, "SCENE_BREAK_HOURS", 6)
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    offsets = [0, 1, 5, 12, 13, 40]  # hours: pauses of 7 h and 27 h start new scenes
+    messages = [discord_message(n, f"message {n}", start + timedelta(hours=hours)) for n, hours in enumerate(offsets)]
+    messages.insert(2, discord_message(99, "", start + timedelta(hours=2), author="Bot", bot=True))
+
+    async def history():
+        for message in messages:
+            yield message
+
+    async def collect():
+        return [scene async for scene in main.iter_rp_scenes(history(), "[RP] Monde", "[RP] taverne", channel_id=100)]
+
+    scenes = asyncio.run(collect())
+    assert [[m["content"] for m in scene["messages"]] for scene in scenes] == [
+        ["message 0", "message 1", "message 2"], ["message 3", "message 4"], ["message 5"]]
+    assert all(scene["type"] == "rp" and scene["channel_id"] == "100" and scene["location"] == "Monde / taverne" for scene in scenes)
+
+
+def rp_scene(scene_id, contents, channel_id=100, start=datetime(2024, 1, 1, tzinfo=timezone.utc)):
+    messages = [main.message_record(discord_message(scene_id * 100 + n, content, start + timedelta(minutes=n), author=author))
+                for n, (author, content) in enumerate(contents)]
+    scene = main.create_scene_object(messages, "[RP] Monde", "[RP] taverne", channel_id=channel_id)
+    scene.update(id=scene_id, summary=f"Résumé {scene_id}", title=f"Scène {scene_id}")
+    return scene
+
+
+def test_lore_store_scene_crud(tmp_path):
+    store = main.LoreStore(str(tmp_path / "lore.db"))
+    scene = rp_scene(1, [("Aldric", "Bonjour"), ("Brune", "Salut")])
+    store.add_scene(scene)
+    store.add_chunks([(0, 1, 0, "Aldric: Bonjour\nBrune: Salut")])
+    store.set_meta("last_segment", 3)
+    store.commit()
+    assert store.get_meta("last_segment") == "3" and store.get_meta("absent", 0) == 0
+    [metadata] = store.load_scene_metadata()
+    assert metadata == main.scene_metadata(scene) and metadata["message_count"] == 2
+    assert store.get_scene(1)["messages"] == scene["messages"]
+    assert store.get_scene(2) is None
+    assert store.load_vector_map() == {0: (1, 0)} and store.get_chunk_ids([1]) == [0]
+    message_id = scene["messages"][0]["id"]
+    assert store.find_message_scene(message_id) == (1, "Bonjour")
+    store.update_message(message_id, "Bonsoir")
+    store.delete_message(scene["messages"][1]["id"])
+    assert [m["content"] for m in store.get_messages(1)] == ["Bonsoir"]
+    # Replacing a scene replaces its messages
+    store.add_scene(dict(scene, title="Nouveau titre"))
+    assert store.get_scene(1)["title"] == "Nouveau titre" and len(store.get_messages(1)) == 2
+    store.delete_scene(1)
+    assert store.load_scene_metadata() == [] and store.get_messages(1) == [] and store.load_vector_map() == {}
+    store.close()
+
+
+def test_migrate_legacy_scenes_json(shard, tmp_path):
+    legacy = [rp_scene(1, [("Aldric", "Bonjour")]), dict(info_entry(7, "Le royaume du nord"), id=2)]
+    legacy[0]["chunks"] = ["chunk a", "chunk b"]
+    path = tmp_path / "scenes.json"
+    path.write_text(json.dumps(legacy), encoding="utf-8")
+    main.migrate_legacy_scenes_json(shard, str(path))
+    store = shard.lore_store
+    assert [scene["id"] for scene in store.load_scene_metadata()] == [1, 2]
+    # Same vector order as the old index: the scene's chunks, then the info entry itself
+    assert store.load_vector_map() == {0: (1, 0), 1: (1, 1), 2: (2, 0)}
+    assert store.get_chunk_text(1) == "chunk b"
+    assert store.get_messages(2)[0]["content"] == "Le royaume du nord"
+
+
+def test_segment_round_trip_with_removals(shard):
+    entries = [info_entry(1, "Le royaume du nord"), info_entry(2, "La guilde du port"), info_entry(3, "Les pirates du sud")]
+    commit_entries(shard, entries)
+    # The second entry is deleted from Discord, the first one is edited
+    removed_id = entries[1]["id"]
+    with shard.persist_lock:
+        main.remove_index_chunks(shard, [1])
+        shard.lore_store.delete_scene(removed_id)
+        main.record_index_delta(shard, [], [], None, removed_vectors=[1], removed_scenes=[removed_id])
+    shard.lore_store.update_message("1", "Le royaume du nord est tombé")
+    path = main.write_segment(shard, "segment-000001.zip")
+
+    replica = main.LoreShard(4343)
+    main.load_index_data(replica)
+    try:
+        assert main.apply_segment(replica, path, 1) == (2, 3)
+        store = replica.lore_store
+        assert [scene["id"] for scene in store.load_scene_metadata()] == [entries[0]["id"], entries[2]["id"]]
+        assert store.get_messages(entries[0]["id"])[0]["content"] == "Le royaume du nord est tombé"
+        assert store.load_vector_map() == {0: (entries[0]["id"], 0), 2: (entries[2]["id"], 0)}
+        assert store.get_meta("last_segment") == "1"
+        assert replica.faiss_index.ntotal == 2
+        _, found = replica.faiss_index.search(np.eye(8, dtype="float32")[:3], 1)
+        assert found[:, 0].tolist()[::2] == [0, 2] and found[1, 0] != 1
+        assert replica.lexical_index.search("guilde", 10) == []
+        assert [vector_id for vector_id, _ in replica.lexical_index.search("pirates", 10)] == [2]
+    finally:
+        replica.close_store()
+
+
+def test_choose_index_type_thresholds(monkeypatch):
+    monkeypatch.setattr(main, "LORE_INDEX_TYPE", "auto")
+    monkeypatch.setattr(main, "LORE_ANN_MIN_VECTORS", 100)
+    monkeypatch.setattr(main, "LORE_IVF_MIN_VECTORS", 1000)
+    assert [main.choose_index_type(n) for n in (0, 99, 100, 999, 1000)] == ["flat", "flat", "hnsw", "hnsw", "ivf"]
+    monkeypatch.setattr(main, "LORE_INDEX_TYPE", "flat")
+    assert main.choose_index_type(10**7) == "flat"
+
+
+def test_index_recall_report(monkeypatch):
+    rng = np.random.default_rng(0)
+    vectors = main.normalize_vectors(rng.standard_normal((3000, 16)))
+    flat = main.create_faiss_index("flat", 16, len(vectors))
+    flat.add(vectors)
+    assert main.index_recall_report(flat) is None
+    monkeypatch.setattr(main, "LORE_IVF_NPROBE", 8)
+    monkeypatch.setattr(main, "LORE_IVF_NLIST", 16)
+    ivf = main.create_faiss_index("ivf", 16, len(vectors))
+    ivf.train(vectors)
+    ivf.add(vectors)
+    ivf.make_direct_map()
+    report = main.index_recall_report(ivf, k=10, query_count=50)
+    assert report["type"] == "ivf" and report["knob"] == "nprobe" and report["queries"] == 50
+    settings = {setting["nprobe"]: setting["recall"] for setting in report["settings"]}
+    # Every setting up to the number of lists, plus the configured one
+    assert set(settings) == {1, 4, 8, 16}
+    assert all(0 <= recall <= 1 for recall in settings.values())
+    # Visiting all 16 lists is an exact search
+    assert settings[16] == 1.0 and settings[1] < 1.0
+    # The search settings are restored afterwards
+    assert ivf.nprobe == 8
+
+
+def test_live_buffers_close_scenes_and_trim_indexed_messages(monkeypatch):
+    monkeypatch.setattr(main, "SCENE_BREAK_HOURS", 6)
+    shard = SimpleNamespace(live_buffers={}, live_pending=[], scenes_data=[])
+    rp = SimpleNamespace(id=100, name="[RP] taverne", category=SimpleNamespace(name="[RP] Monde"))
+    info = SimpleNamespace(id=900, name="[INFO] lore", category=None)
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+    def post(channel, message_id, hours, kind):
+        message = discord_message(message_id, f"message {message_id}", start + timedelta(hours=hours))
+        message.channel = channel
+        main.buffer_live_message(shard, message, kind)
+
+    post(rp, 1, 0, "rp")
+    post(rp, 2, 1, "rp")
+    post(info, 3, 1, "info")
+    assert [m["id"] for m in shard.live_buffers[100]["messages"]] == ["1", "2"]
+    assert [(channel_id, kind) for channel_id, kind, _, _, _ in shard.live_pending] == [(900, "info")]
+    # A long pause closes the scene in progress and starts a new one
+    post(rp, 4, 10, "rp")
+    assert [[m["id"] for m in messages] for _, _, _, _, messages in shard.live_pending] == [["3"], ["1", "2"]]
+    assert [m["id"] for m in shard.live_buffers[100]["messages"]] == ["4"]
+    main.close_live_scene(shard, 100)
+    main.close_live_scene(shard, 100)
+    assert 100 not in shard.live_buffers and len(shard.live_pending) == 3
+    # /setup has since indexed channel 100 up to message 2: only message 4 is left to index live
+    post(rp, 5, 11, "rp")
+    shard.scenes_data = [{"channel_id": "100", "last_time": (start + timedelta(hours=1)).isoformat()}]
+    main.trim_live_buffers(shard)
+    assert [[m["id"] for m in messages] for _, _, _, _, messages in shard.live_pending] == [["3"], ["4"]]
+    assert [m["id"] for m in shard.live_buffers[100]["messages"]] == ["5"]
+
+
+def test_enforce_shard_memory_cap_unloads_least_recently_used(monkeypatch):
+    class StubShard:
+        def __init__(self, guild_id, last_used, busy=False):
+            self.guild_id, self.last_used, self.busy = guild_id, last_used, busy
+            self.loaded = True
+            self.pending_delta = {"chunks": []}
+
+        def memory_bytes(self):
+            return 400 * 1024 * 1024 if self.loaded else 0
+
+        def evictable(self):
+            return self.loaded and not self.busy
+
+        def unload(self):
+            self.loaded = False
+
+    saved = []
+    shards = {guild_id: StubShard(guild_id, last_used, busy) for guild_id, last_used, busy in [(1, 10, True), (2, 20, False), (3, 30, False)]}
+    monkeypatch.setattr(main, "lore_shards", shards)
+    monkeypatch.setattr(main, "LORE_SHARDS_MAX_MB", 1000)
+    monkeypatch.setattr(main, "save_index_data", lambda shard: saved.append(shard.guild_id))
+    asyncio.run(main.enforce_shard_memory_cap())
+    # The oldest index is in use: the next least recently used one is saved then unloaded, which is enough
+    assert saved == [2]
+    assert [guild_id for guild_id, shard in shards.items() if shard.loaded] == [1, 3]
+    asyncio.run(main.enforce_shard_memory_cap())
+    assert saved == [2]
+
+
+def test_metrics_registry_renders_prometheus_text_format():
+    registry = main.MetricsRegistry(buckets=(0.1, 1.0))
+    registry.describe("lore_errors_total", "counter", "Erreurs")
+    registry.describe("lore_stage_seconds", "histogram", "Durées")
+    registry.inc("lore_errors_total", command="lore", stage="embed")
+    registry.inc("lore_errors_total", 2, stage="embed", command="lore")
+    registry.observe("lore_stage_seconds", 0.05, command="setup")
+    registry.observe("lore_stage_seconds", 0.5, command="setup")
+    registry.add_collector(lambda: [("lore_queue", {"pool": 'a"b\\c'}, 3)])
+    registry.add_collector(lambda: 1 / 0)  # a failing collector does not break the exposition
+    assert registry.render().splitlines() == [
+        "# HELP lore_errors_total Erreurs",
+        "# TYPE lore_errors_total counter",
+        'lore_errors_total{command="lore",stage="embed"} 3',
+        "# HELP lore_queue ",
+        "# TYPE lore_queue untyped",
+        'lore_queue{pool="a\\"b\\\\c"} 3',
+        "# HELP lore_stage_seconds Durées",
+        "# TYPE lore_stage_seconds histogram",
+        'lore_stage_seconds_bucket{command="setup",le="0.1"} 1',
+        'lore_stage_seconds_bucket{command="setup",le="1.0"} 2',
+        'lore_stage_seconds_bucket{command="setup",le="+Inf"} 2',
+        'lore_stage_seconds_sum{command="setup"} 0.55',
+        'lore_stage_seconds_count{command="setup"} 2',
+    ]
+
+
+@pytest.mark.parametrize("base_type", ["flat", "hnsw"])
+def test_search_subset_only_returns_active_vectors_of_the_subset(base_type):
+    rng = np.random.default_rng(1)
+    vectors = main.normalize_vectors(rng.standard_normal((300, 16)))
+    base = main.create_faiss_index(base_type, 16, 200)
+    base.add(vectors[:200])
+    index = main.LoreVectorIndex(16, base)
+    index.add(vectors[200:])
+    index.remove([5, 250])
+    query = vectors[[5]]
+    subset = [3, 5, 7, 150, 210, 250, 299]
+    distances, found = index.search_subset(query, 4, subset)
+    # Exact ranking of the subset without the removed vectors 5 and 250
+    active = [3, 7, 150, 210, 299]
+    scores = vectors[active] @ query[0]
+    expected = [active[i] for i in np.argsort(-scores)[:4]]
+    assert found[0].tolist() == expected
+    np.testing.assert_allclose(distances[0], np.sort(scores)[::-1][:4], rtol=1e-5)
+    # More slots than candidates: empty slots come last
+    _, found = index.search_subset(query, 3, [3, 5])
+    assert found[0].tolist() == [3, -1, -1]
+    _, found = index.search_subset(query, 2, [])
+    assert found[0].tolist() == [-1, -1]
+
+
+def test_shortlist_scenes_needs_a_complete_summary_index(monkeypatch):
+    monkeypatch.setattr(main, "LORE_SUMMARY_SCENES", 2)
+    summaries = main.SceneSummaryIndex(2)
+    summaries.set([(1, np.array([1.0, 0.0], dtype="float32")), (2, np.array([0.0, 1.0], dtype="float32")),
+                   (3, np.array([0.6, 0.8], dtype="float32"))])
+    shard = SimpleNamespace(summary_index=summaries, scenes_data=[{}, {}, {}])
+    query = np.array([[0.0, 1.0]], dtype="float32")
+    assert main.shortlist_scenes(shard, query) == [2, 3]
+    # A scene without a summary vector would never be searched: no shortlist at all
+    shard.scenes_data.append({})
+    assert main.shortlist_scenes(shard, query) is None
+    shard.scenes_data.pop()
+    monkeypatch.setattr(main, "LORE_SUMMARY_SCENES", 0)
+    assert main.shortlist_scenes(shard, query) is None